@@ -0,0 +1,55 @@
+"""Micro-benchmark: classifying channel names into channel groups
+
+Compares matching every channel name against a freshly compiled pattern of every group (previous
+implementation of fix_channel_positions) with a single match of a precompiled ChannelNameMatcher.
+
+Run from the bot's root directory: python -m bench.channel_name_matcher_bench
+"""
+import random
+import re
+import timeit
+
+from cogs.channel_manager import ChannelNameMatcher
+
+N_CHANNELS = 5000
+N_GROUPS = 50
+
+
+def classify_per_group(group_names, channel_names):
+    result = []
+    for name in channel_names:
+        key = None
+        for group_name in group_names:
+            pattern = re.compile(r'^' + re.escape(group_name) + r'\s+#(\d+)')
+            match = pattern.match(name)
+            if match:
+                key = group_name, int(match.group(1))
+        result.append(key)
+    return result
+
+
+def classify_matcher(group_names, channel_names):
+    matcher = ChannelNameMatcher(group_names)
+    return [matcher.match(name) for name in channel_names]
+
+
+def main():
+    rnd = random.Random(0)
+    group_names = ['Group {0}'.format(i) for i in range(N_GROUPS)]
+    channel_names = []
+    for i in range(N_CHANNELS):
+        if rnd.random() < 0.8:
+            channel_names.append('{0} #{1}'.format(rnd.choice(group_names), rnd.randint(1, 100)))
+        else:
+            channel_names.append('Other channel {0}'.format(i))
+
+    assert classify_per_group(group_names, channel_names) == classify_matcher(group_names, channel_names)
+
+    for name, fun in [('per group patterns', classify_per_group), ('ChannelNameMatcher', classify_matcher)]:
+        runs = 3
+        best = min(timeit.repeat(lambda: fun(group_names, channel_names), number=1, repeat=runs))
+        print('{0:20s}: {1:8.2f} ms for {2} channels x {3} groups'.format(name, best * 1000, N_CHANNELS, N_GROUPS))
+
+
+if __name__ == '__main__':
+    main()
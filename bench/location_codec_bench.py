@@ -0,0 +1,68 @@
+"""Benchmark: serializing a HierarchicalConfig Location tree
+
+Compares encode/decode time and size of jsonpickle (previous implementation of HierarchicalConfig.save/load)
+with the json and marshal formats of LocationCodec on a tree of 10k locations.
+
+Run from the bot's root directory: python -m bench.location_codec_bench
+"""
+import random
+import timeit
+
+from cogs.hierarchical_config import HierarchicalConfig, LocationCodec
+
+try:
+    import jsonpickle
+except ImportError:
+    jsonpickle = None
+
+N_SERVERS = 100
+N_GROUPS = 99
+
+
+def build_config():
+    rnd = random.Random(0)
+    config = HierarchicalConfig()
+    config.set_var('min_empty_channels', 1)
+    for server in range(N_SERVERS):
+        server_id = str(10 ** 17 + server)
+        config.set_var('channel_timeout', rnd.randint(1, 60), [server_id])
+        config.set_var('groups', ['Group {0}'.format(i) for i in range(N_GROUPS)], [server_id])
+        for group in range(N_GROUPS):
+            config.set_var('min_empty_channels', rnd.randint(1, 5), [server_id, 'Group {0}'.format(group)])
+    return config
+
+
+def jsonpickle_encode(location):
+    jsonpickle.set_preferred_backend('simplejson')
+    jsonpickle.set_encoder_options('simplejson', sort_keys=True, indent=4)
+    return jsonpickle.encode(location).encode('utf-8')
+
+
+def jsonpickle_decode(encoded):
+    return jsonpickle.decode(encoded.decode('utf-8'))
+
+
+def main():
+    location = build_config().data
+    codecs = [
+        ('LocationCodec json', LocationCodec.encode, LocationCodec.decode),
+        ('LocationCodec binary', lambda data: LocationCodec.encode(data, binary=True), LocationCodec.decode),
+    ]
+    if jsonpickle is not None:
+        codecs.insert(0, ('jsonpickle', jsonpickle_encode, jsonpickle_decode))
+    else:
+        print('jsonpickle is not installed, skipping it')
+
+    n_locations = 1 + N_SERVERS * (1 + N_GROUPS)
+    for name, encode, decode in codecs:
+        encoded = encode(location)
+        assert decode(encoded) == location
+        runs = 5
+        encode_time = min(timeit.repeat(lambda: encode(location), number=1, repeat=runs))
+        decode_time = min(timeit.repeat(lambda: decode(encoded), number=1, repeat=runs))
+        print('{0:22s}: encode {1:8.2f} ms, decode {2:8.2f} ms, {3:9d} bytes for {4} locations'
+              .format(name, encode_time * 1000, decode_time * 1000, len(encoded), n_locations))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Memory benchmark: HierarchicalConfig tree of 50k locations
+
+Compares memory allocated for the tree built of Location nodes with eagerly allocated `locations` and `values`
+dicts (previous implementation) with the current __slots__ Location, which allocates them on first write.
+
+Run from the bot's root directory: python -m bench.location_memory_bench
+"""
+import tracemalloc
+
+from cogs.hierarchical_config import HierarchicalConfig
+
+N_SERVERS = 250
+N_GROUPS = 199
+
+
+class EagerLocation:
+    def __init__(self, locations=None, values=None):
+        self.locations = locations if locations else {}
+        self.values = values if values else {}
+
+
+def build_eager():
+    root = EagerLocation()
+    for server in range(N_SERVERS):
+        server_location = root.locations.setdefault(str(10 ** 17 + server), EagerLocation())
+        server_location.values['channel_timeout'] = 5
+        for group in range(N_GROUPS):
+            group_location = server_location.locations.setdefault('Group {0}'.format(group), EagerLocation())
+            if group % 10 == 0:
+                group_location.values['min_empty_channels'] = 2
+    return root
+
+
+def build_config():
+    config = HierarchicalConfig()
+    for server in range(N_SERVERS):
+        server_id = str(10 ** 17 + server)
+        config.set_var('channel_timeout', 5, [server_id])
+        for group in range(N_GROUPS):
+            location = config.ensure_path([server_id, 'Group {0}'.format(group)])
+            if group % 10 == 0:
+                location.set_value('min_empty_channels', 2)
+    return config
+
+
+def measure(build):
+    tracemalloc.start()
+    tree = build()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return tree, size
+
+
+def main():
+    n_locations = 1 + N_SERVERS * (1 + N_GROUPS)
+    for name, build in [('eager dicts', build_eager), ('__slots__ Location', build_config)]:
+        tree, size = measure(build)
+        print('{0:20s}: {1:8.2f} MiB, {2:6.1f} bytes per location for {3} locations'
+              .format(name, size / 2 ** 20, size / n_locations, n_locations))
+        del tree
+
+
+if __name__ == '__main__':
+    main()
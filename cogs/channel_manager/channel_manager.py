@@ -1,25 +1,35 @@
 import asyncio
+import atexit
+import bisect
+import functools
+import heapq
 import json
 import logging
 import os
 import random
 import re
-from asyncio.queues import Queue
-from collections import defaultdict, ChainMap
-from datetime import datetime, timedelta
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict, Counter, OrderedDict, namedtuple, deque
 from operator import itemgetter
-from typing import Any, List, Dict, Union, Set, Callable, Iterable, NewType
+from typing import Any, List, Dict, Union, Set, Callable, Iterable, NewType, Tuple
 
 import discord
 from discord import ChannelType
 from discord.channel import Channel
 from discord.ext import commands
-from discord.http import HTTPClient
 from discord.http import Route
 
+from cogs.hierarchical_config import Config, Variable, VariableNotInLevel, VariableRegistry, write_file_atomic
+from cogs.micks_utils import discord_message_size, paginate, create_messages_from_list
 from cogs.utils import checks
 from cogs.utils.dataIO import dataIO
 
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
 logger = logging.getLogger("red.channel_manager")
 logger.setLevel(logging.WARNING)
 
@@ -27,128 +37,982 @@ BaseValueType = NewType('BaseValueType', Union[str, int, float])
 ValueType = NewType('ValueType', Union[BaseValueType, List[BaseValueType], Dict[str, BaseValueType]])
 
 
-class Config:
-    def __init__(self, defaults: Dict[str, ValueType] = None, data: Dict[str,Dict[str,BaseValueType]] = None):
-        self.data = defaultdict(dict)
-        if data is not None:
-            self.data.update(data)
-        self.defaults = defaults if defaults is not None else {}  # type: Dict[str, ValueType]
+class LazyArg:
+    """Argument of a log message computed only if the message is actually formatted"""
+    __slots__ = ('fn',)
 
-    def __eq__(self, other):
-        if not isinstance(other, Config):
-            return False
-        elif self.defaults != other.defaults:
-            return False
-        else:
-            return self.data == self.data
+    def __init__(self, fn: Callable[[], Any]):
+        self.fn = fn
 
     def __str__(self):
-        return str(self.__dict__)
-
-    def get_location(self, path: List[str]):
-        if path is None or len(path) == 0:
-            return self.data['']
-        location = ChainMap(self.data[''], self.defaults)
-        current_path = ''
-        for key in path:
-            current_path = os.path.join(current_path, key)
-            location = location.new_child(self.data[current_path])
-        return location
-
-    def set_var(self, name: str, value: ValueType, path: List[str] = None):
-        if isinstance(value, (str, int, float, List, Dict)):
-            location = self.get_location(path)
-            location[name] = value
+        return str(self.fn())
+
+    def __repr__(self):
+        return repr(self.fn())
+
+
+def log_fields(server: discord.Server = None, **fields) -> Dict[str, Any]:
+    """Structured fields of a log record, to be passed as `extra`
+
+    `server_id` is used by ServerDebugFilter, other fields are appended to the message by StructuredFormatter
+    """
+    return {'server_id': server.id if server is not None else None, 'fields': fields}
+
+
+class ServerDebugFilter(logging.Filter):
+    """Lets records below configured level through only if they belong to a server with debugging switched on
+
+    Level of the logger is lowered to DEBUG only while some server is being debugged, so otherwise
+    debug messages are discarded by the logger before they are formatted.
+    """
+
+    def __init__(self, logger: logging.Logger):
+        super().__init__()
+        self.logger = logger
+        self.level = logger.level
+        self.server_ids = set()  # type: Set[str]
+
+    def set_level(self, level: int):
+        self.level = level
+        self.apply()
+
+    def set_server_debug(self, server_id: str, enabled: bool):
+        if enabled:
+            self.server_ids.add(server_id)
         else:
-            raise TypeError('value should be one of following types: str, int, float, List, Dict')
+            self.server_ids.discard(server_id)
+        self.apply()
 
-    def delete_var(self, path: List[str], name: str):
-        location = self.get_location(path)
-        if name in location[name]:
-            del location[name]
+    def apply(self):
+        self.logger.setLevel(min(self.level, logging.DEBUG) if self.server_ids else self.level)
 
-    def get_var(self, name: str, path: Iterable[str] = None, default = None) -> ValueType:
-        """Retrieve variable value from specified path
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= self.level or getattr(record, 'server_id', None) in self.server_ids
 
-        If value doesn't exist at specified path, value is looked up at lower levels,
 
-        If variable is of mutable type then a copy of it will be returned, to modify it use set_var with copy as value
+class StructuredFormatter(logging.Formatter):
+    """Formatter appending structured fields of the record (see log_fields) to the message"""
 
-        :param name: name of the variable to retrieve
-        :param path: path of the variable
-        :return: value of the variable
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        message = super().formatMessage(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            message += ' ' + ' '.join('{0}={1!r}'.format(key, value) for key, value in sorted(fields.items()))
+        return message
+
+
+_MISSING = object()
+
+
+class ConfigStorage(ABC):
+    """Storage backend of a Config
+
+    Config reports every change with record_set/record_delete. Saving is split in two steps:
+    prepare_save() runs on the event loop and captures everything that has to be written,
+    write() does the (blocking) writing and may run in an executor.
+    A lazy storage provides only the root level up front, the rest is loaded by Config with load_subtree().
+    """
+    lazy = False
+
+    @abstractmethod
+    def load(self) -> Dict[str, Dict[str, ValueType]]:
+        """
+        :return: stored config data, None if nothing is stored yet
         """
 
-        location = self.get_location(path)
-        value = location.get(name)
-        logger.debug('retrieved variable {0!r}: value {1!r}, type {2!r}'.format(name, value, type(value)))
-        if isinstance(value, (str, int, float)) or value is None:
-            if value is None and default is not None:
-                return default
-            else:
-                return value
-        elif isinstance(value,(List,Set,Dict)):
-            return value.copy()
-        else:
-            raise TypeError('tried to retrieve value of unsupported type (this should not be possible)')
+    def load_root(self) -> Dict[str, Dict[str, ValueType]]:
+        """Data Config starts with: everything, only the root level for lazy storages
+
+        :return: None if nothing is stored yet
+        """
+        return self.load()
+
+    def load_subtree(self, key: str) -> Dict[str, Dict[str, ValueType]]:
+        """Levels at and below top-level key, for lazy storages"""
+        raise NotImplementedError
+
+    def record_set(self, path_key: str, name: str, value: ValueType):
+        pass
 
-    def save(self, file_name: str):
-        with open(file_name, 'w+') as config_file:
-            json.dump(self.data, config_file)
+    def record_delete(self, path_key: str, name: str):
+        pass
 
-    def load(self, file_name: str):
-        with open(file_name, 'r') as config_file:
-            json_str = config_file.read()
-            self.data = json.loads(json_str)
+    @abstractmethod
+    def prepare_save(self, data: Dict[str, Dict[str, ValueType]], compact: bool = False):
+        """
+        :param compact: store whole data instead of just the recorded changes
+        :return: payload for write()
+        """
+
+    @abstractmethod
+    def write(self, payload):
+        pass
+
+
+class JsonStorage(ConfigStorage):
+    """Stores whole config as a single json file, rewritten on every save"""
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+
+    def load(self):
+        if not os.path.isfile(self.file_name):
+            return None
+        try:
+            return dataIO.load_json(self.file_name)
+        except json.JSONDecodeError:
+            logger.error('config file %s is corrupted, starting with empty config', self.file_name)
+            return {}
+
+    def prepare_save(self, data, compact=False):
+        return json.dumps(data)
+
+    def write(self, payload):
+        write_file_atomic(self.file_name, payload)
+
+
+class JournalStorage(JsonStorage):
+    """Stores config as a json snapshot and an append-only journal of changes made since the snapshot
+
+    Journal has one json record per line: ["set", path_key, name, value] or ["delete", path_key, name].
+    When the journal grows over `compact_size` bytes it's compacted: a new snapshot is written atomically and
+    the journal is emptied. Records are idempotent, so a crash between those two steps only means some records
+    are replayed over a snapshot that already contains them. A record torn by a crash is dropped on load.
+    """
+
+    def __init__(self, file_name: str, compact_size: int = 1024 * 1024):
+        super().__init__(file_name)
+        self.journal_file_name = file_name + '.journal'
+        self.compact_size = compact_size
+        self.journal_size = 0
+        self.pending = []  # type: List[List[ValueType]]
+
+    def load(self):
+        data = super().load()
+        if not os.path.isfile(self.journal_file_name):
+            return data
+        data = data if data is not None else {}
+        valid_size = 0
+        with open(self.journal_file_name, 'rb') as journal:
+            for line in journal:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('incomplete record')
+                    self.apply(data, json.loads(line.decode('utf-8')))
+                except ValueError:
+                    logger.warning('dropping damaged journal tail of %s at byte %d', self.journal_file_name, valid_size)
+                    break
+                valid_size += len(line)
+        if valid_size != os.path.getsize(self.journal_file_name):
+            with open(self.journal_file_name, 'r+b') as journal:
+                journal.truncate(valid_size)
+        self.journal_size = valid_size
+        return data
+
+    @staticmethod
+    def apply(data: Dict[str, Dict[str, ValueType]], record: List[ValueType]):
+        if record[0] == 'set':
+            _, path_key, name, value = record
+            data.setdefault(path_key, {})[name] = value
+        elif record[0] == 'delete':
+            _, path_key, name = record
+            data.get(path_key, {}).pop(name, None)
+        else:
+            raise ValueError('unknown journal record {0!r}'.format(record))
+
+    def record_set(self, path_key, name, value):
+        self.pending.append(['set', path_key, name, value])
+
+    def record_delete(self, path_key, name):
+        self.pending.append(['delete', path_key, name])
+
+    def prepare_save(self, data, compact=False):
+        records = ''.join(json.dumps(record) + '\n' for record in self.pending).encode('utf-8')
+        self.pending = []
+        if compact or self.journal_size + len(records) > self.compact_size:
+            return None, json.dumps(data)
+        return records, None
+
+    def write(self, payload):
+        records, snapshot = payload
+        if snapshot is not None:
+            write_file_atomic(self.file_name, snapshot)
+            write_file_atomic(self.journal_file_name, '')
+            self.journal_size = 0
+        elif records:
+            with open(self.journal_file_name, 'ab') as journal:
+                journal.write(records)
+                journal.flush()
+                os.fsync(journal.fileno())
+            self.journal_size += len(records)
+
+
+class SqliteStorage(ConfigStorage):
+    """Stores config in a sqlite database, one row per variable
+
+    Rows are keyed by (path, name), so a change touches only the row of its variable.
+    Changes are coalesced and written in a single transaction.
+    Only the root level is loaded on startup, levels of a server are read with a range scan of the primary key
+    when the server's variables are first used.
+    """
+    lazy = True
+
+    def __init__(self, file_name: str):
+        self.file_name = os.path.splitext(file_name)[0] + '.sqlite3'
+        self.pending = {}  # type: Dict[Tuple[str, str], ValueType]
+
+    def connect(self) -> 'sqlite3.Connection':
+        db = sqlite3.connect(self.file_name)
+        db.execute('CREATE TABLE IF NOT EXISTS config ('
+                   'path TEXT NOT NULL, name TEXT NOT NULL, value TEXT NOT NULL, '
+                   'PRIMARY KEY (path, name)) WITHOUT ROWID')
+        return db
+
+    @staticmethod
+    def to_data(rows: Iterable[Tuple[str, str, str]]) -> Dict[str, Dict[str, ValueType]]:
+        data = {}
+        for path_key, name, value in rows:
+            data.setdefault(path_key, {})[name] = json.loads(value)
+        return data
+
+    def load(self):
+        if not os.path.isfile(self.file_name):
+            return None
+        db = self.connect()
+        try:
+            return self.to_data(db.execute('SELECT path, name, value FROM config'))
+        finally:
+            db.close()
+
+    def load_root(self):
+        if not os.path.isfile(self.file_name):
+            return None
+        db = self.connect()
+        try:
+            if db.execute('SELECT 1 FROM config LIMIT 1').fetchone() is None:
+                return {}
+            return {'': self.to_data(db.execute("SELECT path, name, value FROM config WHERE path = ''")).get('', {})}
+        finally:
+            db.close()
+
+    def load_subtree(self, key):
+        # paths of the levels are key and key + os.sep + ..., all of them sort before key + the character after os.sep
+        db = self.connect()
+        try:
+            rows = db.execute('SELECT path, name, value FROM config WHERE path >= ? AND path < ?',
+                              (key, key + chr(ord(os.sep) + 1)))
+            return self.to_data(row for row in rows if row[0] == key or row[0].startswith(key + os.sep))
+        finally:
+            db.close()
+
+    def record_set(self, path_key, name, value):
+        self.pending[(path_key, name)] = value
+
+    def record_delete(self, path_key, name):
+        self.pending[(path_key, name)] = _MISSING
+
+    def prepare_save(self, data, compact=False):
+        if compact:
+            self.pending = {}
+            rows = [(path_key, name, json.dumps(value))
+                    for path_key, values in data.items() for name, value in values.items()]
+            return True, rows, []
+        rows = [(path_key, name, json.dumps(value))
+                for (path_key, name), value in self.pending.items() if value is not _MISSING]
+        deleted = [key for key, value in self.pending.items() if value is _MISSING]
+        self.pending = {}
+        return False, rows, deleted
+
+    def write(self, payload):
+        replace_all, rows, deleted = payload
+        db = self.connect()
+        try:
+            with db:
+                if replace_all:
+                    db.execute('DELETE FROM config')
+                db.executemany('DELETE FROM config WHERE path = ? AND name = ?', deleted)
+                db.executemany('INSERT OR REPLACE INTO config (path, name, value) VALUES (?, ?, ?)', rows)
+        finally:
+            db.close()
+
+
+config_storages = {
+    'json': JsonStorage,
+    'journal': JournalStorage
+}
+if sqlite3 is not None:
+    config_storages['sqlite'] = SqliteStorage
+
+
+class ConfigSaver:
+    """Write-behind persistence of a Config
+
+    mark_dirty() schedules a save after `delay` seconds, all changes made in the meantime are written at once.
+    What has to be written is captured on the event loop, so config can't change while being saved, the writing
+    itself is done by the config's storage in an executor. A failed write is retried, with the delay doubling
+    after every failure in a row up to `max_retry_delay` seconds.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, config: Config, delay: float = 5,
+                 max_retry_delay: float = 300):
+        self.loop = loop
+        self.config = config
+        self.delay = delay
+        self.max_retry_delay = max_retry_delay
+        self.retry_delay = delay
+        self.dirty = False
+        self.task = None  # type: asyncio.Task
+        self.lock = asyncio.Lock()
+        self.writes = 0
+        self.failed = False
+
+    def mark_dirty(self):
+        self.dirty = True
+        self._schedule(self.delay)
+
+    def _schedule(self, delay: float):
+        if self.task is None:
+            self.task = self.loop.create_task(self._save_later(delay))
+
+    async def _save_later(self, delay: float):
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self.task = None
+        await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            storage = self.config.storage
+            # after a failed write only a full snapshot is sure to contain everything
+            if self.failed:
+                self.config.load_all()
+            payload = storage.prepare_save(self.config.data, compact=self.failed)
+            try:
+                await self.loop.run_in_executor(None, storage.write, payload)
+                self.writes += 1
+                self.failed = False
+                self.retry_delay = self.delay
+            except Exception:
+                self.dirty = True
+                self.failed = True
+                logger.exception('saving config failed, retrying in %.0fs', self.retry_delay)
+                self._schedule(self.retry_delay)
+                self.retry_delay = min(2 * self.retry_delay, self.max_retry_delay)
+
+    def flush_now(self, compact: bool = False):
+        """Save pending changes synchronously, for use when event loop may not run anymore"""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.dirty or compact:
+            self.dirty = False
+            storage = self.config.storage
+            if compact or self.failed:
+                # full snapshot replaces everything stored, so it must not miss data of a lazy storage
+                self.config.load_all()
+            storage.write(storage.prepare_save(self.config.data, compact=compact or self.failed))
+            self.failed = False
+            self.writes += 1
 
 
 class ChannelHandler(logging.Handler):
-    def __init__(self, bot: discord.Client, cog, cog_name: str, channel: discord.Channel, *args, **kwargs):
+    """Sends log records to a discord channel in batches
+
+    Formatted records are buffered, at most `max_records` of them, when the buffer is full the oldest record is
+    dropped. Buffer is flushed once it holds enough text to fill a message or its oldest record is `max_age` seconds
+    old, records are packed into as few code block messages as possible.
+    """
+
+    def __init__(self, bot: discord.Client, cog, cog_name: str, channel: discord.Channel, *args,
+                 max_records: int = 1000, max_age: float = 2, **kwargs):
         self.cog = cog
         self.cog_name = cog_name
-        self.queue = Queue()
+        self.records = deque()  # type: deque
+        self.max_records = max_records
+        self.max_age = max_age
+        self.buffered_size = 0
+        self.dropped = 0
+        self.dropped_since_flush = 0
+        self.messages_sent = 0
         self.channel = channel
         self.bot = bot
         super(ChannelHandler, self).__init__(*args, **kwargs)
 
     def emit(self, record):
-        if self.channel:
-            self.queue.put_nowait(record)
+        # called with handler's lock held, possibly from another thread
+        if not self.channel:
+            return
+        try:
+            text = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        if len(self.records) >= self.max_records:
+            self.buffered_size -= len(self.records.popleft()[1])
+            self.dropped += 1
+            self.dropped_since_flush += 1
+        self.records.append((time.monotonic(), text))
+        self.buffered_size += len(text)
+
+    def should_flush(self) -> bool:
+        if not self.records:
+            return False
+        return (self.buffered_size >= discord_message_size
+                or time.monotonic() - self.records[0][0] >= self.max_age)
+
+    def take_records(self) -> List[str]:
+        self.acquire()
+        try:
+            texts = [text for created, text in self.records]
+            if self.dropped_since_flush:
+                texts.insert(0, '{0} log records were dropped'.format(self.dropped_since_flush))
+            self.records.clear()
+            self.buffered_size = 0
+            self.dropped_since_flush = 0
+        finally:
+            self.release()
+        return texts
+
+    async def flush_records(self):
+        for message in paginate(self.take_records()):
+            try:
+                await self.bot.send_message(content=message, destination=self.channel)
+                self.messages_sent += 1
+            except discord.HTTPException:
+                # logging it would only add more records to send
+                pass
 
     async def update_task(self):
         while self.cog == self.bot.get_cog(self.cog_name):
-            if not self.channel:
-                await asyncio.sleep(1)
+            if self.channel and self.should_flush():
+                await self.flush_records()
             else:
-                record = await self.queue.get()
-                if self.cog != self.bot.get_cog(self.cog_name):
-                    return
-                msg = self.format(record)
-                await self.bot.send_message(content=msg, destination=self.channel)
-
-default_server_vars = {
-    'min_empty_channels': {
-        'type': int,
-        'value': 2,
-        'help': 'Minimum amount of channels that should be present in the group, '
-                'if there are more/less channels will be created/remove'
-    },
-    'channel_timeout': {
-        'type': int,
-        'value': 1,  # minutes
-        'help': 'Amount of time in minutes since last activity before channel may be deleted'
-    },
-    'user_limit': {
-        'type': int,
-        'value': 0,
-        'help': 'Default user_limit to set for new groups, currently does not work'
-    }
-}
+                await asyncio.sleep(min(self.max_age / 4, 0.5))
+
+
+class ReconcileScheduler:
+    """Coalesces bursts of reconcile requests into a single reconcile pass per server
+
+    Every request (re)starts a debounce timer for its server, the reconcile is executed once the server
+    was quiet for `debounce` seconds, but no later than `max_latency` seconds after the first request of the burst.
+    Reconciles of a single server never run concurrently, requests arriving while a reconcile
+    is in progress are merged into the next pass.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, reconcile: Callable[[discord.Server], Any],
+                 get_delays: Callable[[discord.Server], Tuple[float, float]]):
+        """
+        :param loop: event loop to schedule reconciles on
+        :param reconcile: coroutine function performing the reconcile of a server
+        :param get_delays: function returning (debounce, max_latency) in seconds for a server
+        """
+        self.loop = loop
+        self.reconcile_fun = reconcile
+        self.get_delays = get_delays
+        self.pending = {}  # type: Dict[str, asyncio.Task]
+        self.first_request = {}  # type: Dict[str, float]
+        self.last_request = {}  # type: Dict[str, float]
+        self.locks = defaultdict(asyncio.Lock)  # type: Dict[str, asyncio.Lock]
+        self.events_received = Counter()  # type: Dict[str, int]
+        self.reconciles_executed = Counter()  # type: Dict[str, int]
+
+    def request(self, server: discord.Server):
+        """Schedule a reconcile of the server, merging it with already pending one"""
+        now = self.loop.time()
+        self.events_received[server.id] += 1
+        self.last_request[server.id] = now
+        if server.id not in self.pending:
+            self.first_request[server.id] = now
+            self.pending[server.id] = self.loop.create_task(self._debounced_reconcile(server))
+
+    async def _debounced_reconcile(self, server: discord.Server):
+        try:
+            while True:
+                debounce, max_latency = self.get_delays(server)
+                deadline = min(self.last_request[server.id] + debounce,
+                               self.first_request[server.id] + max_latency)
+                delay = deadline - self.loop.time()
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+        finally:
+            # anything requested from now on has to be handled by a new pass
+            self.pending.pop(server.id, None)
+        try:
+            await self.reconcile(server)
+        except Exception:
+            logger.exception('reconcile of server %s failed', server.id, extra=log_fields(server))
+
+    async def reconcile(self, server: discord.Server, timeout: float = None):
+        """Reconcile the server immediately (after the one in progress, if any)
+
+        :param timeout: seconds to wait for the reconcile once it has started, waiting for the one in progress
+            doesn't count. A reconcile that takes longer isn't cancelled in the middle of its requests,
+            it finishes in the background and keeps the server locked until then.
+        :raise asyncio.TimeoutError: if the reconcile didn't finish in time
+        """
+        lock = self.locks[server.id]
+        await lock.acquire()
+        self.reconciles_executed[server.id] += 1
+        task = self.loop.create_task(self.reconcile_fun(server))
+        task.add_done_callback(lambda _: lock.release())
+        try:
+            await asyncio.wait_for(asyncio.shield(task), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            task.add_done_callback(functools.partial(self._log_abandoned, server))
+            raise
+
+    @staticmethod
+    def _log_abandoned(server: discord.Server, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('reconcile of server %s failed: %r', server.id, task.exception(), extra=log_fields(server))
+
+    def cancel(self):
+        for task in list(self.pending.values()):
+            task.cancel()
+        self.pending.clear()
+
+
+class ChannelNameMatcher:
+    """Classifies channel names into channel groups of a server with a single regex match"""
+
+    def __init__(self, group_names: Iterable[str]):
+        self.group_names = list(group_names)
+        if self.group_names:
+            # longer names first, so a group whose name is a prefix of another group's name is tried last
+            alternatives = '|'.join(re.escape(group_name)
+                                    for group_name in sorted(self.group_names, key=len, reverse=True))
+            self.pattern = re.compile(r'^(' + alternatives + r')\s+#(\d+)')
+        else:
+            self.pattern = None
+
+    def match(self, name: str):
+        """
+        :return: tuple (group_name, number) or None if channel name doesn't belong to any group
+        """
+        if self.pattern is None:
+            return None
+        match = self.pattern.match(name)
+        if match:
+            return match.group(1), int(match.group(2))
+
+
+class NumberAllocator:
+    """Keeps track of free channel numbers of a group
+
+    Free numbers below the highest number ever used are kept as a heap of [start, end) ranges,
+    every number from `limit` upwards is free.
+    Numbers given out by allocate() stay used until they're released.
+    """
+
+    def __init__(self, numbers: Iterable[int] = ()):
+        self.used = set()  # type: Set[int]
+        self.free = []  # type: List[Tuple[int, int]]
+        self.limit = 1
+        for num in numbers:
+            self.claim(num)
+
+    def claim(self, num: int):
+        """Mark number as used"""
+        self.used.add(num)
+        if num >= self.limit:
+            if num > self.limit:
+                heapq.heappush(self.free, (self.limit, num))
+            self.limit = num + 1
+        # if the number is in one of the free ranges it's skipped when that range is reached
+
+    def release(self, num: int):
+        """Mark number as free"""
+        if num in self.used:
+            self.used.remove(num)
+            heapq.heappush(self.free, (num, num + 1))
+
+    def allocate(self, n: int) -> List[int]:
+        """Give out the lowest `n` free numbers, they are marked as used"""
+        numbers = []
+        while len(numbers) < n and self.free:
+            start, end = heapq.heappop(self.free)
+            while start < end and start in self.used:
+                start += 1
+            if start < end:
+                numbers.append(start)
+                self.used.add(start)
+                if start + 1 < end:
+                    heapq.heappush(self.free, (start + 1, end))
+        while len(numbers) < n:
+            numbers.append(self.limit)
+            self.used.add(self.limit)
+            self.limit += 1
+        return numbers
+
+
+class ChannelIndex:
+    """In-memory index of managed voice channels: server id -> group name -> {channel number: channel}
+
+    Index is kept up to date from channel create/update/delete events, so reconciles don't have to scan all channels
+    of a server, rebuild() is meant only as a periodic consistency check.
+    If several channels in a group have the same number only the first one is indexed.
+    """
+
+    def __init__(self):
+        self.groups = {}  # type: Dict[str, Dict[str, Dict[int, Channel]]]
+        self.matchers = {}  # type: Dict[str, ChannelNameMatcher]
+        self.allocators = {}  # type: Dict[str, Dict[str, NumberAllocator]]
+        self.channel_keys = {}  # type: Dict[str, Tuple[str, int]]
+
+    def is_indexed(self, server: discord.Server) -> bool:
+        return server.id in self.groups
+
+    def rebuild(self, server: discord.Server, group_names: Iterable[str]) -> bool:
+        """Index server from scratch
+
+        :return: True if the index differed from the rebuilt one
+        """
+        previous = self.snapshot(server)
+        self.drop_server(server)
+        self.groups[server.id] = {group_name: {} for group_name in group_names}
+        self.allocators[server.id] = {group_name: NumberAllocator() for group_name in self.groups[server.id]}
+        self.matchers[server.id] = ChannelNameMatcher(self.groups[server.id])
+        for channel in server.channels:
+            self.add_channel(channel)
+        return previous is not None and previous != self.snapshot(server)
+
+    def snapshot(self, server: discord.Server):
+        if server.id not in self.groups:
+            return None
+        return {group_name: {num: channel.id for num, channel in group.items()}
+                for group_name, group in self.groups[server.id].items()}
+
+    def drop_server(self, server: discord.Server):
+        self.matchers.pop(server.id, None)
+        self.allocators.pop(server.id, None)
+        for group in self.groups.pop(server.id, {}).values():
+            for channel in group.values():
+                self.channel_keys.pop(channel.id, None)
+
+    def add_group(self, server: discord.Server, group_name: str):
+        if server.id not in self.groups or group_name in self.groups[server.id]:
+            return
+        self.groups[server.id][group_name] = {}
+        self.allocators[server.id][group_name] = NumberAllocator()
+        self.matchers[server.id] = ChannelNameMatcher(self.groups[server.id])
+        for channel in server.channels:
+            if channel.id not in self.channel_keys:
+                self.add_channel(channel)
+
+    def remove_group(self, server: discord.Server, group_name: str):
+        if server.id not in self.groups or group_name not in self.groups[server.id]:
+            return
+        for channel in self.groups[server.id].pop(group_name).values():
+            self.channel_keys.pop(channel.id, None)
+        del self.allocators[server.id][group_name]
+        self.matchers[server.id] = ChannelNameMatcher(self.groups[server.id])
+
+    def classify(self, server: discord.Server, name: str):
+        """Find group and number of a channel with given name
+
+        :return: tuple (group_name, number) or None if channel doesn't belong to any group
+        """
+        matcher = self.matchers.get(server.id)
+        if matcher is not None:
+            return matcher.match(name)
+
+    def add_channel(self, channel: Channel):
+        if channel.is_private or channel.type != ChannelType.voice or channel.server.id not in self.groups:
+            return
+        key = self.classify(channel.server, channel.name)
+        if key is None:
+            return
+        group_name, num = key
+        group = self.groups[channel.server.id][group_name]
+        if num in group:
+            # an entry with the same id is kept, it may be the live channel that voice state updates are applied to
+            if group[num].id != channel.id:
+                logger.debug('channel %r has the same number as %r, not indexing it', channel.name, group[num].name,
+                             extra=log_fields(channel.server))
+            return
+        group[num] = channel
+        self.allocators[channel.server.id][group_name].claim(num)
+        self.channel_keys[channel.id] = key
+
+    def remove_channel(self, channel: Channel):
+        key = self.channel_keys.pop(channel.id, None)
+        if key is None:
+            return
+        group_name, num = key
+        group = self.groups[channel.server.id][group_name]
+        if num in group and group[num].id == channel.id:
+            del group[num]
+            self.allocators[channel.server.id][group_name].release(num)
+
+    def update_channel(self, channel: Channel):
+        # name of the channel might have changed, so it may belong to different group or have different number now
+        self.remove_channel(channel)
+        self.add_channel(channel)
+
+    def get_group(self, server: discord.Server, group_name: str) -> Dict[int, Channel]:
+        return self.groups[server.id].get(group_name, {})
+
+    def get_allocator(self, server: discord.Server, group_name: str) -> NumberAllocator:
+        return self.allocators[server.id][group_name]
+
+    def lookup(self, channel: Channel):
+        """
+        :return: tuple (group_name, number) of indexed channel, None if channel isn't indexed
+        """
+        return self.channel_keys.get(channel.id)
+
+
+class ActivityTracker:
+    """Time of the last voice activity in channels, keyed by channel id
+
+    Times are monotonic and entries are kept in order of activity, entries older than `max_age` seconds
+    (the longest channel timeout in use) are evicted from the oldest end, entries of deleted channels are forgotten.
+    """
+
+    def __init__(self, max_age: float, clock: Callable[[], float] = time.monotonic):
+        self.max_age = max_age
+        self.clock = clock
+        self.last_activity = OrderedDict()  # type: Dict[str, float]
+
+    def __len__(self):
+        return len(self.last_activity)
+
+    def touch(self, channel_id: str):
+        now = self.clock()
+        self.last_activity[channel_id] = now
+        self.last_activity.move_to_end(channel_id)
+        self.evict(now)
+
+    def forget(self, channel_id: str):
+        self.last_activity.pop(channel_id, None)
+
+    def evict(self, now: float = None):
+        deadline = (now if now is not None else self.clock()) - self.max_age
+        while self.last_activity and next(iter(self.last_activity.values())) < deadline:
+            self.last_activity.popitem(last=False)
+
+    def is_active(self, channel_id: str, timeout: float) -> bool:
+        last_activity = self.last_activity.get(channel_id)
+        return last_activity is not None and self.clock() - last_activity <= timeout
+
+    def active_channel_ids(self, timeout: float) -> Set[str]:
+        """Ids of all channels active in last `timeout` seconds, every other channel is idle"""
+        deadline = self.clock() - timeout
+        active = set()
+        for channel_id in reversed(self.last_activity):
+            if self.last_activity[channel_id] < deadline:
+                break
+            active.add(channel_id)
+        return active
+
+
+class RestOperation:
+    def __init__(self, route: Route, payload: Any, supersede_key: Any, future: asyncio.Future):
+        self.route = route
+        self.payload = payload
+        self.supersede_key = supersede_key
+        self.future = future
 
 
-def get_vars_list_for_help():
-    var_lines = ['{0:20s} - {help}'.format(var_name, **var) for var_name, var in default_server_vars.items()]
-    return 'Variables:\n' + ('\n'.join(var_lines))
+class RestBucket:
+    """Queued requests and rate limit state of a rate limit bucket"""
+
+    def __init__(self):
+        self.queue = deque()  # type: deque
+        self.workers = set()  # type: Set[asyncio.Task]
+        self.in_flight = set()  # type: Set[Any]
+        self.blocked_until = 0.0
+        self.backoff = 0.0
+
+    def next_operation(self) -> RestOperation:
+        """Remove and return the first queued request not waiting for one with the same supersede key in flight"""
+        for operation in self.queue:
+            if operation.supersede_key is None or operation.supersede_key not in self.in_flight:
+                self.queue.remove(operation)
+                return operation
+        return None
+
+
+class RestExecutor:
+    """Sends channel REST requests through per-bucket queues
+
+    Requests are grouped by the rate limit bucket of their route (Route.bucket). Requests of a bucket are started
+    in the order they were queued, at most `max_in_flight` of them at the same time, so independent requests like
+    channel creates don't wait for each other. Requests with the same supersede key are never in flight together.
+    A queued request is dropped when a newer one with the same supersede key is queued, callers of the dropped
+    request get the result of the newer one.
+
+    Rate limits are left to discord.py's HTTPClient.request, it waits out 429 responses and retries them itself.
+    A 429 that reaches the executor means the client gave up, so it fails the request like any other error and
+    pauses the bucket, for a backoff doubling with every 429 in a row, before the rest of its queue is sent.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, http, max_in_flight: int = 5, max_backoff: float = 60):
+        """
+        :param http: backend with a coroutine method request(route, json=None), normally discord's HTTPClient
+        :param max_in_flight: maximum amount of requests of a bucket sent at the same time
+        :param max_backoff: longest pause of a bucket after 429 responses, in seconds
+        """
+        self.loop = loop
+        self.http = http
+        self.max_in_flight = max_in_flight
+        self.max_backoff = max_backoff
+        self.buckets = {}  # type: Dict[str, RestBucket]
+        self.stats = Counter()  # type: Dict[str, int]
+
+    @staticmethod
+    def get_bucket(route: Route) -> str:
+        return route.bucket
+
+    def request(self, route: Route, payload: Any = None, supersede_key: Any = None) -> asyncio.Future:
+        """Queue a request
+
+        :return: future with the response data
+        """
+        key = self.get_bucket(route)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = RestBucket()
+        operation = RestOperation(route, payload, supersede_key, self.loop.create_future())
+        if supersede_key is not None:
+            for queued in [queued for queued in bucket.queue if queued.supersede_key == supersede_key]:
+                bucket.queue.remove(queued)
+                operation.future.add_done_callback(functools.partial(copy_future_result, target=queued.future))
+                self.stats['superseded'] += 1
+        bucket.queue.append(operation)
+        if len(bucket.workers) < self.max_in_flight:
+            worker = self.loop.create_task(self._process(key, bucket))
+            bucket.workers.add(worker)
+            worker.add_done_callback(functools.partial(self._worker_done, key, bucket))
+        return operation.future
+
+    def _worker_done(self, key: str, bucket: RestBucket, worker: asyncio.Task):
+        bucket.workers.discard(worker)
+        if not bucket.workers and not bucket.queue and self.buckets.get(key) is bucket:
+            del self.buckets[key]
+
+    async def _process(self, key: str, bucket: RestBucket):
+        while True:
+            delay = bucket.blocked_until - self.loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            # a request waiting for one in flight is picked up by the worker sending that one
+            operation = bucket.next_operation()
+            if operation is None:
+                return
+            bucket.in_flight.add(operation.supersede_key)
+            try:
+                await self._send(key, bucket, operation)
+            finally:
+                bucket.in_flight.discard(operation.supersede_key)
+
+    async def _send(self, key: str, bucket: RestBucket, operation: RestOperation):
+        self.stats['sent'] += 1
+        try:
+            result = await self.http.request(operation.route, json=operation.payload)
+        except asyncio.CancelledError:
+            operation.future.cancel()
+            raise
+        except Exception as e:
+            self.stats['failed'] += 1
+            if getattr(getattr(e, 'response', None), 'status', None) == 429:
+                self.stats['rate_limited'] += 1
+                bucket.backoff = min(max(2 * bucket.backoff, 1.0), self.max_backoff)
+                bucket.blocked_until = self.loop.time() + bucket.backoff
+                logger.warning('rate limited on %s, giving up and pausing the bucket for %.0fs', key, bucket.backoff,
+                               extra=log_fields(bucket=key))
+            if not operation.future.done():
+                operation.future.set_exception(e)
+        else:
+            bucket.backoff = 0.0
+            if not operation.future.done():
+                operation.future.set_result(result)
+
+    def create_channel(self, server: discord.Server, name: str, type: ChannelType = ChannelType.voice,
+                       user_limit: int = None) -> asyncio.Future:
+        payload = {'name': name, 'type': type.value}
+        if user_limit:
+            payload['user_limit'] = user_limit
+        return self.request(Route('POST', '/guilds/{guild_id}/channels', guild_id=server.id), payload)
+
+    def delete_channel(self, channel: Channel) -> asyncio.Future:
+        return self.request(Route('DELETE', '/channels/{channel_id}', channel_id=channel.id),
+                            supersede_key=('delete', channel.id))
+
+    def edit_user_limit(self, channel: Channel, user_limit: int) -> asyncio.Future:
+        return self.request(Route('PATCH', '/channels/{channel_id}', channel_id=channel.id),
+                            {'user_limit': user_limit}, supersede_key=('user_limit', channel.id))
+
+    def move_channels(self, server: discord.Server, positions: List[Dict[str, Any]]) -> asyncio.Future:
+        # only the latest channel order matters, so it supersedes the queued ones
+        return self.request(Route('PATCH', '/guilds/{guild_id}/channels', guild_id=server.id), positions,
+                            supersede_key=('positions', server.id))
+
+    def cancel(self):
+        """Stop sending, requests that are queued or in flight are cancelled"""
+        for bucket in self.buckets.values():
+            for worker in bucket.workers:
+                worker.cancel()
+            for operation in bucket.queue:
+                operation.future.cancel()
+        self.buckets.clear()
+
+
+PlannedChannel = namedtuple('PlannedChannel', 'group_name number name user_limit')
+
+
+class ReconcilePlan:
+    """Changes needed to bring managed channels of a server to the desired state
+
+    Channels that are to be created are represented by PlannedChannel tuples, also in `order`.
+    """
+
+    def __init__(self):
+        self.creates = []  # type: List[PlannedChannel]
+        self.deletes = []  # type: List[Channel]
+        self.user_limit_edits = []  # type: List[Tuple[Channel, int]]
+        self.order = []  # type: List[Union[Channel, PlannedChannel]]
+        self.order_changed = False
+
+    def is_empty(self):
+        return not (self.creates or self.deletes or self.user_limit_edits or self.order_changed)
+
+    def __str__(self):
+        return 'creates: {0}, deletes: {1}, user_limit edits: {2}, order changed: {3}'.format(
+            [planned.name for planned in self.creates], [channel.name for channel in self.deletes],
+            [(channel.name, user_limit) for channel, user_limit in self.user_limit_edits], self.order_changed)
+
+
+config_variables = VariableRegistry([
+    Variable('min_empty_channels', int, 2,
+             'Minimum amount of channels that should be present in the group, '
+             'if there are more/less channels will be created/remove',
+             validator=lambda value: value >= 0),
+    Variable('channel_timeout', int, 1,  # minutes
+             'Amount of time in minutes since last activity before channel may be deleted',
+             validator=lambda value: value >= 0),
+    Variable('user_limit', int, 0,
+             'Default user_limit to set for new groups, currently does not work',
+             validator=lambda value: 0 <= value <= 99),
+    Variable('reconcile_debounce', float, 1.0,  # seconds
+             'Time in seconds without voice activity before channels are updated',
+             validator=lambda value: value >= 0),
+    Variable('reconcile_max_latency', float, 5.0,  # seconds
+             'Maximum time in seconds channel updates may be delayed during constant voice activity',
+             validator=lambda value: value >= 0),
+    Variable('max_concurrent_servers', int, 10,
+             'Maximum amount of servers updated at the same time',
+             levels=('global',), validator=lambda value: value >= 1),
+    Variable('server_update_timeout', float, 30,  # seconds
+             'Time in seconds after which update of a server is abandoned until the next tick',
+             levels=('global',), validator=lambda value: value > 0)
+])
 
 
 class ChannelManager:
@@ -164,39 +1028,61 @@ class ChannelManager:
         self.config = None  # type: Config
         self.baseDataPath = "data/channel_manager"
         self.dataFilePath = os.path.join(self.baseDataPath, "config.json")
+        self.settingsFilePath = os.path.join(self.baseDataPath, "settings.json")
+
+        self.channel_activity = ActivityTracker(max_age=60 * config_variables['channel_timeout'].default)
+
+        self.channel_index = ChannelIndex()
+        self.index_check_period = 300  # seconds
 
-        self.channel_activity = {}  # type: Dict[Channel, datetime]
+        self.last_tick_duration = None  # type: float
+        self.server_latencies = {}  # type: Dict[str, float]
+        self.server_timeouts = Counter()  # type: Dict[str, int]
 
-        defaults = {
-            'min_empty_channels': default_server_vars['min_empty_channels']['value'],
-            'channel_timeout': default_server_vars['channel_timeout']['value']
-        }
+        self.log_filter = ServerDebugFilter(logger)
+        logger.addFilter(self.log_filter)
 
-        logger.debug("attempting to load settings from {0}".format(self.dataFilePath))
+        defaults = dict(config_variables.defaults)
+
+        logger.debug("attempting to load settings from %s", self.dataFilePath)
         if not os.path.exists(self.baseDataPath):
-            logger.debug("settings directory at path {0} doesn't exist, creating it")
+            logger.debug("settings directory at path %s doesn't exist, creating it", self.baseDataPath)
             os.mkdir(self.baseDataPath)
-        if not os.path.isfile(self.dataFilePath):
+        self.settings = {'config_storage': 'json'}
+        if os.path.isfile(self.settingsFilePath):
+            self.settings.update(dataIO.load_json(self.settingsFilePath))
+        storage = self.create_storage(self.settings['config_storage'])
+        data = storage.load_root()
+        # a database without any rows may have been created before the json config was migrated into it
+        if not data and not isinstance(storage, JsonStorage):
+            # json snapshot is readable by journal storage, which also applies a journal left behind
+            data = migrate_config(JournalStorage(self.dataFilePath), storage)
+            if data is not None:
+                logger.info('migrated config from %s to %r storage', self.dataFilePath, self.settings['config_storage'])
+                data = storage.load_root()
+        if data is None:
             logger.debug("settings file doesn't exits, creating new file with default settings")
-            self.config = Config(defaults=defaults)
-            self.save_config()
+            self.config = Config(defaults=defaults, storage=storage)
+            storage.write(storage.prepare_save(self.config.data, compact=True))
         else:
-            try:
-                data = dataIO.load_json(self.dataFilePath)
-            except json.JSONDecodeError:
-                data = {}
-            self.config = Config(data=data, defaults=defaults)
+            self.config = Config(data=data, defaults=defaults, storage=storage)
+        self.variables = config_variables.bind(self.config)
+        self.saver = ConfigSaver(self.bot.loop, self.config)
+        self.update_activity_max_age()
+        # cogs aren't unloaded when the bot shuts down
+        atexit.register(self.saver.flush_now)
 
         log_level = self.config.get_var('log_level')
         if log_level is not None:
-            logger.setLevel(logging.getLevelName(log_level).upper())
-        logger.debug("loaded settings file with data: {0}".format(self.config))
+            self.log_filter.set_level(log_level if isinstance(log_level, int)
+                                      else logging.getLevelName(log_level.upper()))
+        logger.debug("loaded settings file with data: %s", self.config)
 
         log_channel_id = self.config.get_var('log_channel_id')
         log_channel = self.bot.get_channel(log_channel_id)
-        logger.info("log channel is: {}".format(log_channel))
+        logger.info("log channel is: %s", log_channel)
         self.channel_handler = ChannelHandler(self.bot, self, 'ChannelManager', log_channel)
-        red_format = logging.Formatter(
+        red_format = StructuredFormatter(
             '%(asctime)s %(levelname)s %(module)s %(funcName)s %(lineno)d: '
             '%(message)s',
             datefmt="[%d/%m/%Y %H:%M]")
@@ -207,10 +1093,24 @@ class ChannelManager:
         logger.addHandler(self.channel_handler)
         self.bot.loop.create_task(self.channel_handler.update_task())
 
+        self.reconciler = ReconcileScheduler(self.bot.loop, self.update_groups, self.get_reconcile_delays)
+        self.rest = RestExecutor(self.bot.loop, self.bot.http)
 
+    def __unload(self):
+        logger.removeHandler(self.channel_handler)
+        logger.removeFilter(self.log_filter)
+        self.log_filter.server_ids.clear()
+        self.log_filter.apply()
+        self.reconciler.cancel()
+        self.rest.cancel()
+        atexit.unregister(self.saver.flush_now)
+        self.saver.flush_now()
 
     def save_config(self):
-        self.config.save(self.dataFilePath)
+        self.saver.mark_dirty()
+
+    def create_storage(self, storage_name: str) -> ConfigStorage:
+        return config_storages[storage_name](self.dataFilePath)
 
     def get_server_var(self, server: discord.Server, key: str) -> Union[str, int, float]:
         return self.config.get_var(key, [server.id])
@@ -226,6 +1126,16 @@ class ChannelManager:
         self.config.set_var(name, value, [server.id, group_name])
         self.save_config()
 
+    def update_activity_max_age(self):
+        """Keep channel activity as long as the longest channel_timeout of managed servers"""
+        server_ids = self.config.get_var('server_ids', frozen=True) or ()
+        timeouts = self.config.resolve_many([()] + [[server_id] for server_id in server_ids], 'channel_timeout')
+        self.channel_activity.max_age = 60 * max(timeouts.values())  # minutes
+
+    def get_reconcile_delays(self, server: discord.Server) -> Tuple[float, float]:
+        server_vars = self.config.resolve_all([server.id], ('reconcile_debounce', 'reconcile_max_latency'))
+        return server_vars['reconcile_debounce'], server_vars['reconcile_max_latency']
+
     async def send_cmd_help(self, ctx):
         if ctx.invoked_subcommand:
             pages = self.bot.formatter.format_help_for(ctx, ctx.invoked_subcommand)
@@ -277,7 +1187,7 @@ class ChannelManager:
         """
         level = ChannelManager.parse_log_level(level_name)
         if level:
-            logger.setLevel(level)
+            self.log_filter.set_level(level)
             self.config.set_var('log_level',level)
             self.save_config()
             await self.bot.say('setting log level to: {0}'.format(logging.getLevelName(level)))
@@ -299,16 +1209,71 @@ class ChannelManager:
         else:
             await self.send_cmd_help(ctx)
 
+    @debug.command(name='trace', pass_context=True, no_pm=True)
+    @checks.is_owner()
+    async def set_server_debug(self, ctx, state: str):
+        """Switches debug logging of this server 'on' or 'off', regardless of log level
+
+        Records are still filtered by the log channel level.
+        """
+        if state not in ('on', 'off'):
+            await self.send_cmd_help(ctx)
+            return
+        server = ctx.message.server
+        self.log_filter.set_server_debug(server.id, state == 'on')
+        await self.bot.say('debug logging of this server is {0}'.format(state))
+
     @debug.command(pass_context=True)
     @checks.is_owner()
     async def set_log_channel(self, ctx, channel: discord.Channel):
         """Sets channel to send log messages to specified channel"""
-        logger.debug('setting debug channel to: {0}'.format(channel, type(channel)))
+        logger.debug('setting debug channel to: %s', channel)
         self.channel_handler.channel = channel
         self.config.set_var('log_channel_id', channel.id)
         self.save_config()
         await self.bot.say('setting debug channel to: {0}'.format(channel.name))
 
+    @debug.command(name='storage', pass_context=True)
+    @checks.is_owner()
+    async def set_storage(self, ctx, storage_name: str):
+        """Sets how configuration is stored, storage can be:
+        'json' - whole configuration is rewritten on every save
+        'journal' - changes are appended to a journal, which is compacted when it grows too big
+        'sqlite' - variables are stored in a sqlite database, changes are written in a single transaction
+        """
+        if storage_name not in config_storages:
+            await self.send_cmd_help(ctx)
+            return
+        # wait for write in progress, then store everything using the new storage
+        await self.saver.flush()
+        self.config.load_all()
+        self.config.storage = self.create_storage(storage_name)
+        self.saver.flush_now(compact=True)
+        self.settings['config_storage'] = storage_name
+        dataIO.save_json(self.settingsFilePath, self.settings)
+        await self.bot.say('configuration is now stored using {0!r} storage'.format(storage_name))
+
+    @debug.command(name='migrate', pass_context=True)
+    @checks.is_owner()
+    async def migrate_storage(self, ctx, source_name: str):
+        """Replaces configuration with the one kept by another storage: 'json', 'journal' or 'sqlite'
+
+        The configuration is copied into the storage currently in use, e.g. 'migrate journal' copies config.json and
+        its journal into the sqlite database.
+        """
+        if source_name not in config_storages or source_name == self.settings['config_storage']:
+            await self.send_cmd_help(ctx)
+            return
+        await self.saver.flush()
+        data = migrate_config(self.create_storage(source_name), self.config.storage)
+        if data is None:
+            await self.bot.say('there is no configuration stored in {0!r} storage'.format(source_name))
+            return
+        self.config.reset(data)
+        self.channel_index = ChannelIndex()
+        self.update_activity_max_age()
+        await self.bot.say('configuration was migrated from {0!r} storage'.format(source_name))
+
     @debug.command(pass_context=True)
     @checks.mod_or_permissions()
     async def echo(self, ctx, level_str, text):
@@ -322,7 +1287,7 @@ class ChannelManager:
         await self.bot.say(self.config)
 
     @debug.command(pass_context=True, no_pm=True)
-    async def addchan(self, ctx, new_name: str, user_limit):
+    async def addchan(self, ctx, new_name: str, user_limit: int):
         server = ctx.message.server
         msg = "trying to create channel with name {new_name}, on server {server}".format(new_name=new_name,
                                                                                          server=server)
@@ -335,9 +1300,8 @@ class ChannelManager:
         all_chans = ctx.message.server.channels
         voice_chans = [channel for channel in all_chans if channel.type == ChannelType.voice]
         voice_chans.sort(key=lambda channel: channel.position)
-        message = create_message_from_list('Channels: \n',
-                                           '{0.position:3d} - {0.name}', voice_chans)
-        await self.bot.say(message)
+        for page in create_messages_from_list('Channels: \n', '{0.position:3d} - {0.name}', voice_chans):
+            await self.bot.say(page)
 
     @debug.command(pass_context=True)
     async def move(self, ctx, name, position):
@@ -354,7 +1318,17 @@ class ChannelManager:
 
     @debug.command(name='upd', pass_context=True)
     async def upd(self, ctx):
-        await self.update_groups(ctx.message.server)
+        await self.reconciler.reconcile(ctx.message.server)
+
+    @debug.command(name='reconcilestats', pass_context=True, no_pm=True)
+    async def reconcile_stats(self, ctx):
+        """Shows how many voice events were merged into how many channel updates"""
+        server = ctx.message.server
+        reconciler = self.reconciler
+        await self.bot.say('this server: {0} events, {1} updates\nall servers: {2} events, {3} updates'
+                           .format(reconciler.events_received[server.id], reconciler.reconciles_executed[server.id],
+                                   sum(reconciler.events_received.values()),
+                                   sum(reconciler.reconciles_executed.values())))
 
     @debug.command(name='movechans', pass_context=True)
     async def shuffle(self, ctx, method='sort'):
@@ -366,7 +1340,7 @@ class ChannelManager:
             logger.debug('sorting voice channels')
             result = sorted(voice_channels, key=lambda chan: chan.name)
         elif method == 'random':
-            logger.debug('randomizing voice channels: {0!r}'.format(voice_channels))
+            logger.debug('randomizing voice channels: %r', voice_channels, extra=log_fields(server))
             result = list(voice_channels)
             random.shuffle(result)
         else:
@@ -375,33 +1349,64 @@ class ChannelManager:
         # await self.move_chans(voice_channels, result)
         await self.move_channels(server, channels=result)
 
+    @debug.command(name='reststats')
+    async def rest_stats(self):
+        """Shows counts of sent, rate limited, superseded and failed channel requests"""
+        stats = self.rest.stats
+        await self.bot.say('sent: {0}, rate limited: {1}, superseded: {2}, failed: {3}, queued: {4}'
+                           .format(stats['sent'], stats['rate_limited'], stats['superseded'], stats['failed'],
+                                   sum(len(bucket.queue) for bucket in self.rest.buckets.values())))
+
+    @debug.command(name='tickstats', pass_context=True)
+    async def tick_stats(self, ctx, n_servers: int = 10):
+        """Shows duration of the last update of all servers and the slowest servers"""
+        if self.last_tick_duration is None:
+            await self.bot.say('no update finished yet')
+            return
+        slowest = sorted(self.server_latencies.items(), key=itemgetter(1), reverse=True)[:n_servers]
+        lines = ((server_id, latency, self.server_timeouts[server_id]) for server_id, latency in slowest)
+        for page in create_messages_from_list('Last update took {0:.3f}s, slowest servers:\n'
+                                              .format(self.last_tick_duration),
+                                              '{0[0]:20s} {0[1]:8.3f}s timeouts: {0[2]}', lines):
+            await self.bot.say(page)
+
+    @debug.command(name='scheduler', pass_context=True)
+    @checks.is_owner()
+    async def set_scheduler(self, ctx, max_concurrent_servers: str, server_update_timeout: str):
+        """Sets how many servers are updated concurrently and how long a single server update may take"""
+        try:
+            max_concurrent_servers = self.variables['max_concurrent_servers'].parse(max_concurrent_servers)
+            server_update_timeout = self.variables['server_update_timeout'].parse(server_update_timeout)
+        except ValueError:
+            await self.send_cmd_help(ctx)
+            return
+        self.variables['max_concurrent_servers'].set_global(max_concurrent_servers)
+        self.variables['server_update_timeout'].set_global(server_update_timeout)
+        self.save_config()
+        await self.bot.say('updating at most {0} servers at a time, with timeout of {1}s'
+                           .format(max_concurrent_servers, server_update_timeout))
+
     @cm.command(name='addgroup', no_pm=True, pass_context=True, help='Add channel group to manage')
     async def _cm_add_group(self, ctx, *, group_name):
         await self.add_group(ctx.message.server, group_name)
 
     async def add_group(self, server: discord.Server, group_name: str):
-        server_ids = self.config.get_var('server_ids')  # type: List[int]
-        if not server_ids:
-            server_ids = []
-        if server.id not in server_ids:
-            server_ids.append(server.id)
+        if server.id not in (self.config.get_var('server_ids', frozen=True) or ()):
+            self.config.update_var('server_ids', lambda server_ids: (server_ids or []) + [server.id])
+            self.update_activity_max_age()
             self.config.set_var('server_name', server.name,[server.id])  # just for reference in config file
-        self.config.set_var('server_ids', server_ids)
 
-        channel_groups = self.config.get_var('channel_groups', [server.id])  # type: List[str]
-        if channel_groups is None:
-            channel_groups = []
-        if group_name not in channel_groups:
-            channel_groups.append(group_name)
-        else:
+        if group_name in (self.config.get_var('channel_groups', [server.id], frozen=True) or ()):
             await self.bot.say('group {0!r} already exists'.format(group_name))
             return
-        self.config.set_var('channel_groups', channel_groups, [server.id])
+        self.config.update_var('channel_groups', lambda channel_groups: (channel_groups or []) + [group_name],
+                               [server.id])
         self.save_config()
+        self.channel_index.add_group(server, group_name)
 
-        self.bot.loop.create_task(self.update_groups(server))
+        self.reconciler.request(server)
 
-        logger.debug('added channel group {0!r}'.format(group_name))
+        logger.debug('added channel group %r', group_name, extra=log_fields(server))
         await self.bot.say('added channel group {0!r}'.format(group_name))
 
     @cm.command(name='removegroup', pass_context=True, no_pm=True,
@@ -410,70 +1415,67 @@ class ChannelManager:
         await self.remove_group(ctx.message.server, group_name, delete = True)
 
     async def remove_group(self, server: discord.Server, group_name: str, delete = True):
-        channel_groups = self.config.get_var('channel_groups', [server.id])  # type: List[str]
-        if channel_groups is None:
-            channel_groups = []
-
-        if group_name not in channel_groups:
+        if group_name not in (self.config.get_var('channel_groups', [server.id], frozen=True) or ()):
             await self.bot.say('group {0!r} doesn\'t exist'.format(group_name))
         else:
-            channel_groups.remove(group_name)
-            self.config.set_var('channel_groups', channel_groups, [server.id])
+            # an index rebuilt after the group is removed from config wouldn't find its channels
+            group_channels = self.get_channels_for_group(server, group_name)
+            self.config.update_var('channel_groups', lambda channel_groups: [name for name in channel_groups
+                                                                             if name != group_name], [server.id])
             self.save_config()
+            self.channel_index.remove_group(server, group_name)
             await self.bot.say('removing group {0!r}'.format(group_name))
-            logger.debug('delete is: {0!r}'.format(delete))
+            logger.debug('delete is: %r', delete, extra=log_fields(server))
             if delete:
-                for channel in self.get_channels_for_group(server, group_name):
+                for channel in group_channels:
                     await self.delete_channel(server, channel)
 
     @cm.command(name='listgroups', pass_context=True, no_pm=True, help='Show currently managed channel groups')
     async def list_groups(self, ctx):
-        channel_groups = self.config.get_var('channel_groups', [ctx.message.server.id])
+        channel_groups = self.config.get_var('channel_groups', [ctx.message.server.id], frozen=True)
         if channel_groups:
-            message = create_message_from_list(prefix='Channel groups:\n', line_format='{0}',
-                                               message_list=sorted(channel_groups))
-            await self.bot.say(message)
+            for page in create_messages_from_list(prefix='Channel groups:\n', line_format='{0}',
+                                                  message_list=sorted(channel_groups)):
+                await self.bot.say(page)
         else:
             await self.bot.say('There are no channel groups.')
 
     @cm.command(name='get', pass_context=True, no_pm=True,
-                help='Get value of server variable\n' + get_vars_list_for_help())
-    async def _cm_get(self, ctx, var_name: str):
+                help='Get value of server variable\n' + config_variables.help)
+    async def _cm_get(self, ctx, var_name: str = None):
         if var_name is None:
-            await self.bot.say('available variables are: {0!r}'.format(default_server_vars.keys()))
+            await self.bot.say('available variables are: {0}'.format(', '.join(config_variables.server_names)))
         else:
             value = self.config.get_var(var_name, [ctx.message.server.id])
             await self.bot.say('{0} = {1!r}'.format(var_name, value))
 
     @cm.command(name='getall', pass_context=True)
     async def _cm_get_all(self, ctx):
-        list=((var_name, self.get_server_var(ctx.message.server,var_name)) for var_name in default_server_vars.keys())
-        logger.debug('list: {0}'.format(list))
-        message = create_message_from_list('Server variables:', '{0[0]:20s} = {0[1]!r}',list)
-        await self.bot.say(message)
+        server_vars = self.config.resolve_all([ctx.message.server.id], config_variables.server_names)
+        variables = ((var_name, server_vars[var_name]) for var_name in config_variables.server_names)
+        for page in create_messages_from_list('Server variables:', '{0[0]:20s} = {0[1]!r}', variables):
+            await self.bot.say(page)
 
     @cm.command(name='set', pass_context=True, no_pm=True,
-                help='Set value of server variable\n' + get_vars_list_for_help())
+                help='Set value of server variable\n' + config_variables.help)
     async def _cm_set(self, ctx, var_name: str, value: str):
         server = ctx.message.server
+        if var_name not in self.variables:
+            await self.bot.say('unknown variable {0!r}'.format(var_name))
+            return
+        variable = self.variables[var_name]
         try:
             if value == 'None':
+                variable.check_level('server')
                 self.config.delete_var([server.id], var_name)
             else:
-                type_fun = default_server_vars[var_name]['type']  # type: Callable[[Any], None]
-                parsed = type_fun(value)
-                self.config.set_var(var_name, parsed, [server.id])
+                variable.set_server(server, value)
+            if var_name == 'channel_timeout':
+                self.update_activity_max_age()
             await self.bot.say('setting {0} = {1}'.format(var_name, value))
             self.save_config()
-        except ValueError as e:
+        except (ValueError, VariableNotInLevel) as e:
             await self.bot.say(e)
-        except KeyError:
-            await self.bot.say('unknown variable {0!r}'.format(var_name))
-
-    @staticmethod
-    def get_channel_name_pattern(group_name):
-        channel_name_pattern = re.compile(r'^' + re.escape(group_name) + r'\s+#(\d+)')
-        return channel_name_pattern
 
     @staticmethod
     def create_channel_name(group_name, num):
@@ -483,217 +1485,232 @@ class ChannelManager:
     def get_voice_channels(server):
         return [channel for channel in server.channels if channel.type == ChannelType.voice]
 
-    def get_channel_number_in_group(self, group_name, channel):
-        pattern = self.get_channel_name_pattern(group_name)
-        match = pattern.match(channel.name)
-        if match:
-            try:
-                return int(match.group(1))
-            except ValueError:
-                return None
+    def rebuild_channel_index(self, server, channel_groups: Iterable[str] = None):
+        if channel_groups is None:
+            channel_groups = self.config.get_var('channel_groups', [server.id], (), frozen=True)
+        if self.channel_index.rebuild(server, channel_groups):
+            logger.warning('channel index of server %s was out of date', server.id, extra=log_fields(server))
+
+    def get_group_channels(self, server, group_name) -> Dict[int, Channel]:
+        if not self.channel_index.is_indexed(server):
+            self.rebuild_channel_index(server)
+        return self.channel_index.get_group(server, group_name)
 
     def get_channels_for_group(self, server, group_name):
-        pattern = self.get_channel_name_pattern(group_name)
-        group_chans = [channel for channel in server.channels
-                       if channel.type == ChannelType.voice
-                       and pattern.match(channel.name)
-                       ]
-        return group_chans
-
-    async def create_group_channel(self, server, group_name, num):
-        chan_name = self.create_channel_name(group_name, num)
-        logger.info('group {0!r} had no channels, creating new channel with name {1!r}'.format(group_name, chan_name))
-        #user_limit = self.get_server_var(server, 'user_limit')
-        # await self.create_channel(server=server, name=chan_name, type=ChannelType.voice, user_limit=user_limit)
-        await self.bot.create_channel(server=server, name=chan_name, type=ChannelType.voice)
+        return list(self.get_group_channels(server, group_name).values())
 
     async def update_scheduler(self):
+        last_index_check = self.bot.loop.time()
         while self == self.bot.get_cog('ChannelManager'):
             if self.enabled and not self.paused:
-                server_ids = self.config.get_var('server_ids')
-                logger.debug('got server_ids: {0!r}'.format(server_ids))
+                check_index = self.bot.loop.time() - last_index_check > self.index_check_period
+                if check_index:
+                    last_index_check = self.bot.loop.time()
+                server_ids = self.config.get_var('server_ids', frozen=True)
+                logger.debug('got server_ids: %r', server_ids)
                 if server_ids is not None:
+                    servers = []
+                    if check_index:
+                        channel_groups = self.config.resolve_many([[server_id] for server_id in server_ids],
+                                                                  'channel_groups', frozen=True)
                     for server_id in server_ids:
                         server = self.bot.get_server(server_id)
-                        logger.debug("attempting to get server with id {0}, result: {1}".format(server_id, server))
+                        logger.debug("attempting to get server with id %s, result: %s", server_id, server)
                         if server:
-                            await self.update_groups(server)
+                            if check_index:
+                                self.rebuild_channel_index(server, channel_groups[(server_id,)] or ())
+                            servers.append(server)
+                    await self.update_servers(servers)
             await asyncio.sleep(self.update_period)
 
+    async def update_servers(self, servers: List[discord.Server]):
+        """Reconcile servers concurrently, at most max_concurrent_servers at a time"""
+        semaphore = asyncio.Semaphore(self.variables['max_concurrent_servers'].get())
+        timeout = self.variables['server_update_timeout'].get()  # seconds
+        start = self.bot.loop.time()
+        await asyncio.gather(*[self.update_server(server, semaphore, timeout) for server in servers])
+        self.last_tick_duration = self.bot.loop.time() - start
+        managed_ids = {server.id for server in servers}
+        for stats in (self.server_latencies, self.server_timeouts):
+            for server_id in stats.keys() - managed_ids:
+                del stats[server_id]
+        logger.debug('updated %d servers in %.3fs', len(servers), self.last_tick_duration,
+                     extra=log_fields(servers=len(servers), duration=self.last_tick_duration))
+
+    async def update_server(self, server: discord.Server, semaphore: asyncio.Semaphore, timeout: float):
+        async with semaphore:
+            start = self.bot.loop.time()
+            try:
+                await self.reconciler.reconcile(server, timeout)
+            except asyncio.TimeoutError:
+                self.server_timeouts[server.id] += 1
+                logger.warning('updating server %s took longer than %ss, skipping it this time', server.id, timeout,
+                               extra=log_fields(server, timeout=timeout))
+            except Exception:
+                logger.exception('updating server %s failed', server.id, extra=log_fields(server))
+            self.server_latencies[server.id] = self.bot.loop.time() - start
+
     async def update_groups(self, server):
         if not self.enabled:
             return
-        channel_groups = self.config.get_var('channel_groups', [server.id], [])
-        for group_name in channel_groups:
-            await self.update_group(server, group_name)
-        await self.fix_channel_positions(server)
-
-    async def update_group(self, server, group_name):
-        pattern = self.get_channel_name_pattern(group_name)
-        min_empty_channels = self.get_server_var(server, 'min_empty_channels')
-        logger.debug('updating channel group {0!r}'.format(group_name))
-
-        group_channels = self.get_channels_for_group(server, group_name)
-
-        if not group_channels:
-            # if there are no channels for this group - create one and exit
-            await self.create_group_channel(server, group_name, 1)
+        plan = self.plan_server(server)
+        if plan.is_empty():
+            logger.debug('channels of server %s are up to date', server.id, extra=log_fields(server))
             return
-        # create channels if needed
-        chan_to_numbers = {}
-        chan_numbers = []
-        empty_chans = []
-        for channel in group_channels:
-            if not channel.voice_members:
-                empty_chans.append(channel)
-
-            match = pattern.match(channel.name)
-            if match:
-                num = int(match.group(1))
-                chan_to_numbers[channel] = num
-                chan_numbers.append(num)
-        n_channels_to_create = max(0, min_empty_channels - len(empty_chans))
-        if n_channels_to_create > 0:
-            logger.info('group {0!r} has {1!r} empty channels, min_empty is {min_empty}, '
-                        'will create {n_channels_to_create!r} channels'
-                        .format(group_name, len(empty_chans), min_empty=min_empty_channels,
-                                n_channels_to_create=n_channels_to_create))
-            free_nums = find_free_numbers(chan_numbers, n_channels_to_create)
-            for i in range(0, n_channels_to_create):
-                chan_name = self.create_channel_name(group_name, free_nums[i])
-                await self.bot.create_channel(server=server, name=chan_name, type=ChannelType.voice)
-
-        # check if we should and can remove some channels
-        n_to_remove = len(empty_chans) - min_empty_channels
-        if n_to_remove > 0:
-            logger.info('group {group_name!r} has {n_empty!r} empty channels, '
-                        'will attempt to remove {n_to_remove!r} channels'
-                        .format(group_name=group_name, n_empty=len(empty_chans), n_to_remove=n_to_remove))
-            # create a list of empty channels sorted by number, remove the highest numbered ones
-            empty_channels_with_number = [{'channel': channel, 'num': chan_to_numbers[channel]} for channel in
-                                          empty_chans]
-            empty_channels_with_number.sort(key=itemgetter('num'))
-            for idx, chan_dict in enumerate(empty_channels_with_number):
-                if idx >= min_empty_channels:
-                    channel = chan_dict['channel']
-                    await self.delete_channel(server, channel)
+        logger.info('updating channels of server %s: %s', server.id, plan,
+                    extra=log_fields(server, creates=len(plan.creates), deletes=len(plan.deletes),
+                                     user_limit_edits=len(plan.user_limit_edits), order_changed=plan.order_changed))
+        await self.execute_plan(server, plan)
+
+    def plan_server(self, server) -> ReconcilePlan:
+        server_vars = self.config.resolve_all([server.id], ('channel_groups', 'min_empty_channels', 'channel_timeout'),
+                                              frozen=True)
+        channel_groups = server_vars['channel_groups'] or ()
+        if not self.channel_index.is_indexed(server):
+            self.rebuild_channel_index(server, channel_groups)
+        groups = {group_name: self.channel_index.get_group(server, group_name) for group_name in channel_groups}
+        allocators = {group_name: self.channel_index.get_allocator(server, group_name) for group_name in groups}
+        voice_channels = self.get_voice_channels(server)
+        voice_channels.sort(key=lambda ch: ch.position)
+        active_ids = self.channel_activity.active_channel_ids(60 * server_vars['channel_timeout'])  # minutes
+        return plan_reconcile(voice_channels, groups, server_vars['min_empty_channels'],
+                              lambda channel: channel.id in active_ids, allocators)
+
+    async def execute_plan(self, server, plan: ReconcilePlan):
+        """Issue all creates, deletes and edits of the plan concurrently, then fix channel order with one request"""
+        created = {}  # type: Dict[PlannedChannel, Channel]
+
+        async def create(planned: PlannedChannel):
+            try:
+                channel = await self.create_channel(server, planned.name, ChannelType.voice, planned.user_limit)
+            except Exception:
+                self.channel_index.get_allocator(server, planned.group_name).release(planned.number)
+                raise
+            created[planned] = channel
+
+        operations = [create(planned) for planned in plan.creates]
+        operations.extend(self.delete_channel(server, channel, force=True) for channel in plan.deletes)
+        operations.extend(self.rest.edit_user_limit(channel, user_limit)
+                          for channel, user_limit in plan.user_limit_edits)
+        results = await asyncio.gather(*operations, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error('updating channels of server %s failed: %r', server.id, result, extra=log_fields(server))
+
+        if plan.order_changed:
+            channels = [created.get(channel, channel) for channel in plan.order
+                        if not isinstance(channel, PlannedChannel) or channel in created]
+            logger.debug('final channel positions: %s', LazyArg(lambda: [channel.name for channel in channels]),
+                         extra=log_fields(server))
+            await self.move_channels(server, channels)
 
     def channel_is_active(self, server, channel):
-        last_activity = None
-        if channel in self.channel_activity:
-            last_activity = self.channel_activity[channel]
-        timeout = timedelta(minutes=self.get_server_var(server, 'channel_timeout'))
-        if last_activity is None or ((datetime.now() - timeout) > last_activity):
-            return False
-        else:
-            return True
+        return self.channel_activity.is_active(channel.id, 60 * self.variables['channel_timeout'].get_server(server))
 
     async def delete_channel(self, server, channel, force=False):
-        if force:
-            await self.bot.delete_channel(channel=channel)
-
-        if not self.channel_is_active(server, channel):
-            logger.info("removing channel {0.name}".format(channel))
-            await self.bot.delete_channel(channel=channel)
-        else:
-            logger.info("not removing channel {0.name!r} due to recent activity"
-                         .format(channel))
-
-    async def fix_channel_positions(self, server):
-        if not self.enabled:
-            return
-        channel_groups = self.get_server_var(server, 'channel_groups')  # type: Set[str]
-        if not channel_groups:
-            logger.debug('channel_groups was empty or None: {0!r}'.format(channel_groups))
-            return
-        channels = self.get_voice_channels(server)  # type: List[discord.Channel]
-        channels.sort(key=lambda ch: ch.position)
-        channels_original = list(channels)
-        logger.debug("initial channel positions: {0}".format([ch.name for ch in channels]))
-        group_regexps = {group: self.get_channel_name_pattern(group) for group in channel_groups}
-        channels_by_group = {group: [] for group in channel_groups}
-        group_anchors = {}
-        for idx, channel in enumerate(list(channels)):
-            for group, regex in group_regexps.items():
-                chan_num = self.get_channel_number_in_group(group_name=group, channel=channel)
-                if chan_num is not None:
-                    if chan_num == 1:
-                        group_anchors[channel] = group
-                    elif chan_num != 1:
-                        channels.remove(channel)
-                        channels_by_group[group].append({'num': chan_num, 'channel': channel})
-        logger.debug('channels by group: {0!r}'.format(channels_by_group))
-        result_channels = []
-        for channel in channels:
-            if channel not in group_anchors:
-                # a channel that's not in any group (else it'd have been picked up in earlier processing)
-                # leave it where it is
-                result_channels.append(channel)
-            if channel in group_anchors:
-                result_channels.append(channel)
-                # first channel in a group, append it where it was
-                group = group_anchors[channel]
-                # get all channels in that group and add them in order
-                group_channels = channels_by_group[group]
-                group_channels.sort(key=itemgetter('num'))
-                user_limit = channel.user_limit
-                for grp_channel in group_channels:
-                    group_channel = grp_channel['channel']  # type: discord.Channel
-                    if group_channel.user_limit != user_limit:
-                        await self.bot.http.edit_channel(group_channel.id, user_limit=user_limit)
-                    result_channels.append(group_channel)
-        logger.debug('final channel positions: {0}'.format([channel.name for channel in result_channels]))
-        changes = False
-        for i, channel in enumerate(result_channels):
-            if channel != channels_original[i]:
-                changes = True
-                break
-        if changes:
-            logger.debug("moving channels")
-            await self.move_channels(server, result_channels)
+        if force or not self.channel_is_active(server, channel):
+            logger.info("removing channel %s", channel.name, extra=log_fields(server, channel=channel.id))
+            await self.rest.delete_channel(channel)
+            self.channel_index.remove_channel(channel)
         else:
-            logger.debug('no changes in channel order')
+            logger.info("not removing channel %r due to recent activity", channel.name,
+                        extra=log_fields(server, channel=channel.id))
 
     async def move_channels(self, server: discord.Server, channels: List[discord.Channel]):
-        payload = [{'id': c.id, 'position': index} for index, c in enumerate(channels)]
-        r = Route('PATCH', '/guilds/{guild_id}/channels', guild_id=server.id)
-        logger.debug('using payload: {0!r}'.format(payload))
-        await self.bot.http.request(r, json=payload)
-
-    async def create_channel(self, server: discord.Server, name: str, type: ChannelType, user_limit: int,
-                             permission_overwrites=None):
-        # doesn't work atm, reason unknown
-        url = HTTPClient.GUILDS + '/{0}/channels'.format(server.id)
-        payload = {
-            'name': name,
-            'type': str(type),
-            'permission_overwrites': []
-        }
-        # if user_limit is not None:
-        #    payload['user_limit'] = user_limit
-
-        if permission_overwrites is not None:
-            payload['permission_overwrites'] = permission_overwrites
-
-        logger.debug('url: {0}'.format(url))
-        logger.debug('payload: {0}'.format(payload))
-        return self.bot.http.post(url, json=payload, bucket="create_channel")
-
-
-def create_message_from_list(prefix: str, line_format: str, message_list: Iterable[Any]):
-    message_lines = ['```', prefix]
-    lines = [line_format.format(line_args) for line_args in message_list]
-    message_lines.extend(lines)
-    message_lines.append('```')
-    return "\n".join(message_lines)
+        payload = plan_channel_positions(channels)
+        logger.debug('using payload: %r', payload, extra=log_fields(server))
+        if payload:
+            await self.rest.move_channels(server, payload)
+
+    async def create_channel(self, server: discord.Server, name: str, type: ChannelType, user_limit: int = None):
+        data = await self.rest.create_channel(server, name, type, user_limit)
+        # the gateway may have delivered the channel already, its object is the one that tracks voice members
+        channel = server.get_channel(data['id'])
+        if channel is None:
+            # on_channel_create swaps in the live channel once it arrives
+            channel = Channel(server=server, **data)
+        self.channel_index.add_channel(channel)
+        return channel
+
+
+def plan_channel_positions(channels: List[Channel]) -> List[Dict[str, Any]]:
+    """Compute position changes that put channels in the given order, leaving as many channels in place as possible
+
+    A set of channels can keep their positions if there are enough free positions between each two of them
+    for the channels that are ordered between them, that is if `position - index` doesn't decrease along the order
+    (and isn't negative, positions start at 0). The longest such subsequence stays, every other channel gets
+    the next position after its predecessor.
+
+    :param channels: channels in desired order
+    :return: payload for the channel positions endpoint, empty if channels are already in order
+    """
+    keys = [channel.position - index for index, channel in enumerate(channels)]
+    kept = longest_non_decreasing_subsequence(keys, min_value=0)
+    payload = []
+    position = -1
+    for index, channel in enumerate(channels):
+        if index in kept:
+            position = channel.position
+        else:
+            position += 1
+            payload.append({'id': channel.id, 'position': position})
+    return payload
+
+
+def longest_non_decreasing_subsequence(values: List[int], min_value: int = None) -> Set[int]:
+    """
+    :param min_value: values lower than that are never part of the subsequence
+    :return: indices of elements of the subsequence
+    """
+    tail_values = []  # type: List[int]
+    tail_indices = []  # type: List[int]
+    predecessors = {}  # type: Dict[int, int]
+    for index, value in enumerate(values):
+        if min_value is not None and value < min_value:
+            continue
+        length = bisect.bisect_right(tail_values, value)
+        predecessors[index] = tail_indices[length - 1] if length > 0 else None
+        if length == len(tail_values):
+            tail_values.append(value)
+            tail_indices.append(index)
+        else:
+            tail_values[length] = value
+            tail_indices[length] = index
+    indices = set()
+    index = tail_indices[-1] if tail_indices else None
+    while index is not None:
+        indices.add(index)
+        index = predecessors[index]
+    return indices
+
+
+def copy_future_result(source: asyncio.Future, target: asyncio.Future):
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+def migrate_config(source: ConfigStorage, target: ConfigStorage) -> Dict[str, Dict[str, ValueType]]:
+    """Copy everything stored in source storage to target storage
+
+    :return: migrated data, None if nothing is stored in source storage
+    """
+    data = source.load()
+    if not data:
+        return None
+    target.write(target.prepare_save(data, compact=True))
+    return data
 
 
 def find_free_numbers(numbers: List[int], n_to_find: int):
-    free_numbers = []
-    max_num = max(numbers)
-    for i in range(1, max_num):
-        if i not in numbers:
-            free_numbers.append(i)
+    used_numbers = set(numbers)
+    max_num = max(used_numbers)
+    free_numbers = [i for i in range(1, max_num) if i not in used_numbers]
     n_found = len(free_numbers)
     for i in range(0, n_to_find - n_found):
         free_numbers.append(max_num + i + 1)
@@ -701,6 +1718,84 @@ def find_free_numbers(numbers: List[int], n_to_find: int):
     return free_numbers
 
 
+def plan_reconcile(voice_channels: List[Channel], groups: Dict[str, Dict[int, Channel]], min_empty_channels: int,
+                   is_active: Callable[[Channel], bool],
+                   allocators: Dict[str, NumberAllocator] = None) -> ReconcilePlan:
+    """Compute changes needed for channel groups of a server
+
+    Every group gets at least `min_empty_channels` empty channels, surplus empty channels with the highest numbers
+    are removed unless they were recently active. Channels of a group are placed in order of their numbers
+    at the position of the group's lowest numbered existing channel (the anchor) and get its user_limit.
+
+    :param voice_channels: all voice channels of the server, sorted by position
+    :param groups: channels of each group by their numbers
+    :param min_empty_channels: number of empty channels each group should have
+    :param is_active: tells if a channel had recent activity and shouldn't be removed
+    :param allocators: number allocators of the groups, numbers of planned channels are allocated from them,
+                       if not given numbers are computed from the group's channels
+    """
+    plan = ReconcilePlan()
+    group_members = {}  # type: Dict[str, Dict[int, Union[Channel, PlannedChannel]]]
+    anchors = {}  # type: Dict[str, str]
+    for group_name, group_channels in groups.items():
+        members = dict(group_channels)
+        allocator = allocators[group_name] if allocators is not None else NumberAllocator(group_channels)
+        if not group_channels:
+            # if there are no channels for this group - create just one
+            numbers_to_create = allocator.allocate(1)
+        else:
+            empty_channels = sorted(((num, channel) for num, channel in group_channels.items()
+                                     if not channel.voice_members), key=itemgetter(0))
+            n_to_create = max(0, min_empty_channels - len(empty_channels))
+            numbers_to_create = allocator.allocate(n_to_create)
+            # remove the highest numbered empty channels
+            for num, channel in empty_channels[min_empty_channels:]:
+                if is_active(channel):
+                    logger.info("not removing channel %r due to recent activity", channel.name,
+                                extra=log_fields(channel.server, channel=channel.id))
+                else:
+                    plan.deletes.append(channel)
+                    del members[num]
+
+        user_limit = 0
+        if members:
+            anchor = members[min(members)]
+            anchors[anchor.id] = group_name
+            user_limit = anchor.user_limit
+        for num in numbers_to_create:
+            planned = PlannedChannel(group_name, num, ChannelManager.create_channel_name(group_name, num), user_limit)
+            plan.creates.append(planned)
+            members[num] = planned
+        for channel in members.values():
+            if not isinstance(channel, PlannedChannel) and channel.user_limit != user_limit:
+                plan.user_limit_edits.append((channel, user_limit))
+        group_members[group_name] = members
+
+    group_channel_ids = {channel.id for members in group_members.values() for channel in members.values()
+                         if not isinstance(channel, PlannedChannel)}
+    deleted = {channel.id for channel in plan.deletes}
+    remaining = [channel for channel in voice_channels if channel.id not in deleted]
+    placed_groups = set()
+    for channel in remaining:
+        if channel.id in anchors:
+            # put whole group in place of its anchor
+            placed_groups.add(anchors[channel.id])
+            members = group_members[anchors[channel.id]]
+            plan.order.extend(members[num] for num in sorted(members))
+        elif channel.id not in group_channel_ids:
+            # not a managed channel, leave it where it is
+            plan.order.append(channel)
+    for group_name, members in group_members.items():
+        if group_name not in placed_groups:
+            # group consisting only of new channels, they are created at the end
+            plan.order.extend(members[num] for num in sorted(members))
+
+    # new channels are appended at the end, if there are several their order depends on which request finished first
+    expected = remaining + plan.creates
+    plan.order_changed = len(plan.creates) > 1 or any(a is not b for a, b in zip(plan.order, expected))
+    return plan
+
+
 def find_by_name(channels: List[Channel], name: str):
     for channel in channels:
         if channel.name == name:
@@ -710,7 +1805,7 @@ def find_by_name(channels: List[Channel], name: str):
 def install_dep(dep_name):
     try:
         import pip
-        logger.debug('trying to install: ' + dep_name)
+        logger.debug('trying to install: %s', dep_name)
         pip.main(['install', dep_name])
     except Exception as e:
         logger.error(e)
@@ -722,20 +1817,34 @@ def setup(bot):
     bot.loop.create_task(cm.update_scheduler())
 
     async def on_channel_create(channel):
-        logger.info("on_channel_create, channel: {0}".format(channel))
-        await cm.fix_channel_positions(channel.server)
+        logger.info("on_channel_create, channel: %s", channel)
+        if channel.is_private:
+            return
+        # replaces a copy indexed from the REST response of create_channel
+        cm.channel_index.update_channel(channel)
+        cm.reconciler.request(channel.server)
+
+    async def on_channel_delete(channel):
+        if not channel.is_private:
+            cm.channel_index.remove_channel(channel)
+            cm.channel_activity.forget(channel.id)
+
+    async def on_channel_update(before, after):
+        if not after.is_private:
+            cm.channel_index.update_channel(after)
 
     async def on_voice_state_update(before, after):
         chan_before = before.voice.voice_channel
         chan_after = after.voice.voice_channel
         if chan_before:
-            cm.channel_activity[chan_before] = datetime.now()
+            cm.channel_activity.touch(chan_before.id)
         if chan_after:
-            cm.channel_activity[chan_after] = datetime.now()
-        await cm.update_groups(before.server)
-        logger.debug('on_voice_state_update, channel_before: {chan_before}, channel_after: {chan_after}, before: {0}, after: {1}'
-                    .format(before, after, chan_before=chan_before, chan_after=chan_after))
+            cm.channel_activity.touch(chan_after.id)
+        cm.reconciler.request(before.server)
+        logger.debug('on_voice_state_update, channel_before: %s, channel_after: %s, before: %s, after: %s',
+                     chan_before, chan_after, before, after, extra=log_fields(before.server))
 
     bot.add_listener(on_channel_create, 'on_channel_create')
-    # bot.add_listener(on_channel_update, 'on_channel_update')
+    bot.add_listener(on_channel_delete, 'on_channel_delete')
+    bot.add_listener(on_channel_update, 'on_channel_update')
     bot.add_listener(on_voice_state_update, 'on_voice_state_update')
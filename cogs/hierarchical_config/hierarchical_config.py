@@ -1,10 +1,12 @@
+import copy
+import json
 import logging
-from typing import Dict, Iterable, List, Set, Union, NewType
-
-try:
-    import jsonpickle
-except ImportError:
-    jsonpickle = None
+import marshal
+import os
+from abc import ABC, abstractmethod
+from collections import defaultdict, namedtuple, OrderedDict
+from types import MappingProxyType
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Set, Tuple, Union, NewType
 
 BaseValueType = NewType('BaseValueType', Union[str, int, float])
 ValueType = NewType('ValueType', Union[BaseValueType, List[BaseValueType], Set[BaseValueType], Dict[str, BaseValueType]])
@@ -12,25 +14,428 @@ ValueType = NewType('ValueType', Union[BaseValueType, List[BaseValueType], Set[B
 logger = logging.getLogger("red.hierarchical_config")
 logger.setLevel(logging.DEBUG)
 
+CacheInfo = namedtuple('CacheInfo', 'hits misses size')
+_MISSING = object()
+_NO_VALUES = MappingProxyType({})
+
 
 class Location:
-    def __init__(self, locations: Dict = None, values: Dict[str, ValueType] = None) -> object:
-        self.locations = locations if locations else {}  # type: Dict[str, Location]
-        self.values = values if values else {}  # type: Dict[str, ValueType]
+    """Node of the configuration tree
+
+    Dicts of child locations and of values are allocated on first write or on first access through `locations`
+    and `values`, get_child, get_value, child_items, value_items and value_mapping read them without allocating.
+    """
+    __slots__ = ('_locations', '_values')
+
+    def __init__(self, locations: Dict = None, values: Dict[str, ValueType] = None):
+        self._locations = locations if locations else None  # type: Dict[str, Location]
+        self._values = values if values else None  # type: Dict[str, ValueType]
+
+    @property
+    def locations(self) -> Dict[str, 'Location']:
+        if self._locations is None:
+            self._locations = {}
+        return self._locations
+
+    @locations.setter
+    def locations(self, locations: Dict[str, 'Location']):
+        self._locations = locations if locations else None
+
+    @property
+    def values(self) -> Dict[str, ValueType]:
+        if self._values is None:
+            self._values = {}
+        return self._values
+
+    @values.setter
+    def values(self, values: Dict[str, ValueType]):
+        self._values = values if values else None
+
+    def get_child(self, key: str, create: bool = False) -> 'Location':
+        """Child location at key, None if it doesn't exist and create isn't set"""
+        if self._locations is not None and key in self._locations:
+            return self._locations[key]
+        if not create:
+            return None
+        if self._locations is None:
+            self._locations = {}
+        child = self._locations[key] = Location()
+        return child
+
+    def child_items(self) -> Iterable[Tuple[str, 'Location']]:
+        return self._locations.items() if self._locations is not None else ()
+
+    def value_items(self) -> Iterable[Tuple[str, ValueType]]:
+        return self._values.items() if self._values is not None else ()
+
+    def value_mapping(self) -> Mapping[str, ValueType]:
+        """Values set at the location, not to be modified"""
+        return self._values if self._values is not None else _NO_VALUES
+
+    def get_value(self, name: str, default: ValueType = None) -> ValueType:
+        if self._values is None:
+            return default
+        return self._values.get(name, default)
+
+    def set_value(self, name: str, value: ValueType):
+        if self._values is None:
+            self._values = {}
+        self._values[name] = value
+
+    def delete_value(self, name: str) -> bool:
+        if self._values is None or name not in self._values:
+            return False
+        del self._values[name]
+        if not self._values:
+            self._values = None
+        return True
 
     def __eq__(self, other):
         if not isinstance(other, Location):
             return False
-        elif self.locations != other.locations:
+        elif dict(self.child_items()) != dict(other.child_items()):
             return False
         else:
-            return self.values == other.values
+            return dict(self.value_items()) == dict(other.value_items())
+
+
+class LocationCodec:
+    """Converts Location trees to plain dicts and back, and stores them as json or marshal
+
+    Location is stored as {"locations": {key: location, ...}, "values": {name: value, ...}}, empty members
+    are omitted. In json, sets are stored as {"py/set": [...]}, and a dict that would read as such a tag
+    is wrapped in {"py/dict": {...}}. Files written with jsonpickle by previous versions are recognised by
+    the "py/object" tag of the root location and decoded separately.
+    """
+
+    binary_magic = b'HCFG\x01'
+    json_tags = ('py/set', 'py/tuple', 'py/dict')
+
+    @classmethod
+    def to_dict(cls, location: Location) -> Dict[str, Any]:
+        data = {}
+        locations = {key: cls.to_dict(child) for key, child in location.child_items()}
+        if locations:
+            data['locations'] = locations
+        values = dict(location.value_items())
+        if values:
+            data['values'] = values
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> Location:
+        locations = data.get('locations')
+        return Location(
+            {key: cls.from_dict(child) for key, child in locations.items()} if locations else None,
+            dict(data['values']) if data.get('values') else None
+        )
+
+    @classmethod
+    def _to_json(cls, value):
+        if isinstance(value, (set, frozenset)):
+            return {'py/set': [cls._to_json(item) for item in value]}
+        elif isinstance(value, tuple):
+            return {'py/tuple': [cls._to_json(item) for item in value]}
+        elif isinstance(value, list):
+            return [cls._to_json(item) for item in value]
+        elif isinstance(value, dict):
+            data = {key: cls._to_json(item) for key, item in value.items()}
+            if len(data) == 1 and next(iter(data)) in cls.json_tags:
+                return {'py/dict': data}
+            return data
+        return value
+
+    @classmethod
+    def _from_json(cls, data):
+        if isinstance(data, list):
+            return [cls._from_json(item) for item in data]
+        elif not isinstance(data, dict):
+            return data
+        if len(data) == 1:
+            tag, items = next(iter(data.items()))
+            if tag == 'py/set':
+                return set(cls._from_json(item) for item in items)
+            elif tag == 'py/tuple':
+                return tuple(cls._from_json(item) for item in items)
+            elif tag == 'py/dict':
+                data = items
+        return {key: cls._from_json(item) for key, item in data.items()}
+
+    @staticmethod
+    def _from_jsonpickle(data: Dict[str, Any]) -> Dict[str, Any]:
+        """Plain data of a document written by jsonpickle, objects become dicts of their attributes
+
+        jsonpickle numbers objects, lists and dicts from 0 in the order they are written,
+        {"py/id": n} refers back to the n-th of them.
+        """
+        objects = []
+
+        def restore(value):
+            if isinstance(value, list):
+                restored = []
+                objects.append(restored)
+                restored.extend(restore(item) for item in value)
+                return restored
+            elif not isinstance(value, dict):
+                return value
+            elif 'py/id' in value:
+                return objects[value['py/id']]
+            elif 'py/set' in value:
+                return set(restore(item) for item in value['py/set'])
+            elif 'py/tuple' in value:
+                return tuple(restore(item) for item in value['py/tuple'])
+            restored = {}
+            objects.append(restored)
+            for key, item in value.items():
+                if 'py/object' in value:
+                    # Location with __slots__ is pickled under the slot names
+                    key = key.lstrip('_')
+                if not key.startswith('py/'):
+                    restored[key] = restore(item)
+            return restored
+
+        return restore(data)
+
+    @classmethod
+    def encode(cls, location: Location, binary: bool = False) -> bytes:
+        data = cls.to_dict(location)
+        if binary:
+            return cls.binary_magic + marshal.dumps(data)
+        return json.dumps(cls._to_json(data), sort_keys=True, indent=4).encode('utf-8')
+
+    @classmethod
+    def decode(cls, encoded: bytes) -> Location:
+        if encoded.startswith(cls.binary_magic):
+            data = marshal.loads(encoded[len(cls.binary_magic):])
+        else:
+            data = json.loads(encoded.decode('utf-8'))
+            if isinstance(data, dict) and 'py/object' in data:
+                data = cls._from_jsonpickle(data)
+            else:
+                data = cls._from_json(data)
+        return cls.from_dict(data)
+
+
+class BaseConfig(ABC):
+    """Variables stored at the levels of a hierarchy, shared part of the configs
+
+    Subclasses keep the values set at each level, identified by its path, and implement the level accessors.
+    A variable that isn't set at a path is looked up at shorter paths and finally in `defaults`.
+    Resolved values are cached per variable and path until the variable is set or deleted at the same
+    or a shorter path.
+    """
+
+    value_types = (str, int, float, list, dict)  # type: Tuple[type, ...]
+
+    def __init__(self, defaults: Dict[str, ValueType] = None):
+        self.defaults = defaults if defaults is not None else {}  # type: Dict[str, ValueType]
+        # name -> path -> (path of the level the value is set at or None for defaults, value)
+        self._cache = {}  # type: Dict[str, Dict[Tuple[str, ...], Tuple[Tuple[str, ...], ValueType]]]
+        # (name, path of the level the value is set at) -> read-only version of the value
+        self._frozen = {}  # type: Dict[Tuple[str, Tuple[str, ...]], ValueType]
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    @abstractmethod
+    def _get_levels(self, path: Tuple[str, ...]) -> List[Mapping[str, ValueType]]:
+        """Values set at each level from the root to path (len(path) + 1 of them), empty for missing levels"""
+
+    @abstractmethod
+    def _store_value(self, path: Tuple[str, ...], name: str, value: ValueType):
+        pass
+
+    @abstractmethod
+    def _remove_value(self, path: Tuple[str, ...], name: str) -> bool:
+        """
+        :return: whether the variable was set at path
+        """
+
+    def set_var(self, name: str, value: ValueType, path: Iterable[str] = None):
+        if not isinstance(value, self.value_types):
+            raise TypeError('value should be one of following types: {0}'
+                            .format(', '.join(value_type.__name__ for value_type in self.value_types)))
+        path = tuple(path) if path else ()
+        self._store_value(path, name, value)
+        self._invalidate(name, path)
+
+    def delete_var(self, path: Iterable[str], name: str) -> bool:
+        """
+        :return: whether the variable was set at path
+        """
+        path = tuple(path) if path else ()
+        if not self._remove_value(path, name):
+            return False
+        self._invalidate(name, path)
+        return True
+
+    def _invalidate(self, name: str, path: Tuple[str, ...]):
+        """Drop cached values of variable at path and all paths below it"""
+        self._frozen.pop((name, path), None)
+        if not path:
+            self._cache.pop(name, None)
+            return
+        cached = self._cache.get(name, {})
+        for cached_path in [cached_path for cached_path in cached if cached_path[:len(path)] == path]:
+            del cached[cached_path]
+
+    def _clear_cache(self):
+        self._cache.clear()
+        self._frozen.clear()
+
+    def _resolve(self, name: str, path: Tuple[str, ...],
+                 levels: List[Mapping[str, ValueType]] = None) -> Tuple[Tuple[str, ...], ValueType]:
+        """(path of the level the value is set at or None for defaults, value) of variable visible at path
+
+        The levels along path are retrieved once (or taken from levels) and searched from path towards the root
+        up to the first cached prefix, values visible at the prefixes passed on the way are cached as well.
+        """
+        cached = self._cache.setdefault(name, {})
+        resolved = cached.get(path)
+        if resolved is not None:
+            return resolved
+        if levels is None:
+            levels = self._get_levels(path)
+        uncached = []
+        for depth in range(len(path), -1, -1):
+            prefix = path[:depth] if depth < len(path) else path
+            resolved = cached.get(prefix)
+            if resolved is not None:
+                break
+            uncached.append(prefix)
+            value = levels[depth].get(name, _MISSING)
+            if value is not _MISSING:
+                resolved = prefix, value
+                break
+        else:
+            resolved = None, self.defaults.get(name)
+        for prefix in uncached:
+            cached[prefix] = resolved
+        return resolved
+
+    def _lookup(self, name: str, path: Iterable[str]) -> Tuple[Tuple[str, ...], ValueType]:
+        path = tuple(path) if path else ()
+        resolved = self._cache.get(name, {}).get(path)
+        if resolved is not None:
+            self.cache_hits += 1
+            return resolved
+        self.cache_misses += 1
+        resolved = self._resolve(name, path)
+        logger.debug('retrieved variable %r: value %r, type %r', name, resolved[1], type(resolved[1]))
+        return resolved
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(self.cache_hits, self.cache_misses, sum(len(cached) for cached in self._cache.values()))
+
+    def get_var(self, name: str, path: Iterable[str] = None, default: ValueType = None,
+                frozen: bool = False) -> ValueType:
+        """Retrieve variable value from specified path
+
+        If value doesn't exist at specified path, value is looked up at lower levels,
+        resolved values are cached until the variable is set or deleted at the same or a lower level
+
+        If variable is of mutable type then a copy of it will be returned, to modify it use set_var with copy as value
+        or update_var. With frozen set a read-only view is returned instead, without copying on every call
+
+        :param name: name of the variable to retrieve
+        :param path: path of the variable
+        :param default: returned if the variable doesn't exist
+        :param frozen: return read-only view (tuple, frozenset or MappingProxyType) of mutable value
+        :return: value of the variable
+        """
+        resolved = self._lookup(name, path)
+        if resolved[1] is None and default is not None:
+            return default
+        return self._get_value(name, resolved, frozen)
+
+    def resolve_all(self, path: Iterable[str] = None, names: Iterable[str] = None,
+                    frozen: bool = False) -> Dict[str, ValueType]:
+        """Retrieve values of many variables from specified path at once
+
+        Values are looked up as in get_var and share its cache
+
+        :param path: path of the variables
+        :param names: names of the variables to retrieve, all variables visible at path (including defaults) if None
+        :param frozen: return read-only views of mutable values, as in get_var
+        :return: dict of variable name to value, None for variables that don't exist
+        """
+        path = tuple(path) if path else ()
+        levels = self._get_levels(path)
+        # values visible at path, the deepest level wins
+        merged = {}
+        for depth, values in enumerate(levels):
+            if values:
+                prefix = path[:depth]
+                for name, value in values.items():
+                    merged[name] = prefix, value
+        if names is None:
+            names = set(self.defaults)
+            names.update(merged)
+        result = {}
+        for name in names:
+            cached = self._cache.setdefault(name, {})
+            resolved = cached.get(path)
+            if resolved is not None:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+                resolved = cached[path] = merged.get(name) or (None, self.defaults.get(name))
+            result[name] = self._get_value(name, resolved, frozen)
+        return result
 
+    def resolve_many(self, paths: Iterable[Iterable[str]], name: str,
+                     frozen: bool = False) -> Dict[Tuple[str, ...], ValueType]:
+        """Retrieve value of a variable from many paths at once
+
+        Values are looked up as in get_var and share its cache, so values resolved for common prefixes
+        of the paths (e.g. global level) are reused
+
+        :param paths: paths of the variable
+        :param name: name of the variable to retrieve
+        :param frozen: return read-only views of mutable values, as in get_var
+        :return: dict of path (as tuple) to value
+        """
+        cached = self._cache.setdefault(name, {})
+        result = {}
+        for path in paths:
+            path = tuple(path) if path else ()
+            resolved = cached.get(path)
+            if resolved is not None:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+                resolved = self._resolve(name, path)
+            result[path] = self._get_value(name, resolved, frozen)
+        return result
+
+    def _get_value(self, name: str, resolved: Tuple[Tuple[str, ...], ValueType], frozen: bool) -> ValueType:
+        """Shallow copy of resolved value, or its read-only version created once per stored value if frozen is set"""
+        level_path, value = resolved
+        if isinstance(value, (str, int, float)) or value is None:
+            return value
+        elif not frozen:
+            return value.copy()
+        key = name, level_path
+        frozen_value = self._frozen.get(key, _MISSING)
+        if frozen_value is _MISSING:
+            frozen_value = self._frozen[key] = freeze_value(value)
+        return frozen_value
+
+    def update_var(self, name: str, fn: Callable[[ValueType], ValueType], path: List[str] = None) -> ValueType:
+        """Set variable at path to fn(current value), current value is a (mutable) copy of value returned by get_var
+
+        :return: new value of the variable
+        """
+        value = fn(self.get_var(name, path))
+        self.set_var(name, value, path)
+        return value
+
+
+class HierarchicalConfig(BaseConfig):
+    value_types = (str, int, float, list, set, dict)
 
-class HierarchicalConfig:
     def __init__(self, defaults: Dict[str, ValueType] = None, data: Location = None):
+        super().__init__(defaults)
         self.data = data if data else Location()  # type: Location
-        self.defaults = defaults if defaults else {}  # type: Dict[str, ValueType]
 
     def __eq__(self, other):
         if not isinstance(other, HierarchicalConfig):
@@ -41,128 +446,281 @@ class HierarchicalConfig:
             return self.data == self.data
 
     def ensure_path(self, path: List[str]) -> Location:
-        if path is None or len(path) == 0:
-            return self.data
         location = self.data  # type: Location
-        for key in path:
-            if key not in location.locations:
-                location.locations[key] = Location()
-            location = location.locations[key]
+        for key in path or ():
+            location = location.get_child(key, create=True)
         return location
 
-    def get_location(self, path: List[str]):
+    def get_location(self, path: List[str]) -> Location:
+        """Location at path, None if it doesn't exist"""
         location = self.data
-        for key in path:
-            if key in location.locations:
-                location = location.locations[key]
+        for key in path or ():
+            location = location.get_child(key)
+            if location is None:
+                return None
         return location
 
-    def set_var(self, name: str, value: ValueType, path: List[str] = None):
-        if isinstance(value, (str, int, float, List, Set, Dict)):
-            location = self.ensure_path(path)
-            location.values[name] = value
-        else:
-            raise TypeError('value should be one of following types: str, int, float, List, Set, Dict')
+    def _get_levels(self, path):
+        location = self.data
+        levels = [location.value_mapping()]
+        for key in path:
+            location = location.get_child(key) if location is not None else None
+            levels.append(location.value_mapping() if location is not None else _NO_VALUES)
+        return levels
 
-    def delete_var(self, path: List[str], name: str):
-        location = self.get_location(path)
-        if name in location.values[name]:
-            del location.values[name]
+    def _store_value(self, path, name, value):
+        location = self.ensure_path(path)
+        location.set_value(name, value)
 
-    def get_var(self, name: str, path: Iterable[str] = None) -> ValueType:
-        """Retrieve variable value from specified path
+    def _remove_value(self, path, name):
+        location = self.get_location(path)
+        if location is None:
+            return False
+        return location.delete_value(name)
 
-        If value doesn't exist at specified path, value is looked up recursively at lower levels,
-        stoping at default value
+    def save(self, file_name: str, binary: bool = False):
+        """Save configuration as json, or as a compact marshal file if binary is set"""
+        write_file_atomic(file_name, LocationCodec.encode(self.data, binary=binary))
 
-        If variable is of mutable type then a copy of it will be returned, to modify it use set_var with copy as value
+    def load(self, file_name: str):
+        """Load configuration saved in any of the formats"""
+        with open(file_name, 'rb') as config_file:
+            self.data = LocationCodec.decode(config_file.read())
+        self._clear_cache()
+
+
+class Config(BaseConfig):
+    """Configuration kept as flat dict of levels, keyed by their paths joined with os.sep
+
+    If `storage` is given, every change is reported to it with record_set(path_key, name, value) and
+    record_delete(path_key, name), so it can save changes instead of the whole data.
+    A storage with `lazy` set is expected to provide only the root level as `data`, levels at and below a top-level
+    key are loaded with storage.load_subtree(key) when one of them is used first, everything else with
+    storage.load() by load_all().
+    """
+
+    def __init__(self, defaults: Dict[str, ValueType] = None, data: Dict[str, Dict[str, BaseValueType]] = None,
+                 storage=None):
+        super().__init__(defaults)
+        self.data = defaultdict(dict)
+        if data is not None:
+            self.data.update(data)
+        self.storage = storage
+        # top-level keys loaded from a lazy storage, None when all data is in memory
+        self.loaded = set() if storage is not None and storage.lazy else None  # type: Set[str]
 
-        :param name: name of the variable to retrieve
-        :param path: path of the variable
-        :return: value of the variable
-        """
+    def __eq__(self, other):
+        if not isinstance(other, Config):
+            return False
+        elif self.defaults != other.defaults:
+            return False
+        else:
+            return self.data == self.data
 
-        value = self.data.values.get(name, self.defaults.get(name))
-        location = self.data
-        if not path:
-            return value
+    def __str__(self):
+        return str({'data': self.data, 'defaults': self.defaults})
+
+    def reset(self, data: Dict[str, Dict[str, ValueType]]):
+        """Replace all data, e.g. after it was replaced in storage"""
+        self.data = defaultdict(dict, data)
+        self.loaded = None
+        self._clear_cache()
+
+    def load_all(self):
+        """Load everything that wasn't loaded from a lazy storage yet"""
+        if self.loaded is None:
+            return
+        for path_key, values in (self.storage.load() or {}).items():
+            if path_key and path_key.split(os.sep, 1)[0] not in self.loaded:
+                self.data[path_key] = values
+        self.loaded = None
+
+    def _get_level(self, path: Tuple[str, ...]) -> Dict[str, ValueType]:
+        self._load_subtree(path)
+        return self.data.get(os.sep.join(path))
+
+    def _load_subtree(self, path: Tuple[str, ...]):
+        if path and self.loaded is not None and path[0] not in self.loaded:
+            self.loaded.add(path[0])
+            self.data.update(self.storage.load_subtree(path[0]))
+
+    def _get_levels(self, path):
+        self._load_subtree(path)
+        path_key = ''
+        levels = [self.data.get(path_key) or _NO_VALUES]
         for key in path:
-            # get value from current location, preserve existing one if it doesn't exist here
-            if key in location.locations:
-                location = location.locations[key]
-                value = location.values.get(name, value)
-            else:
-                break
-        logger.debug('retrieved variable {0!r}: value {1!r}, type {2!r}'.format(name, value, type(value)))
-        if isinstance(value,(str, int, float)) or value is None:
-            return value
-        elif isinstance(value,(List,Set,Dict)):
-            return value.copy()
-        else:
-            raise TypeError('tried to retrieve value of unsupported type (this should not be possible)')
+            path_key = path_key + os.sep + key if path_key else key
+            levels.append(self.data.get(path_key) or _NO_VALUES)
+        return levels
+
+    def _store_value(self, path, name, value):
+        self._get_level(path)
+        path_key = os.sep.join(path)
+        values = self.data.setdefault(path_key, {})
+        values[name] = value
+        if self.storage is not None:
+            self.storage.record_set(path_key, name, value)
+
+    def _remove_value(self, path, name):
+        path_key = os.sep.join(path)
+        values = self._get_level(path)
+        if values is None or name not in values:
+            return False
+        del values[name]
+        if self.storage is not None:
+            self.storage.record_delete(path_key, name)
+        return True
 
     def save(self, file_name: str):
-        with open(file_name, 'w+') as config_file:
-            jsonpickle.set_preferred_backend('simplejson')
-            jsonpickle.set_encoder_options('simplejson', sort_keys=True, indent=4)
-            json_str = jsonpickle.encode(self.data)
-            config_file.write(json_str)
+        write_file_atomic(file_name, json.dumps(self.data))
 
     def load(self, file_name: str):
         with open(file_name, 'r') as config_file:
-            json_str = config_file.read()
-            self.data = jsonpickle.decode(json_str)
+            self.data = json.loads(config_file.read())
+        self._clear_cache()
+
+
+def write_file_atomic(file_name: str, content: Union[str, bytes]):
+    """Write file so that it contains either the old or the new content, even if writing is interrupted"""
+    tmp_file_name = file_name + '.tmp'
+    with open(tmp_file_name, 'wb' if isinstance(content, bytes) else 'w') as tmp_file:
+        tmp_file.write(content)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_file_name, file_name)
+
+
+def freeze_value(value: ValueType) -> ValueType:
+    """Read-only copy of value at every depth: tuples of lists, frozensets of sets, read-only proxies of dicts"""
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze_value(item) for item in value)
+    elif isinstance(value, (set, frozenset)):
+        return frozenset(value)
+    elif isinstance(value, dict):
+        return MappingProxyType({key: freeze_value(item) for key, item in value.items()})
+    return value
 
 
 class VariableNotInLevel(Exception):
-    pass
+    def __init__(self, name: str = None, level: str = None):
+        super().__init__('variable {0!r} can not be set at {1!r} level'.format(name, level))
+        self.name = name
+        self.level = level
+
+
+def parse_bool(value: Union[str, bool]) -> bool:
+    if isinstance(value, bool):
+        return value
+    text = str(value).lower()
+    if text in ('true', 'yes', 'on', '1'):
+        return True
+    elif text in ('false', 'no', 'off', '0'):
+        return False
+    raise ValueError('invalid boolean value {0!r}'.format(value))
+
+
+var_types = {
+    'int': int,
+    'float': float,
+    'str': str,
+    'bool': parse_bool
+}  # type: Dict[str, Callable[[Any], ValueType]]
+
+
+def get_type_parser(var_type: Union[str, Callable[[Any], ValueType]]) -> Callable[[Any], ValueType]:
+    """Parser of a type given by its name in var_types or by the type itself"""
+    if isinstance(var_type, str):
+        if var_type not in var_types:
+            raise ValueError('unknown variable type {0!r}, known types are: {1}'
+                             .format(var_type, ', '.join(sorted(var_types))))
+        return var_types[var_type]
+    return parse_bool if var_type is bool else var_type
 
 
 class Variable:
+    """Declared configuration variable
+
+    Values are converted with `parser` (by default the parser of `var_type`) and checked with `validator` once,
+    when they are set, default is converted when the variable is declared.
+    """
 
     def __init__(self, name: str,
-                 levels: List[str],
-                 var_type: str,
+                 var_type: Union[str, Callable[[Any], ValueType]],
+                 default: ValueType,
                  description: str,
-                 default: str,
-                 store: HierarchicalConfig):
+                 levels: Iterable[str] = ('global', 'server'),
+                 store: BaseConfig = None,
+                 parser: Callable[[Any], ValueType] = None,
+                 validator: Callable[[ValueType], bool] = None):
         self.name = name
-        self.levels = levels
         self.var_type = var_type
         self.description = description
-        self.default = default
-        self.store = store  # type: HierarchicalConfig
-
-    def _convert_value(self, value):
-        if self.var_type == 'int':
-            return int(value)
-
-    def _convert_and_set_value(self, value, path):
-        try:
-            converted = self._convert_value(value)
-            self.store.set_var(self.name, converted, path=path)
-        except Exception as e:
-            raise e
+        self.levels = frozenset(levels)
+        self.store = store  # type: BaseConfig
+        self.parser = parser if parser is not None else get_type_parser(var_type)
+        self.validator = validator
+        self.default = self.parse(default) if default is not None else None
+
+    def bind(self, store: BaseConfig) -> 'Variable':
+        """Copy of the variable reading and writing values in store"""
+        variable = copy.copy(self)
+        variable.store = store
+        return variable
+
+    def parse(self, value) -> ValueType:
+        converted = self.parser(value)
+        if self.validator is not None and not self.validator(converted):
+            raise ValueError('invalid value {0!r} of variable {1!r}'.format(value, self.name))
+        return converted
+
+    def check_level(self, level: str):
+        if level not in self.levels:
+            raise VariableNotInLevel(self.name, level)
+
+    def _set(self, level: str, value, path: List[str] = None):
+        self.check_level(level)
+        self.store.set_var(self.name, self.parse(value), path=path)
 
     def set_global(self, value):
-        if 'global' not in self.levels:
-            raise VariableNotInLevel(level='global')
-        self._convert_and_set_value(value, None)
+        self._set('global', value)
 
     def set_server(self, server, value):
-        if 'server' not in self.levels:
-            raise VariableNotInLevel(level='server')
-        self._convert_and_set_value(value, [server.id])
+        self._set('server', value, [server.id])
 
     def set_group(self, server, group_name, value):
-        if 'group' not in self.levels:
-            raise VariableNotInLevel(level='group')
-        self._convert_and_set_value(value, [server.id, group_name])
+        self._set('group', value, [server.id, group_name])
+
+    def get(self, path: List[str] = None) -> ValueType:
+        value = self.store.get_var(name=self.name, path=path)
+        return self.default if value is None else value
+
+    def get_server(self, server) -> ValueType:
+        return self.get([server.id])
+
+    def get_group(self, server, group_name) -> ValueType:
+        return self.get([server.id, group_name])
 
-    def get(self, path: List[str]=None):
-        return self.store.get_var(name=self.name, path=path)
+
+class VariableRegistry:
+    """Declared variables, with their defaults and help text computed once"""
+
+    def __init__(self, variables: Iterable[Variable]):
+        self.variables = OrderedDict((variable.name, variable) for variable in variables)
+        self.defaults = {name: variable.default for name, variable in self.variables.items()}
+        self.server_names = tuple(name for name, variable in self.variables.items() if 'server' in variable.levels)
+        var_lines = ['{0:20s} - {1}'.format(name, self.variables[name].description) for name in self.server_names]
+        self.help = 'Variables:\n' + '\n'.join(var_lines)
+
+    def bind(self, store: BaseConfig) -> 'VariableRegistry':
+        """Registry of the same variables reading and writing values in store"""
+        return VariableRegistry(variable.bind(store) for variable in self.variables.values())
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.variables
+
+    def __getitem__(self, name: str) -> Variable:
+        return self.variables[name]
 
 
 def setup(bot):
-    if jsonpickle is None:
-        raise RuntimeError("You need to run `pip3 install jsonpickle`")
+    pass
@@ -1,34 +1,152 @@
-from typing import Iterable, Any
+from collections import defaultdict
+from itertools import chain
+from typing import Iterable, Iterator, Any, Dict, List, Set
 
-from discord import Server, User
+from discord import Member, Server
 from discord.ext.commands import Bot
 from discord.ext.commands.core import command
 from discord.role import Role
 
 from cogs.utils import checks
 
+discord_message_size = 2000
+
+
+class RoleIndex:
+    """Roles of a server by normalised name and ids of members of each role
+
+    Built once from the server and kept up to date with member and role events, so lookups don't scan all members.
+    """
+
+    def __init__(self, server: Server):
+        self.server = server
+        self.roles = {}  # type: Dict[str, Role]
+        self.members = defaultdict(set)  # type: Dict[str, Set[str]]
+        self.member_count = 0
+        self.rebuild()
+
+    def rebuild(self):
+        self.roles.clear()
+        self.members.clear()
+        for role in self.server.roles:
+            self.roles.setdefault(process_input(role.name), role)
+        for member in self.server.members:
+            self.add_member(member)
+        self.member_count = len(self.server.members)
+
+    def is_stale(self) -> bool:
+        """Members were added to the server without events, e.g. by chunking of large servers"""
+        return self.member_count != len(self.server.members)
+
+    def get_role(self, rolename: str) -> Role:
+        return self.roles.get(process_input(rolename))
+
+    def get_members(self, role: Role) -> List[Member]:
+        members = (self.server.get_member(member_id) for member_id in self.members.get(role.id, ()))
+        return [member for member in members if member is not None]
+
+    def add_member(self, member: Member):
+        for role in member.roles:
+            self.members[role.id].add(member.id)
+
+    def remove_member(self, member: Member):
+        for role in member.roles:
+            self.members[role.id].discard(member.id)
+
+    def update_member(self, before: Member, after: Member):
+        if before.roles != after.roles:
+            self.remove_member(before)
+            self.add_member(after)
+
+    def _reindex_name(self, name: str):
+        role = get_role_by_name(self.server.roles, name)
+        if role is None:
+            self.roles.pop(process_input(name), None)
+        else:
+            self.roles[process_input(name)] = role
+
+    def add_role(self, role: Role):
+        self.roles.setdefault(process_input(role.name), role)
+
+    def remove_role(self, role: Role):
+        self.members.pop(role.id, None)
+        if self.roles.get(process_input(role.name)) is role:
+            self._reindex_name(role.name)
+
+    def update_role(self, before: Role, after: Role):
+        if process_input(before.name) != process_input(after.name):
+            self._reindex_name(before.name)
+            self._reindex_name(after.name)
+
 
 class MicksUtils:
     def __init__(self, bot: Bot):
         self.bot = bot
+        self.role_indexes = {}  # type: Dict[str, RoleIndex]
+
+    def role_index(self, server: Server) -> RoleIndex:
+        index = self.role_indexes.get(server.id)
+        if index is None:
+            index = self.role_indexes[server.id] = RoleIndex(server)
+        elif index.is_stale():
+            index.rebuild()
+        return index
+
+    def indexed(self, server: Server) -> RoleIndex:
+        """Index of server if it was built, events of other servers are ignored"""
+        return self.role_indexes.get(server.id)
+
+    async def on_member_join(self, member: Member):
+        index = self.indexed(member.server)
+        if index is not None:
+            index.add_member(member)
+            index.member_count = len(member.server.members)
+
+    async def on_member_remove(self, member: Member):
+        index = self.indexed(member.server)
+        if index is not None:
+            index.remove_member(member)
+            index.member_count = len(member.server.members)
+
+    async def on_member_update(self, before: Member, after: Member):
+        index = self.indexed(after.server)
+        if index is not None:
+            index.update_member(before, after)
+
+    async def on_server_role_create(self, role: Role):
+        index = self.indexed(role.server)
+        if index is not None:
+            index.add_role(role)
+
+    async def on_server_role_delete(self, role: Role):
+        index = self.indexed(role.server)
+        if index is not None:
+            index.remove_role(role)
+
+    async def on_server_role_update(self, before: Role, after: Role):
+        index = self.indexed(after.server)
+        if index is not None:
+            index.update_role(before, after)
+
+    async def on_server_remove(self, server: Server):
+        self.role_indexes.pop(server.id, None)
 
     @command(name='listrole', pass_context=True)
     @checks.mod_or_permissions(administrator=True, moderator=True)
     async def _list_role(self, ctx, *, rolename: str):
         """List all members for a given role"""
         server = ctx.message.server  # type: Server
-        #role = discord.utils.get(server.roles, name=rolename.lower())  # type: Role
-        role = get_role_by_name(server.roles, rolename) # cause we want to be case insensitive
+        index = self.role_index(server)
+        role = index.get_role(rolename)  # cause we want to be case insensitive
         if role is None:
             roles = sorted(server.roles, key=lambda role: role.name.lower())
-            await self.bot.say(create_message_from_list('Couldn\'t find role {role}, available roles are:\n'
-                                                        .format(role=rolename),
-                                                        '- {0.name}', roles))
+            pages = create_messages_from_list('Couldn\'t find role {role}, available roles are:\n'
+                                              .format(role=rolename), '- {0.name}', roles)
         else:
-            users = sorted(get_users_for_role(server.members, role.name),
-                           key=lambda user: user.name.lower())
-            await self.bot.say(create_message_from_list('Users for role {role.name!r}:\n'.format(role=role),
-                                                        '- {0.name}', users))
+            users = sorted(index.get_members(role), key=lambda user: user.name.lower())
+            pages = create_messages_from_list('Users for role {role.name!r}:\n'.format(role=role), '- {0.name}', users)
+        for page in pages:
+            await self.bot.say(page)
 
 def process_input(input: str):
     input_stripped = input.lower().strip()
@@ -41,20 +159,35 @@ def get_role_by_name(roles: Iterable[Role], rolename: str):
             return role
 
 
-def get_users_for_role(users: Iterable[User], rolename: str):
-    users_with_role = []
-    for user in users:
-        if rolename in (role.name for role in user.roles):
-            users_with_role.append(user)
-    return users_with_role
+def paginate(lines: Iterable[str], prefix: str = None, limit: int = discord_message_size) -> Iterator[str]:
+    """Pack lines into as few code block messages of at most `limit` characters as possible
+
+    Lines are consumed lazily and every message is yielded as soon as it's full, so it can be sent before the rest
+    of the lines is produced. `prefix` starts the first message, lines too long to fit into a message on their own
+    are truncated.
+    """
+    start, end = '```\n', '```'
+    max_line = limit - len(start) - len(end) - 1
+    current = []
+    size = 0
+    for line in chain([prefix], lines) if prefix is not None else lines:
+        # don't let the line close the code block
+        line = line.replace('```', '`\u200b``')
+        if len(line) > max_line:
+            line = line[:max_line - 3] + '...'
+        if current and size + len(line) + 1 > max_line + 1:
+            yield start + '\n'.join(current) + '\n' + end
+            current = []
+            size = 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        yield start + '\n'.join(current) + '\n' + end
 
 
-def create_message_from_list(prefix: str, line_format: str, message_list: Iterable[Any]):
-    message_lines = ['```', prefix]
-    lines = [line_format.format(line_args) for line_args in message_list]
-    message_lines.extend(lines)
-    message_lines.append('```')
-    return "\n".join(message_lines)
+def create_messages_from_list(prefix: str, line_format: str, message_list: Iterable[Any],
+                              limit: int = discord_message_size) -> Iterator[str]:
+    return paginate((line_format.format(line_args) for line_args in message_list), prefix, limit)
 
 
 def setup(bot: Bot):
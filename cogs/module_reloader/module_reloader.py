@@ -1,8 +1,20 @@
+import ast
 import asyncio
+import ctypes
+import ctypes.util
+import errno
 import glob
+import hashlib
+import heapq
 import logging
 import os
-import traceback
+import struct
+import sys
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Set, Tuple
 
 from discord.ext import commands
 
@@ -13,69 +25,558 @@ logger = logging.getLogger("red.module_reloader")
 logger.setLevel(logging.INFO)
 
 
+def scan_files(root: str) -> Dict[str, float]:
+    """Modification times of all python files below root, symlinks are followed"""
+    files = {}
+    for dir_path, dir_names, file_names in os.walk(root, followlinks=True):
+        dir_names[:] = [name for name in dir_names if name != '__pycache__']
+        for name in file_names:
+            if name.endswith('.py'):
+                path = os.path.join(dir_path, name)
+                try:
+                    files[path] = os.stat(os.path.realpath(path)).st_mtime
+                except OSError:
+                    pass
+    return files
+
+
+class FileWatcher(ABC):
+    """Watches python files below root and reports changed ones
+
+    Changes are debounced: callback is called with all changed paths once no change was seen for `debounce` seconds.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, root: str, callback: Callable[[Set[str]], None],
+                 debounce: float = 0.2):
+        self.loop = loop
+        self.root = root
+        self.callback = callback
+        self.debounce = debounce
+        self.changed = set()  # type: Set[str]
+        self.handle = None  # type: asyncio.Handle
+
+    @abstractmethod
+    def start(self):
+        pass
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def file_changed(self, path: str):
+        self.changed.add(path)
+        if self.handle is not None:
+            self.handle.cancel()
+        self.handle = self.loop.call_later(self.debounce, self._deliver)
+
+    def _deliver(self):
+        self.handle = None
+        changed, self.changed = self.changed, set()
+        self.callback(changed)
+
+
+class PollingWatcher(FileWatcher):
+    """Checks modification times of the files every `period` seconds, scanning is done in an executor"""
+
+    def __init__(self, loop, root, callback, debounce=0.2, period: float = 1):
+        super().__init__(loop, root, callback, debounce)
+        self.period = period
+        self.files = {}  # type: Dict[str, float]
+        self.task = None  # type: asyncio.Task
+
+    def start(self):
+        self.files = scan_files(self.root)
+        self.task = self.loop.create_task(self._poll())
+
+    def stop(self):
+        super().stop()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.period)
+            files = await self.loop.run_in_executor(None, scan_files, self.root)
+            for path, mtime in files.items():
+                if self.files.get(path) != mtime:
+                    self.file_changed(path)
+            self.files = files
+
+
+class Inotify:
+    """Minimal ctypes binding of linux inotify"""
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = 0o2000000
+
+    event_header = struct.Struct('iIII')
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError('libc not found')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError('libc has no inotify')
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add_watch(self, path: str, mask: int) -> int:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed', path)
+        return wd
+
+    def read_events(self) -> List[tuple]:
+        """Read available events as (wd, mask, name) tuples"""
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.event_header.unpack_from(data, offset)
+            offset += self.event_header.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class InotifyWatcher(FileWatcher):
+    """Watches directories with inotify, events are read when the event loop sees the inotify fd readable
+
+    Every directory below root is watched, new directories are watched as they are created. Python files that are
+    symlinks get a watch on the directory of their target as well, as writes to the target aren't seen through
+    the link.
+    """
+    file_mask = Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO | Inotify.IN_ATTRIB | Inotify.IN_CREATE
+
+    def __init__(self, loop, root, callback, debounce=0.2):
+        super().__init__(loop, root, callback, debounce)
+        self.inotify = None  # type: Inotify
+        self.directories = {}  # type: Dict[int, str]
+        self.link_targets = {}  # type: Dict[str, Set[str]]
+
+    def start(self):
+        self.inotify = Inotify()
+        try:
+            self.watch_tree(self.root)
+            self.loop.add_reader(self.inotify.fd, self._read)
+        except Exception:
+            self.inotify.close()
+            self.inotify = None
+            raise
+
+    def stop(self):
+        super().stop()
+        if self.inotify is not None:
+            self.loop.remove_reader(self.inotify.fd)
+            self.inotify.close()
+            self.inotify = None
+
+    def watch_tree(self, root: str):
+        for dir_path, dir_names, file_names in os.walk(root, followlinks=True):
+            dir_names[:] = [name for name in dir_names if name != '__pycache__']
+            self.directories[self.inotify.add_watch(dir_path, self.file_mask)] = dir_path
+            for name in file_names:
+                path = os.path.join(dir_path, name)
+                if name.endswith('.py') and os.path.islink(path):
+                    self.watch_link(path)
+
+    def watch_link(self, path: str):
+        target = os.path.realpath(path)
+        if path not in self.link_targets.setdefault(target, set()):
+            self.link_targets[target].add(path)
+            target_dir = os.path.dirname(target)
+            if target_dir not in self.directories.values():
+                self.directories[self.inotify.add_watch(target_dir, self.file_mask)] = target_dir
+
+    def _read(self):
+        for wd, mask, name in self.inotify.read_events():
+            if mask & Inotify.IN_Q_OVERFLOW:
+                logger.warning('inotify queue overflowed, some changes may have been missed')
+                continue
+            if mask & Inotify.IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+            directory = self.directories.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & Inotify.IN_ISDIR:
+                if mask & Inotify.IN_CREATE and name != '__pycache__':
+                    self.watch_tree(path)
+                continue
+            if not name.endswith('.py'):
+                continue
+            if path in self.link_targets:
+                for link in self.link_targets[path]:
+                    self.file_changed(link)
+            if path.startswith(self.root + os.sep):
+                if os.path.islink(path):
+                    self.watch_link(path)
+                self.file_changed(path)
+
+
+def create_watcher(loop: asyncio.AbstractEventLoop, root: str, callback: Callable[[Set[str]], None],
+                   debounce: float = 0.2) -> FileWatcher:
+    """Start inotify watcher if it's available, polling watcher otherwise"""
+    try:
+        watcher = InotifyWatcher(loop, root, callback, debounce)
+        watcher.start()
+        return watcher
+    # event loops that can't watch file descriptors (proactor) raise NotImplementedError from add_reader
+    except (OSError, NotImplementedError) as e:
+        logger.info('inotify is not available ({0}), polling for changes'.format(e))
+    watcher = PollingWatcher(loop, root, callback, debounce)
+    watcher.start()
+    return watcher
+
+
+def module_of_file(path: str, root: str = 'cogs') -> str:
+    """Name of the cog module a file belongs to: cogs/a.py -> cogs.a, cogs/b/c.py -> cogs.b
+
+    Returns None for files that don't belong to a cog
+    """
+    parts = os.path.relpath(path, root).split(os.sep)
+    if parts[0] in ('utils', os.pardir):
+        return None
+    return '{0}.{1}'.format(os.path.basename(root), os.path.splitext(parts[0])[0])
+
+
+FileState = namedtuple('FileState', 'size mtime digest')
+
+
+class ChangeDetector:
+    """Tells which files really changed
+
+    Files with unchanged size and modification time are skipped without reading them, files with only a new
+    modification time (e.g. touched or saved without changes) are compared by content hash.
+    """
+
+    def __init__(self, on_content: Callable[[str, bytes], None] = None, on_delete: Callable[[str], None] = None):
+        self.states = {}  # type: Dict[str, FileState]
+        self.on_content = on_content
+        self.on_delete = on_delete
+
+    def refresh(self, paths: Iterable[str]) -> Set[str]:
+        """Update state of paths, returns the ones that were created, deleted or had their content changed"""
+        changed = set()
+        for path in paths:
+            previous = self.states.get(path)
+            try:
+                stat = os.stat(path)
+                if previous is not None and (stat.st_size, stat.st_mtime) == previous[:2]:
+                    continue
+                with open(path, 'rb') as f:
+                    content = f.read()
+            except OSError:
+                if self.states.pop(path, None) is not None:
+                    changed.add(path)
+                    if self.on_delete is not None:
+                        self.on_delete(path)
+                continue
+            digest = hashlib.sha1(content).digest()
+            self.states[path] = FileState(len(content), stat.st_mtime, digest)
+            if previous is not None and previous.digest == digest:
+                logger.debug('{0} was modified without changing its content'.format(path))
+                continue
+            changed.add(path)
+            if self.on_content is not None:
+                self.on_content(path, content)
+        return changed
+
+
+class DependencyGraph:
+    """Imports between cog modules, collected from the source of their files"""
+
+    def __init__(self, root: str = 'cogs'):
+        self.root = root
+        self.package = os.path.basename(root)
+        self.imports = {}  # type: Dict[str, Set[str]]
+
+    def update_file(self, path: str, source: bytes):
+        try:
+            tree = ast.parse(source, path)
+        except (SyntaxError, ValueError) as e:
+            logger.debug('keeping previous imports of {0}, parsing failed: {1}'.format(path, e))
+            return
+        self.imports[path] = self.find_imports(path, tree)
+
+    def remove_file(self, path: str):
+        self.imports.pop(path, None)
+
+    def find_imports(self, path: str, tree: ast.AST) -> Set[str]:
+        """Cog modules imported by file"""
+        package = [self.package] + os.path.relpath(os.path.dirname(path), self.root).split(os.sep)
+        package = [part for part in package if part != os.curdir]
+        names = []
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names.extend(alias.name.split('.') for alias in node.names)
+            elif isinstance(node, ast.ImportFrom):
+                base = package[:len(package) - node.level + 1] if node.level else []
+                module = base + (node.module.split('.') if node.module else [])
+                if len(module) == 1:
+                    names.extend(module + [alias.name] for alias in node.names)
+                else:
+                    names.append(module)
+        return {'.'.join(name[:2]) for name in names
+                if len(name) > 1 and name[0] == self.package and name[1] != 'utils'}
+
+    def dependencies(self) -> Dict[str, Set[str]]:
+        """Modules imported by each module"""
+        dependencies = defaultdict(set)
+        for path, imported in self.imports.items():
+            module = module_of_file(path, self.root)
+            if module is not None:
+                dependencies[module].update(imported - {module})
+        return dependencies
+
+    def reload_order(self, modules: Iterable[str], loaded: Set[str] = None) -> List[str]:
+        """Modules that need reloading after `modules` changed, each of them once
+
+        These are the changed modules and modules that depend on them, directly or not (only those in `loaded`, when
+        it's given). Every module comes after the modules it imports, modules in an import cycle come last.
+        """
+        dependencies = self.dependencies()
+        dependents = defaultdict(set)
+        for module, imported in dependencies.items():
+            for dependency in imported:
+                dependents[dependency].add(module)
+
+        selected = set(modules)
+        visited = set(selected)
+        stack = list(selected)
+        while stack:
+            for dependent in dependents[stack.pop()] - visited:
+                visited.add(dependent)
+                stack.append(dependent)
+                if loaded is None or dependent in loaded:
+                    selected.add(dependent)
+
+        remaining = {module: dependencies.get(module, set()) & selected for module in selected}
+        ready = [module for module, imported in remaining.items() if not imported]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            module = heapq.heappop(ready)
+            order.append(module)
+            for dependent in dependents[module]:
+                imported = remaining.get(dependent)
+                if imported:
+                    imported.discard(module)
+                    if not imported:
+                        heapq.heappush(ready, dependent)
+        if len(order) < len(selected):
+            cyclic = sorted(selected.difference(order))
+            logger.warning('import cycle between modules {0}'.format(cyclic))
+            order.extend(cyclic)
+        return order
+
+
+class ModuleStats:
+    """Outcome counters and per-phase timings (in seconds) of reloads of a module"""
+
+    def __init__(self):
+        self.successes = 0
+        self.failures = 0
+        self.last_error = None  # type: str
+        self.last = {}  # type: Dict[str, float]
+        self.total = defaultdict(float)  # type: Dict[str, float]
+        self.slowest = defaultdict(float)  # type: Dict[str, float]
+        self.counts = defaultdict(int)  # type: Dict[str, int]
+
+    def record(self, timings: Dict[str, float], error: str = None):
+        if error is None:
+            self.successes += 1
+        else:
+            self.failures += 1
+            self.last_error = error
+        self.last = timings
+        for phase, seconds in timings.items():
+            self.total[phase] += seconds
+            self.counts[phase] += 1
+            self.slowest[phase] = max(self.slowest[phase], seconds)
+
+    def mean(self, phase: str) -> float:
+        return self.total[phase] / self.counts[phase] if self.counts[phase] else 0.0
+
+
+class ReloadStats:
+    """Timings of reloads: unload, import and setup phases per module, disabling commands per batch"""
+    phases = ('unload', 'import', 'setup')
+
+    def __init__(self):
+        self.modules = defaultdict(ModuleStats)  # type: Dict[str, ModuleStats]
+        self.batches = ModuleStats()
+
+    def record(self, module: str, timings: Dict[str, float], error: str = None):
+        self.modules[module].record(timings, error)
+
+    def record_batch(self, timings: Dict[str, float]):
+        self.batches.record(timings)
+
+    def slowest(self, count: int = None) -> List[Tuple[str, ModuleStats]]:
+        """Modules ordered by mean time of import and setup, slowest first"""
+        modules = sorted(self.modules.items(), key=lambda item: -(item[1].mean('import') + item[1].mean('setup')))
+        return modules[:count]
+
+    def format(self, count: int = 10) -> str:
+        lines = ['```', '{0:<30} {1:>4} {2:>4} {3:>10} {4:>10} {5:>10} {6:>10}'.format(
+            'module', 'ok', 'fail', 'import ms', 'max ms', 'setup ms', 'unload ms')]
+        errors = []
+        for module, stats in self.slowest(count):
+            lines.append('{0:<30} {1:>4} {2:>4} {3:>10.1f} {4:>10.1f} {5:>10.1f} {6:>10.1f}'.format(
+                module, stats.successes, stats.failures, stats.mean('import') * 1000, stats.slowest['import'] * 1000,
+                stats.mean('setup') * 1000, stats.mean('unload') * 1000))
+            if stats.last_error is not None:
+                errors.append('{0}: {1}'.format(module, stats.last_error[:100]))
+        lines.append('')
+        lines.append('batches: {0}, disabling commands: {1:.1f} ms mean, {2:.1f} ms max'.format(
+            self.batches.successes, self.batches.mean('commands') * 1000, self.batches.slowest['commands'] * 1000))
+        if errors:
+            lines.append('last errors:')
+            lines.extend(errors[:5])
+        lines.append('```')
+        return '\n'.join(lines)
+
+
+@contextmanager
+def timed_load_extension(bot, timings: Dict[str, float]):
+    """Record time spent in bot.load_extension (which calls setup of the cog, the module is already imported)
+    as 'setup' phase, while the Owner cog loads a cog"""
+    load_extension = bot.load_extension
+    shadowed = 'load_extension' in vars(bot)
+
+    def load_extension_timed(name):
+        start = time.perf_counter()
+        try:
+            load_extension(name)
+        finally:
+            timings['setup'] = time.perf_counter() - start
+
+    bot.load_extension = load_extension_timed
+    try:
+        yield
+    finally:
+        if shadowed:
+            bot.load_extension = load_extension
+        else:
+            del bot.load_extension
+
+
 class ModuleReloader:
     def __init__(self, bot):
         logger.debug('loading module')
         self.bot = bot
-        self.update_period = 1
-        self.prev = []
+        self.root = 'cogs'
+        self.debounce = 0.2
+        self.graph = DependencyGraph(self.root)
+        self.detector = ChangeDetector(self.graph.update_file, self.graph.remove_file)
+        self.detector.refresh(scan_files(self.root))
+        self.reload_lock = asyncio.Lock()
+        self.stats = ReloadStats()
+        self.watcher = None  # type: FileWatcher
 
-    async def reload_module(self, module):
-        try:
-            module = os.path.splitext(os.path.basename(module))[0]
-        except:
-            pass
-        if "cogs." not in module:
-            module = "cogs." + module
+    def __unload(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+
+    def start_watching(self):
+        self.watcher = create_watcher(self.bot.loop, self.root, self.files_changed, self.debounce)
+
+    def modified_modules(self, paths: Iterable[str]) -> List[str]:
+        """Modules of the files which content changed"""
+        changed = self.detector.refresh(paths)
+        return sorted({module_of_file(path, self.root) for path in changed} - {None})
+
+    def files_changed(self, paths: Set[str]):
+        modules = self.modified_modules(paths)
+        if modules:
+            logger.info('reloading modified cogs: {0}'.format(modules))
+            self.bot.loop.create_task(self.reload_modules(modules))
+
+    def _reload(self, module: str) -> bool:
         owner_cog = self.bot.get_cog('Owner')
         logger.debug("trying to reload module {0}".format(module))
+        timings = {}
+        start = time.perf_counter()
         try:
             owner_cog._unload_cog(module, reloading=True)
         except:
             pass
+        timings['unload'] = time.perf_counter() - start
 
+        error = None
+        start = time.perf_counter()
         try:
-            owner_cog._load_cog(module)
+            with timed_load_extension(self.bot, timings):
+                owner_cog._load_cog(module)
         except CogNotFoundError:
             logger.warn("module {0} cannot be found.".format(module))
+            error = 'module not found'
         except NoSetupError:
             logger.warn("module {0} does not have a setup function.".format(module))
+            error = 'no setup function'
         except CogLoadError as e:
-            logger.error("loading module {0} failed".format(module))
-            # logger.exception(e)
-            traceback.print_exc()
+            logger.error("loading module {0} failed".format(module), exc_info=True)
+            error = '{0}: {1}'.format(type(e.__cause__ or e).__name__, e)
+        except Exception as e:
+            # a failing module mustn't stop reloading of the rest of the batch
+            logger.error("reloading module {0} failed".format(module), exc_info=True)
+            error = '{0}: {1}'.format(type(e).__name__, e)
         else:
             set_cog(module, True)
-            await owner_cog.disable_commands()
-
-    def check_for_modifications(self):
-        cogs = glob.glob('cogs/*.py')
-        logger.debug('found files to check for modifiction: {0}'.format(cogs))
-        after = {f: os.stat(os.path.realpath(f)) for f in cogs}
-        if not self.prev:
-            self.prev = after
-            return []
-        modified = []
-        for f, stat in after.items():
-            if f in self.prev:
-                prev_stat = self.prev[f]
-                if stat.st_mtime != prev_stat.st_mtime:
-                    modified.append(f)
-        self.prev = after
-        return modified
-
-    async def reload_modules(self, modules):
-        for f in modules:
-            await self.reload_module(f)
-
-    async def update_scheduler(self):
-        while self == self.bot.get_cog('ModuleReloader'):
-            logger.debug('checking for modified cogs')
-            modified = self.check_for_modifications()
-            if modified:
-                logger.info('reloading modified cogs: {0}'.format(modified))
-                await self.reload_modules(modified)
-            await asyncio.sleep(self.update_period)
+        timings['import'] = time.perf_counter() - start - timings.get('setup', 0)
+        self.stats.record(module, timings, error)
+        logger.debug('reloaded module {0} in {1:.1f} ms'.format(module, sum(timings.values()) * 1000))
+        return error is None
+
+    async def disable_commands(self):
+        start = time.perf_counter()
+        await self.bot.get_cog('Owner').disable_commands()
+        self.stats.record_batch({'commands': time.perf_counter() - start})
+
+    async def reload_module(self, module):
+        if module.endswith('.py') or os.sep in module:
+            module = module_of_file(module, self.root) or module
+        if not module.startswith("cogs."):
+            module = "cogs." + module
+        async with self.reload_lock:
+            if self._reload(module):
+                await self.disable_commands()
+
+    def check_for_modifications(self) -> List[str]:
+        files = set(scan_files(self.root))
+        logger.debug('found files to check for modifiction: {0}'.format(list(files)))
+        return self.modified_modules(files.union(self.detector.states))
+
+    async def reload_modules(self, modules: Iterable[str]):
+        """Reload modules and modules that import them, each once, dependencies first"""
+        async with self.reload_lock:
+            order = self.graph.reload_order(modules, loaded=set(sys.modules))
+            logger.debug('reload order: {0}'.format(order))
+            reloaded = [module for module in order if self._reload(module)]
+            if reloaded:
+                await self.disable_commands()
 
     @commands.command(name='listcogs', pass_context=True)
     async def _list_cogs(self):
@@ -94,8 +595,13 @@ class ModuleReloader:
     async def reload_cmd(self, ctx, module):
         await self.reload_module(module)
 
+    @commands.command(name='reloadstats', pass_context=True)
+    async def reload_stats_cmd(self, ctx, count: int = 10):
+        """Show reload timings of the slowest cogs to import (at most 12)"""
+        await self.bot.say(self.stats.format(min(count, 12)))
+
 
 def setup(bot):
     mr = ModuleReloader(bot)
     bot.add_cog(mr)
-    bot.loop.create_task(mr.update_scheduler())
+    mr.start_watching()
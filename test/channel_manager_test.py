@@ -1,7 +1,43 @@
 import argparse
+import asyncio
+import json
+import os
+import random
+import logging
+import tempfile
 import unittest
+from collections import namedtuple
 
-from cogs.channel_manager import find_free_numbers
+import discord
+from discord import ChannelType
+from discord.http import Route
+
+from cogs.channel_manager import find_free_numbers, ReconcileScheduler, ChannelIndex, ChannelNameMatcher, \
+    plan_reconcile, PlannedChannel, RestExecutor, NumberAllocator, plan_channel_positions, Config, ConfigSaver, \
+    JsonStorage, JournalStorage, SqliteStorage, migrate_config, sqlite3, Variable, VariableRegistry, \
+    VariableNotInLevel, ChannelHandler, LazyArg, log_fields, ServerDebugFilter, StructuredFormatter, \
+    ActivityTracker, ChannelManager
+
+FakeServer = namedtuple('FakeServer', 'id')
+FakeResponse = namedtuple('FakeResponse', 'status reason headers')
+
+
+class FakeChannel:
+    def __init__(self, id, name, server, type=ChannelType.voice, position=0):
+        self.id = id
+        self.name = name
+        self.server = server
+        self.type = type
+        self.position = position
+        self.is_private = False
+        self.voice_members = []
+        self.user_limit = 0
+
+
+class FakeChannelServer:
+    def __init__(self, id, channels=None):
+        self.id = id
+        self.channels = channels if channels else []
 
 
 class TestUtils(unittest.TestCase):
@@ -29,5 +65,958 @@ class TestUtils(unittest.TestCase):
                                '-channel_timeout','1'])
         )
         #parser.print_help()
+
+
+class TestVariableRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = VariableRegistry([
+            Variable('count', int, 2, 'Some count', validator=lambda value: value >= 0),
+            Variable('timeout', float, 30, 'Some timeout', levels=('global',))
+        ])
+
+    def test_registry(self):
+        self.assertEqual({'count': 2, 'timeout': 30}, self.registry.defaults)
+        self.assertEqual(('count',), self.registry.server_names)
+        self.assertIn('count', self.registry.help)
+        self.assertNotIn('timeout', self.registry.help)
+        self.assertNotIn('other', self.registry)
+
+    def test_parse(self):
+        self.assertEqual(3, self.registry['count'].parse('3'))
+        self.assertEqual(1.5, self.registry['timeout'].parse('1.5'))
+        self.assertRaises(ValueError, self.registry['count'].parse, '-1')
+        self.assertRaises(ValueError, self.registry['count'].parse, 'a')
+        self.registry['count'].check_level('server')
+        self.assertRaises(VariableNotInLevel, self.registry['timeout'].check_level, 'server')
+
+
+class TestActivityTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.tracker = ActivityTracker(max_age=100, clock=lambda: self.now)
+
+    def test_active(self):
+        self.tracker.touch('1')
+        self.now = 30
+        self.tracker.touch('2')
+        self.now = 50
+        self.assertTrue(self.tracker.is_active('1', 60))
+        self.assertFalse(self.tracker.is_active('1', 40))
+        self.assertFalse(self.tracker.is_active('3', 60))
+        self.assertEqual({'2'}, self.tracker.active_channel_ids(40))
+        self.assertEqual({'1', '2'}, self.tracker.active_channel_ids(60))
+        self.tracker.touch('1')
+        self.assertEqual({'1'}, self.tracker.active_channel_ids(10))
+
+    def test_eviction(self):
+        for i in range(10):
+            self.now = i * 20
+            self.tracker.touch(str(i))
+        self.assertEqual([str(i) for i in range(4, 10)], list(self.tracker.last_activity))
+        self.tracker.forget('9')
+        self.tracker.forget('missing')
+        self.assertEqual(5, len(self.tracker))
+
+
+class TestNumberAllocator(unittest.TestCase):
+
+    def test_matches_find_free_numbers(self):
+        rnd = random.Random(0)
+        for _ in range(500):
+            numbers = rnd.sample(range(1, 40), rnd.randint(1, 20))
+            n_to_find = rnd.randint(0, 25)
+            expected = find_free_numbers(numbers, n_to_find)[:n_to_find]
+            self.assertEqual(expected, NumberAllocator(numbers).allocate(n_to_find), numbers)
+
+    def test_claim_release(self):
+        rnd = random.Random(1)
+        allocator = NumberAllocator()
+        used = set()
+        for _ in range(2000):
+            action = rnd.random()
+            if action < 0.3:
+                num = rnd.randint(1, 60)
+                allocator.claim(num)
+                used.add(num)
+            elif action < 0.6 and used:
+                num = rnd.choice(sorted(used))
+                allocator.release(num)
+                used.remove(num)
+            else:
+                n = rnd.randint(0, 3)
+                expected = find_free_numbers(list(used), n)[:n] if used else list(range(1, n + 1))
+                self.assertEqual(expected, allocator.allocate(n))
+                used.update(expected)
+
+    def test_large_number(self):
+        allocator = NumberAllocator([1, 10 ** 9])
+        self.assertEqual([2, 3], allocator.allocate(2))
+        allocator.release(1)
+        self.assertEqual([1, 4], allocator.allocate(2))
+
+
+class TestPlanChannelPositions(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeServer('1')
+
+    def make_channels(self, *positions):
+        return [FakeChannel(str(i), str(i), self.server, position=position) for i, position in enumerate(positions)]
+
+    @staticmethod
+    def apply(channels, payload):
+        positions = {channel.id: channel.position for channel in channels}
+        positions.update((change['id'], change['position']) for change in payload)
+        return positions
+
+    def test_in_order(self):
+        channels = self.make_channels(0, 1, 2, 5)
+        self.assertEqual([], plan_channel_positions(channels))
+
+    def test_new_channel_in_group(self):
+        # channel created at the end has to be moved after the first one, only the second one moves
+        a, b, new = self.make_channels(0, 1, 2)
+        self.assertEqual([{'id': b.id, 'position': 3}], plan_channel_positions([a, new, b]))
+
+    def test_move_to_front(self):
+        # there's no free position before the first channel, so it's cheaper to move the others after it
+        channels = self.make_channels(0, 1, 2, 3, 4)
+        self.assertEqual([{'id': '0', 'position': 5}, {'id': '1', 'position': 6},
+                          {'id': '2', 'position': 7}, {'id': '3', 'position': 8}],
+                         plan_channel_positions([channels[4]] + channels[:4]))
+
+    def test_random_orders(self):
+        rnd = random.Random(0)
+        for _ in range(300):
+            positions = rnd.sample(range(30), rnd.randint(1, 15))
+            channels = self.make_channels(*positions)
+            rnd.shuffle(channels)
+            payload = plan_channel_positions(channels)
+            positions = self.apply(channels, payload)
+            ordered = [channel.id for channel in channels]
+            self.assertEqual(ordered, sorted(ordered, key=lambda channel_id: positions[channel_id]))
+            self.assertEqual(len(channels), len(set(positions.values())))
+            self.assertTrue(all(position >= 0 for position in positions.values()))
+            self.assertLessEqual(len(payload), len(channels))
+
+
+class TestConfigSaver(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(self.tmp_dir.name, 'config.json')
+        self.config = Config(storage=JsonStorage(self.file_name))
+        self.saver = ConfigSaver(self.loop, self.config, delay=0.02)
+
+    def tearDown(self):
+        self.loop.close()
+        self.tmp_dir.cleanup()
+
+    def read(self):
+        with open(self.file_name) as config_file:
+            return json.load(config_file)
+
+    def test_coalesce(self):
+        async def changes():
+            for i in range(10):
+                self.config.set_var('var', i, [str(i)])
+                self.saver.mark_dirty()
+            await asyncio.sleep(0.1)
+
+        self.loop.run_until_complete(changes())
+        self.assertEqual(1, self.saver.writes)
+        self.assertEqual({'var': 9}, self.read()['9'])
+        self.assertEqual([], [name for name in os.listdir(self.tmp_dir.name) if name.endswith('.tmp')])
+
+    def test_flush_now(self):
+        self.config.set_var('var', 1)
+        self.saver.mark_dirty()
+        self.saver.flush_now()
+        self.assertEqual({'': {'var': 1}}, self.read())
+        self.saver.flush_now()
+        self.assertEqual(1, self.saver.writes)
+
+    def test_retry(self):
+        storage = self.config.storage
+        write = storage.write
+        attempts = []
+
+        def failing_write(payload):
+            attempts.append(self.loop.time())
+            if len(attempts) < 3:
+                raise OSError('disk full')
+            write(payload)
+
+        storage.write = failing_write
+        self.config.set_var('var', 1)
+        self.saver.mark_dirty()
+        with self.assertLogs('red.channel_manager', 'ERROR'):
+            self.loop.run_until_complete(asyncio.sleep(0.3))
+        self.assertEqual(3, len(attempts))
+        self.assertEqual({'': {'var': 1}}, self.read())
+        self.assertFalse(self.saver.dirty)
+        self.assertGreater(attempts[2] - attempts[1], attempts[1] - attempts[0])
+        self.assertEqual(self.saver.delay, self.saver.retry_delay)
+
+
+class FakeMessageBot:
+    def __init__(self):
+        self.cog = None
+        self.messages = []
+
+    def get_cog(self, name):
+        return self.cog
+
+    async def send_message(self, destination, content):
+        self.messages.append(content)
+
+
+class TestChannelHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.bot = FakeMessageBot()
+        self.bot.cog = object()
+        self.handler = ChannelHandler(self.bot, self.bot.cog, 'cog', 'channel', max_records=50, max_age=0.05)
+        self.logger = logging.getLogger('test.channel_handler')
+        self.logger.propagate = False
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.loop.close()
+
+    def run_task(self, duration):
+        async def run():
+            task = self.loop.create_task(self.handler.update_task())
+            await asyncio.sleep(duration)
+            self.bot.cog = None
+            await task
+        self.loop.run_until_complete(run())
+
+    def test_batching(self):
+        for i in range(30):
+            self.logger.warning('record %d', i)
+        self.run_task(0.15)
+        self.assertEqual(1, len(self.bot.messages))
+        self.assertEqual('```\n' + '\n'.join('record {0}'.format(i) for i in range(30)) + '\n```',
+                         self.bot.messages[0])
+
+    def test_drop_oldest(self):
+        for i in range(60):
+            self.logger.warning('record %d', i)
+        self.assertEqual(10, self.handler.dropped)
+        self.run_task(0.15)
+        lines = ''.join(self.bot.messages).split('\n')
+        self.assertEqual('10 log records were dropped', lines[1])
+        self.assertEqual('record 10', lines[2])
+        self.assertEqual(0, self.handler.buffered_size)
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestLogging(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger('test.channel_manager_logging')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.WARNING)
+        self.handler = RecordingHandler()
+        self.logger.addHandler(self.handler)
+        self.log_filter = ServerDebugFilter(self.logger)
+        self.logger.addFilter(self.log_filter)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.logger.removeFilter(self.log_filter)
+
+    def test_server_debug(self):
+        evaluated = []
+        arg = LazyArg(lambda: evaluated.append(1) or 'value')
+        self.logger.debug('message %s', arg, extra=log_fields(FakeServer('1')))
+        self.assertEqual([], self.handler.records)
+
+        self.log_filter.set_server_debug('1', True)
+        self.assertEqual(logging.DEBUG, self.logger.level)
+        self.logger.debug('message %s', arg, extra=log_fields(FakeServer('1')))
+        self.logger.debug('message %s', arg, extra=log_fields(FakeServer('2')))
+        self.logger.debug('message %s', arg)
+        self.logger.warning('warning')
+        self.assertEqual(['message value', 'warning'], [record.getMessage() for record in self.handler.records])
+        self.assertEqual(1, len(evaluated))
+
+        self.log_filter.set_server_debug('1', False)
+        self.assertEqual(logging.WARNING, self.logger.level)
+
+    def test_structured_formatter(self):
+        self.handler.setFormatter(StructuredFormatter('%(levelname)s %(message)s'))
+        self.logger.warning('moved %d channels', 2, extra=log_fields(FakeServer('1'), channel='3', count=2))
+        self.assertEqual("WARNING moved 2 channels channel='3' count=2", self.handler.format(self.handler.records[0]))
+
+
+class TestJournalStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(self.tmp_dir.name, 'config.json')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def save(self, config, compact=False):
+        config.storage.write(config.storage.prepare_save(config.data, compact=compact))
+
+    def load(self, compact_size=1024):
+        storage = JournalStorage(self.file_name, compact_size=compact_size)
+        return Config(data=storage.load(), storage=storage)
+
+    def test_replay(self):
+        config = Config(storage=JournalStorage(self.file_name))
+        self.assertIsNone(config.storage.load())
+        config.set_var('var1', 1)
+        config.set_var('var2', ['ä', 'ß'], ['a', 'b'])
+        self.save(config)
+        config.set_var('var1', 2)
+        config.delete_var(['a', 'b'], 'var2')
+        config.set_var('var3', {'x': 'y'}, ['a'])
+        self.save(config)
+        self.assertFalse(os.path.exists(self.file_name))
+        self.assertEqual(os.path.getsize(self.file_name + '.journal'), config.storage.journal_size)
+
+        loaded = self.load()
+        self.assertEqual(dict(config.data), dict(loaded.data))
+        self.assertEqual(2, loaded.get_var('var1'))
+
+    def test_compaction(self):
+        config = self.load(compact_size=200)
+        for i in range(20):
+            config.set_var('var', i, [str(i)])
+            self.save(config)
+        self.assertLess(os.path.getsize(self.file_name + '.journal'), 200)
+        self.assertTrue(os.path.exists(self.file_name))
+        self.assertEqual(dict(config.data), dict(self.load().data))
+
+    def test_torn_record(self):
+        config = self.load()
+        config.set_var('var', 1)
+        config.set_var('var', 2)
+        self.save(config)
+        with open(self.file_name + '.journal', 'ab') as journal:
+            journal.write(b'["set", "", "var", 3')
+
+        loaded = self.load()
+        self.assertEqual(2, loaded.get_var('var'))
+        loaded.set_var('var', 4)
+        self.save(loaded)
+        self.assertEqual(4, self.load().get_var('var'))
+
+
+@unittest.skipIf(sqlite3 is None, 'sqlite3 is not available')
+class TestSqliteStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(self.tmp_dir.name, 'config.json')
+        self.config = Config(storage=SqliteStorage(self.file_name))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def save(self, compact=False):
+        storage = self.config.storage
+        storage.write(storage.prepare_save(self.config.data, compact=compact))
+
+    def test_save_load(self):
+        self.assertIsNone(self.config.storage.load())
+        self.config.set_var('var1', 1)
+        self.config.set_var('var2', {'a': [1, 2]}, ['1', 'group'])
+        self.config.set_var('var3', 'x', ['1'])
+        self.save()
+        self.config.set_var('var1', 2)
+        self.config.delete_var(['1'], 'var3')
+        self.save()
+        # locations without variables have no rows
+        self.assertEqual({'': {'var1': 2}, os.path.join('1', 'group'): {'var2': {'a': [1, 2]}}},
+                         SqliteStorage(self.file_name).load())
+
+    def test_migrate(self):
+        json_config = Config(storage=JsonStorage(self.file_name))
+        json_config.set_var('var', 1, ['1'])
+        json_config.storage.write(json_config.storage.prepare_save(json_config.data))
+        self.assertEqual({'1': {'var': 1}}, migrate_config(JsonStorage(self.file_name), self.config.storage))
+        self.assertEqual({'1': {'var': 1}}, SqliteStorage(self.file_name).load())
+        self.assertIsNone(migrate_config(JsonStorage(self.file_name + '.missing'), self.config.storage))
+
+    def test_lazy_load(self):
+        self.config.set_var('var', 0)
+        self.config.set_var('var', 1, ['1'])
+        self.config.set_var('var', 2, ['1', 'group'])
+        self.config.set_var('var', 10, ['10'])
+        self.config.set_var('var', 3, ['2'])
+        self.save()
+
+        storage = SqliteStorage(self.file_name)
+        self.assertEqual({'1': {'var': 1}, os.path.join('1', 'group'): {'var': 2}}, storage.load_subtree('1'))
+        config = Config(data=storage.load_root(), storage=storage)
+        self.assertEqual({'': {'var': 0}}, dict(config.data))
+        self.assertEqual(2, config.get_var('var', ['1', 'group', 'x']))
+        self.assertEqual({'', '1', os.path.join('1', 'group')}, set(config.data))
+        config.set_var('var', 4, ['2', 'group'])
+        self.assertEqual(3, config.get_var('var', ['2']))
+
+        config.load_all()
+        self.assertEqual(10, config.get_var('var', ['10']))
+        self.assertEqual(4, config.get_var('var', ['2', 'group']))
+        self.assertIsNone(config.loaded)
+
+    def test_compact_keeps_unloaded_levels(self):
+        self.config.set_var('var', 1, ['1'])
+        self.save()
+        storage = SqliteStorage(self.file_name)
+        config = Config(data=storage.load_root(), storage=storage)
+        config.set_var('var', 2)
+        loop = asyncio.new_event_loop()
+        try:
+            ConfigSaver(loop, config).flush_now(compact=True)
+        finally:
+            loop.close()
+        self.assertEqual({'': {'var': 2}, '1': {'var': 1}}, storage.load())
+
+
+class TestReconcileScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.reconciled = []
+
+    def tearDown(self):
+        self.loop.close()
+
+    async def reconcile(self, server):
+        self.reconciled.append((server.id, self.loop.time()))
+
+    def test_burst_is_coalesced(self):
+        scheduler = ReconcileScheduler(self.loop, self.reconcile, lambda server: (0.05, 1))
+        server = FakeServer('1')
+
+        async def burst():
+            for i in range(20):
+                scheduler.request(server)
+                await asyncio.sleep(0.001)
+            await asyncio.sleep(0.1)
+
+        self.loop.run_until_complete(burst())
+        self.assertEqual(1, len(self.reconciled))
+        self.assertEqual(20, scheduler.events_received['1'])
+        self.assertEqual(1, scheduler.reconciles_executed['1'])
+
+    def test_max_latency(self):
+        scheduler = ReconcileScheduler(self.loop, self.reconcile, lambda server: (0.05, 0.1))
+        server = FakeServer('1')
+
+        async def constant_activity():
+            start = self.loop.time()
+            while self.loop.time() - start < 0.35:
+                scheduler.request(server)
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.1)
+            return start
+
+        start = self.loop.run_until_complete(constant_activity())
+        self.assertGreaterEqual(len(self.reconciled), 2)
+        self.assertLess(self.reconciled[0][1] - start, 0.15)
+
+    def test_servers_are_independent(self):
+        scheduler = ReconcileScheduler(self.loop, self.reconcile, lambda server: (0.01, 1))
+
+        async def requests():
+            scheduler.request(FakeServer('1'))
+            scheduler.request(FakeServer('2'))
+            scheduler.request(FakeServer('1'))
+            await asyncio.sleep(0.05)
+
+        self.loop.run_until_complete(requests())
+        self.assertEqual(['1', '2'], sorted(server_id for server_id, _ in self.reconciled))
+
+    def test_timeout_keeps_reconcile_running(self):
+        finished = []
+
+        async def slow_reconcile(server):
+            await asyncio.sleep(0.05)
+            finished.append(server.id)
+
+        scheduler = ReconcileScheduler(self.loop, slow_reconcile, lambda server: (0.01, 1))
+        server = FakeServer('1')
+
+        async def reconcile():
+            with self.assertRaises(asyncio.TimeoutError):
+                await scheduler.reconcile(server, 0.01)
+            self.assertTrue(scheduler.locks['1'].locked())
+            await asyncio.sleep(0.1)
+
+        self.loop.run_until_complete(reconcile())
+        self.assertEqual(['1'], finished)
+        self.assertFalse(scheduler.locks['1'].locked())
+
+
+class FakeManagerBot:
+    def __init__(self, loop):
+        self.loop = loop
+        self.http = FakeHTTP(loop)
+        self.messages = []
+
+    def get_channel(self, channel_id):
+        return None
+
+    async def say(self, content):
+        self.messages.append(str(content))
+
+    def get_cog(self, name):
+        return None
+
+
+class ChannelManagerTestCase(unittest.TestCase):
+    """Runs the cog in a temporary working directory, its data lives under data/channel_manager"""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir.name)
+        os.makedirs(os.path.join('data', 'channel_manager'))
+        self.cm = None
+
+    def tearDown(self):
+        if self.cm is not None:
+            self.cm._ChannelManager__unload()
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def load_cog(self):
+        self.cm = ChannelManager(FakeManagerBot(self.loop))
+        return self.cm
+
+
+@unittest.skipIf(sqlite3 is None, 'sqlite3 is not available')
+class TestConfigMigration(ChannelManagerTestCase):
+
+    def test_empty_database_is_migrated(self):
+        with open(os.path.join('data', 'channel_manager', 'settings.json'), 'w') as settings_file:
+            json.dump({'config_storage': 'sqlite'}, settings_file)
+        with open(os.path.join('data', 'channel_manager', 'config.json'), 'w') as config_file:
+            json.dump({'1': {'min_empty_channels': 5}}, config_file)
+        storage = SqliteStorage(os.path.join('data', 'channel_manager', 'config.json'))
+        storage.connect().close()
+        self.assertEqual({}, storage.load())
+
+        self.assertEqual(5, self.load_cog().config.get_var('min_empty_channels', ['1']))
+        self.assertEqual({'1': {'min_empty_channels': 5}}, storage.load())
+
+
+    def test_migrate_command(self):
+        cm = self.load_cog()
+        cm.config.set_var('min_empty_channels', 3, ['1'])
+        cm.saver.flush_now(compact=True)
+        cm.settings['config_storage'] = 'sqlite'
+        cm.config.storage = cm.create_storage('sqlite')
+        cm.config.reset({})
+        cm.bot.messages.clear()
+
+        self.loop.run_until_complete(ChannelManager.migrate_storage.callback(cm, None, 'json'))
+        self.assertEqual(["configuration was migrated from 'json' storage"], cm.bot.messages)
+        self.assertEqual(3, cm.config.get_var('min_empty_channels', ['1']))
+        self.assertEqual({'1': {'min_empty_channels': 3}}, cm.config.storage.load_subtree('1'))
+
+
+class TestVariableCommands(ChannelManagerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.load_cog()
+        self.server = FakeServer('1')
+        self.ctx = namedtuple('Context', 'message')(namedtuple('Message', 'server')(self.server))
+
+    def run_command(self, command, *args):
+        self.cm.bot.messages.clear()
+        self.loop.run_until_complete(command.callback(self.cm, self.ctx, *args))
+        return self.cm.bot.messages
+
+    def test_set(self):
+        self.assertEqual(['setting min_empty_channels = 3'],
+                         self.run_command(ChannelManager._cm_set, 'min_empty_channels', '3'))
+        self.assertEqual(3, self.cm.variables['min_empty_channels'].get_server(self.server))
+        self.assertEqual(2, self.cm.variables['min_empty_channels'].get())
+        self.run_command(ChannelManager._cm_set, 'min_empty_channels', '-1')
+        self.run_command(ChannelManager._cm_set, 'max_concurrent_servers', '3')
+        self.assertEqual(3, self.cm.variables['min_empty_channels'].get_server(self.server))
+        self.assertEqual(10, self.cm.config.get_var('max_concurrent_servers', [self.server.id]))
+
+    def test_get(self):
+        self.cm.config.set_var('channel_groups', ['a'], [self.server.id])
+        self.assertEqual(["channel_groups = ['a']"], self.run_command(ChannelManager._cm_get, 'channel_groups'))
+        self.assertEqual(['min_empty_channels = 2'], self.run_command(ChannelManager._cm_get, 'min_empty_channels'))
+        self.assertIn('min_empty_channels', self.run_command(ChannelManager._cm_get)[0])
+
+
+class TestGroupCommands(ChannelManagerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.load_cog()
+        self.server = FakeChannelServer('1')
+        self.server.name = 'server'
+        self.server.channels = [FakeChannel(str(i), 'Squad #{0}'.format(i), self.server) for i in (1, 2)]
+
+    def test_add_group_requests_reconcile(self):
+        self.loop.run_until_complete(self.cm.add_group(self.server, 'Squad'))
+        self.assertEqual(['Squad'], self.cm.config.get_var('channel_groups', [self.server.id]))
+        self.assertIn(self.server.id, self.cm.reconciler.pending)
+
+    def test_remove_group_of_unindexed_server(self):
+        self.cm.config.set_var('channel_groups', ['Squad'], [self.server.id])
+        self.loop.run_until_complete(self.cm.remove_group(self.server, 'Squad'))
+        self.assertEqual([], self.cm.config.get_var('channel_groups', [self.server.id]))
+        self.assertEqual(['/channels/1', '/channels/2'],
+                         sorted(url[-len('/channels/1'):] for method, url, _ in self.cm.bot.http.requests
+                                if method == 'DELETE'))
+
+
+class TestUpdateServers(ChannelManagerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.load_cog().reconciler.reconcile_fun = self.reconcile
+        self.delays = {}
+        self.running = 0
+        self.max_running = 0
+
+    async def reconcile(self, server):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(self.delays.get(server.id, 0.01))
+        self.running -= 1
+
+    def test_concurrency_bound(self):
+        self.cm.config.set_var('max_concurrent_servers', 2)
+        servers = [FakeServer(str(i)) for i in range(5)]
+        self.loop.run_until_complete(self.cm.update_servers(servers))
+        self.assertEqual(2, self.max_running)
+        self.assertEqual({server.id for server in servers}, set(self.cm.server_latencies))
+
+    def test_timeout(self):
+        self.cm.config.set_var('server_update_timeout', 0.03)
+        self.delays['1'] = 0.1
+        servers = [FakeServer('1'), FakeServer('2')]
+
+        async def update():
+            # waiting for the reconcile in progress doesn't count towards the timeout
+            async with self.cm.reconciler.locks['2']:
+                update = self.loop.create_task(self.cm.update_servers(servers))
+                await asyncio.sleep(0.05)
+            await update
+            self.assertEqual(1, self.running)
+            await asyncio.sleep(0.1)
+
+        self.loop.run_until_complete(update())
+        self.assertEqual({'1': 1}, self.cm.server_timeouts)
+        self.assertEqual(0, self.running)
+
+        self.loop.run_until_complete(self.cm.update_servers(servers[1:]))
+        self.assertEqual({}, self.cm.server_timeouts)
+        self.assertEqual({'2'}, set(self.cm.server_latencies))
+
+
+class TestChannelNameMatcher(unittest.TestCase):
+
+    def test_match(self):
+        matcher = ChannelNameMatcher(['Squad', 'Squad Alpha', 'a.b (c)'])
+        self.assertEqual(('Squad', 12), matcher.match('Squad #12'))
+        self.assertEqual(('Squad', 3), matcher.match('Squad   #3 extra'))
+        self.assertEqual(('Squad Alpha', 1), matcher.match('Squad Alpha #1'))
+        self.assertEqual(('a.b (c)', 2), matcher.match('a.b (c) #2'))
+        self.assertIsNone(matcher.match('axb (c) #2'))
+        self.assertIsNone(matcher.match('Squad #'))
+        self.assertIsNone(matcher.match('Squad Beta #1'))
+        self.assertIsNone(matcher.match('General'))
+
+    def test_no_groups(self):
+        self.assertIsNone(ChannelNameMatcher([]).match(' #1'))
+
+
+class TestChannelIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeChannelServer('1')
+        names = ['General', 'Squad #1', 'Squad #2', 'Squad Alpha #1', 'Raid #3', 'Raid #x']
+        self.server.channels = [FakeChannel(str(i), name, self.server) for i, name in enumerate(names)]
+        self.server.channels.append(FakeChannel('text', 'Squad #3', self.server, type=ChannelType.text))
+        self.index = ChannelIndex()
+        self.index.rebuild(self.server, ['Squad', 'Raid'])
+
+    def group_names(self, group_name):
+        return {num: channel.name for num, channel in self.index.get_group(self.server, group_name).items()}
+
+    def test_rebuild(self):
+        self.assertEqual({1: 'Squad #1', 2: 'Squad #2'}, self.group_names('Squad'))
+        self.assertEqual({3: 'Raid #3'}, self.group_names('Raid'))
+        self.assertEqual(('Squad', 2), self.index.lookup(self.server.channels[2]))
+        self.assertIsNone(self.index.lookup(self.server.channels[0]))
+        self.assertFalse(self.index.rebuild(self.server, ['Squad', 'Raid']))
+
+    def test_channel_events(self):
+        channel = FakeChannel('new', 'Raid #1', self.server)
+        self.server.channels.append(channel)
+        self.index.add_channel(channel)
+        self.assertEqual({1: 'Raid #1', 3: 'Raid #3'}, self.group_names('Raid'))
+
+        channel.name = 'Squad #4'
+        self.index.update_channel(channel)
+        self.assertEqual({3: 'Raid #3'}, self.group_names('Raid'))
+        self.assertEqual({1: 'Squad #1', 2: 'Squad #2', 4: 'Squad #4'}, self.group_names('Squad'))
+
+        self.server.channels.remove(channel)
+        self.index.remove_channel(channel)
+        self.assertEqual({1: 'Squad #1', 2: 'Squad #2'}, self.group_names('Squad'))
+        self.assertFalse(self.index.rebuild(self.server, ['Squad', 'Raid']))
+
+    def test_created_channel_keeps_members(self):
+        groups = ['Squad']
+        for gateway_first in (True, False):
+            self.index.rebuild(self.server, groups)
+            live = FakeChannel('new', 'Squad #3', self.server)
+            live.voice_members = ['user']
+            detached = FakeChannel('new', 'Squad #3', self.server)
+            if gateway_first:
+                self.index.add_channel(live)
+                self.index.add_channel(detached)
+            else:
+                self.index.add_channel(detached)
+                self.index.update_channel(live)
+            self.assertIs(live, self.index.get_group(self.server, 'Squad')[3])
+            channels = [channel for channel in self.server.channels if channel.type == ChannelType.voice] + [live]
+            plan = plan_reconcile(channels, {'Squad': self.index.get_group(self.server, 'Squad')}, 1,
+                                  lambda channel: False)
+            self.assertNotIn(live, plan.deletes)
+            self.assertEqual(1, len(plan.deletes))
+            self.index.remove_channel(live)
+
+    def test_groups(self):
+        self.index.add_group(self.server, 'Squad Alpha')
+        self.assertEqual({1: 'Squad Alpha #1'}, self.group_names('Squad Alpha'))
+        self.index.remove_group(self.server, 'Squad')
+        self.assertEqual({}, self.group_names('Squad'))
+        self.assertIsNone(self.index.lookup(self.server.channels[1]))
+
+    def test_rebuild_detects_drift(self):
+        self.server.channels.append(FakeChannel('missed', 'Raid #4', self.server))
+        self.assertTrue(self.index.rebuild(self.server, ['Squad', 'Raid']))
+        self.assertEqual({3: 'Raid #3', 4: 'Raid #4'}, self.group_names('Raid'))
+
+
+class TestPlanReconcile(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeChannelServer('1')
+
+    def make_channels(self, *names):
+        channels = [FakeChannel(name, name, self.server, position=i) for i, name in enumerate(names)]
+        self.server.channels = channels
+        return channels
+
+    def plan(self, groups, min_empty=2, active=()):
+        index = ChannelIndex()
+        index.rebuild(self.server, groups)
+        return plan_reconcile(self.server.channels, {group: index.get_group(self.server, group) for group in groups},
+                              min_empty, lambda channel: channel.name in active)
+
+    @staticmethod
+    def names(channels):
+        return [channel.name for channel in channels]
+
+    def test_up_to_date(self):
+        self.make_channels('General', 'Squad #1', 'Squad #2', 'AFK')
+        plan = self.plan(['Squad'])
+        self.assertTrue(plan.is_empty())
+
+    def test_empty_group(self):
+        self.make_channels('General')
+        plan = self.plan(['Squad'])
+        self.assertEqual([PlannedChannel('Squad', 1, 'Squad #1', 0)], plan.creates)
+        self.assertFalse(plan.order_changed)
+
+    def test_create(self):
+        channels = self.make_channels('Squad #1', 'General', 'Squad #4', 'Squad #2')
+        channels[0].voice_members = ['user']
+        channels[0].user_limit = 5
+        channels[2].voice_members = ['user']
+        plan = self.plan(['Squad'], min_empty=3)
+        self.assertEqual([('Squad #3', 5), ('Squad #5', 5)], [(planned.name, planned.user_limit)
+                                                              for planned in plan.creates])
+        self.assertEqual(['Squad #4', 'Squad #2'], [channel.name for channel, limit in plan.user_limit_edits])
+        self.assertEqual(['Squad #1', 'Squad #2', 'Squad #3', 'Squad #4', 'Squad #5', 'General'],
+                         self.names(plan.order))
+        self.assertTrue(plan.order_changed)
+
+    def test_delete(self):
+        self.make_channels('Squad #1', 'Squad #2', 'Squad #3', 'Squad #4', 'General')
+        plan = self.plan(['Squad'], active=['Squad #4'])
+        self.assertEqual(['Squad #3'], self.names(plan.deletes))
+        self.assertEqual([], plan.creates)
+        self.assertEqual(['Squad #1', 'Squad #2', 'Squad #4', 'General'], self.names(plan.order))
+        self.assertFalse(plan.order_changed)
+
+    def test_order(self):
+        self.make_channels('Raid #2', 'General', 'Squad #2', 'Raid #1', 'AFK', 'Squad #1')
+        plan = self.plan(['Squad', 'Raid'])
+        self.assertEqual([], plan.creates)
+        self.assertEqual([], plan.deletes)
+        self.assertEqual(['General', 'Raid #1', 'Raid #2', 'AFK', 'Squad #1', 'Squad #2'], self.names(plan.order))
+        self.assertTrue(plan.order_changed)
+
+
+class FakeHTTP:
+    """Offline stand-in for discord's HTTPClient, allows `limit` requests per bucket every `period` seconds
+
+    Like discord's client, it waits out rate limits itself and gives up after `tries` attempts.
+    """
+
+    def __init__(self, loop, limit=2, period=0.05, latency=0.001, tries=5):
+        self.loop = loop
+        self.limit = limit
+        self.period = period
+        self.latency = latency
+        self.tries = tries
+        self.windows = {}
+        self.requests = []
+        self.errors = {}
+        self.rate_limited = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def request(self, route, json=None):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return await self._request(route, json)
+        finally:
+            self.in_flight -= 1
+
+    async def _request(self, route, json):
+        for attempt in range(self.tries):
+            await asyncio.sleep(self.latency)
+            if route.url in self.errors:
+                raise discord.HTTPException(FakeResponse(self.errors[route.url], 'Error', {}), 'error')
+            now = self.loop.time()
+            start, count = self.windows.get(route.bucket, (now, 0))
+            if now - start >= self.period:
+                start, count = now, 0
+            if count < self.limit:
+                self.windows[route.bucket] = (start, count + 1)
+                self.requests.append((route.method, route.url, json))
+                return {'id': str(len(self.requests))}
+            self.rate_limited += 1
+            if attempt + 1 < self.tries:
+                await asyncio.sleep(self.period - (now - start))
+        raise discord.HTTPException(FakeResponse(429, 'Too Many Requests', {}), 'You are being rate limited.')
+
+
+class TestRestExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.http = FakeHTTP(self.loop)
+        self.executor = RestExecutor(self.loop, self.http)
+        self.server = FakeServer('1')
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_rate_limit(self):
+        futures = [self.executor.create_channel(self.server, 'Squad #{0}'.format(i)) for i in range(5)]
+        results = self.loop.run_until_complete(asyncio.gather(*futures))
+        self.assertEqual(['1', '2', '3', '4', '5'], sorted(result['id'] for result in results))
+        self.assertEqual(['Squad #{0}'.format(i) for i in range(5)], sorted(payload['name']
+                                                                            for _, _, payload in self.http.requests))
+        self.assertGreater(self.http.rate_limited, 0)
+        self.assertEqual(5, self.executor.stats['sent'])
+        self.assertEqual(0, self.executor.stats['failed'])
+
+    def test_rate_limit_gives_up(self):
+        self.http.tries = 1
+        futures = [self.executor.create_channel(self.server, 'Squad #{0}'.format(i)) for i in range(3)]
+        results = self.loop.run_until_complete(asyncio.gather(*futures, return_exceptions=True))
+        self.assertIsInstance(results[2], discord.HTTPException)
+        self.assertEqual(3, self.executor.stats['sent'])
+        self.assertEqual(1, self.executor.stats['rate_limited'])
+        self.assertEqual(1, self.executor.stats['failed'])
+
+    def test_rate_limit_pauses_bucket(self):
+        self.executor = RestExecutor(self.loop, self.http, max_in_flight=1, max_backoff=0.1)
+        self.http.tries = 1
+        self.http.limit = 1
+        futures = [self.executor.create_channel(self.server, 'Squad #{0}'.format(i)) for i in range(3)]
+        start = self.loop.time()
+        results = self.loop.run_until_complete(asyncio.gather(*futures, return_exceptions=True))
+        self.assertIsInstance(results[1], discord.HTTPException)
+        self.assertEqual('2', results[2]['id'])
+        self.assertGreaterEqual(self.loop.time() - start, 0.1)
+
+    def test_parallel_requests(self):
+        self.http.limit = 10
+        self.http.latency = 0.01
+        futures = [self.executor.create_channel(self.server, 'Squad #{0}'.format(i)) for i in range(4)]
+        futures.append(self.executor.move_channels(self.server, [{'id': 'a', 'position': 0}]))
+        futures.append(self.executor.move_channels(self.server, [{'id': 'a', 'position': 1}]))
+        self.loop.run_until_complete(asyncio.gather(*futures))
+        self.assertEqual(5, self.http.max_in_flight)
+        self.assertEqual({}, self.executor.buckets)
+
+    def test_supersede(self):
+        async def move():
+            futures = [self.executor.move_channels(self.server, [{'id': 'a', 'position': 0}])]
+            await asyncio.sleep(0)
+            # first request is in flight now, queued ones are superseded by the last one
+            for i in range(1, 4):
+                futures.append(self.executor.move_channels(self.server, [{'id': 'a', 'position': i}]))
+            return await asyncio.gather(*futures)
+
+        results = self.loop.run_until_complete(move())
+        self.assertEqual([0, 3], [payload[0]['position'] for _, _, payload in self.http.requests])
+        self.assertEqual(['1', '2', '2', '2'], [result['id'] for result in results])
+        self.assertEqual(2, self.executor.stats['superseded'])
+
+    def test_error(self):
+        channel = FakeChannel('2', 'Squad #1', self.server)
+        self.http.errors[Route('DELETE', '/channels/{channel_id}', channel_id='2').url] = 404
+        with self.assertRaises(discord.HTTPException):
+            self.loop.run_until_complete(self.executor.delete_channel(channel))
+        self.assertEqual(1, self.executor.stats['failed'])
+
+    def test_cancel(self):
+        async def cancel():
+            futures = [self.executor.create_channel(self.server, 'Squad #{0}'.format(i)) for i in range(3)]
+            await asyncio.sleep(0)
+            self.executor.cancel()
+            await asyncio.sleep(0.01)
+            return futures
+
+        futures = self.loop.run_until_complete(cancel())
+        self.assertTrue(all(future.cancelled() for future in futures))
+        self.assertEqual({}, self.executor.buckets)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -3,7 +3,7 @@ import os
 import unittest
 
 
-from cogs.config import Config
+from cogs.hierarchical_config import Config
 
 
 class TestSettings(unittest.TestCase):
@@ -68,6 +68,39 @@ class TestSettings(unittest.TestCase):
 
         self.assertEquals(config, loaded_config)
 
+    def testCache(self):
+        config = Config(defaults={'name': 'default'})
+        config.set_var('name', 'v_root', [])
+        config.set_var('name', 'v_a', ['a'])
+
+        self.assertEqual('v_a', config.get_var('name', ['a', 'b']))
+        self.assertEqual('v_a', config.get_var('name', ['a', 'b']))
+        self.assertEqual('v_root', config.get_var('name', ['c']))
+        self.assertEqual((1, 2), config.cache_info()[:2])
+
+        # setting value at a deeper level invalidates only paths below it
+        config.set_var('name', 'v_ab', ['a', 'b'])
+        self.assertEqual('v_ab', config.get_var('name', ['a', 'b']))
+        self.assertEqual('v_root', config.get_var('name', ['c']))
+        self.assertEqual((2, 3), config.cache_info()[:2])
+
+        # setting value at a lower level invalidates everything above it
+        config.set_var('name', 'v_root2', [])
+        self.assertEqual('v_root2', config.get_var('name', ['c']))
+        self.assertEqual('v_ab', config.get_var('name', ['a', 'b']))
+
+        config.delete_var(['a', 'b'], 'name')
+        self.assertEqual('v_a', config.get_var('name', ['a', 'b']))
+        config.delete_var([], 'name')
+        self.assertEqual('default', config.get_var('name', ['c']))
+
+    def testGetDoesNotCreateLocations(self):
+        config = Config()
+        config.set_var('name', 1, ['a'])
+        config.get_var('name', ['a', 'b', 'c'])
+        config.get_var('other', [])
+        self.assertEqual({'a': {'name': 1}}, dict(config.data))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,10 @@
 import os
 import unittest
+from collections import namedtuple
 
 import jsonpickle
 
-from cogs.hierarchical_config import HierarchicalConfig, Location
-from cogs.hierarchical_config.config import Variable
+from cogs.hierarchical_config import HierarchicalConfig, Location, LocationCodec, Variable, VariableNotInLevel
 
 
 class TestSettings(unittest.TestCase):
@@ -116,7 +116,159 @@ class TestSettings(unittest.TestCase):
         loaded_config.load(file_path)
 
         self.assertEquals(config, loaded_config)
+        self.assertFalse(os.path.exists(file_path + '.tmp'))
 
+    def testCodec(self):
+        config = HierarchicalConfig()
+        config.set_var('var1', 10, [])
+        config.set_var('var2', {1, 2}, ['a1'])
+        config.set_var('var3', [{'abc': 234}], ['a1', 'b1'])
+        config.ensure_path(['a2'])
+
+        for binary in (False, True):
+            self.assertEqual(config.data, LocationCodec.decode(LocationCodec.encode(config.data, binary=binary)))
+
+    def testLoadJsonpickle(self):
+        config = HierarchicalConfig()
+        config.set_var('var1', 10, [])
+        config.set_var('var2', {1, 2}, ['a1'])
+        config.set_var('var3', 'abc', ['a1', 'b1'])
+
+        self.assertEqual(config.data, LocationCodec.decode(jsonpickle.encode(config.data).encode('utf-8')))
+
+    def testLoadJsonpickleReferences(self):
+        shared = [1, 2]
+        config = HierarchicalConfig()
+        config.set_var('var1', shared, ['a1'])
+        config.set_var('var2', {'x': shared}, ['a1', 'b1'])
+        config.set_var('var3', shared, ['a2'])
+
+        # written by jsonpickle, later occurrences of the list are references to the first one
+        legacy = b'''{"py/object": "hierarchical_config.Location", "locations": {"a1": {"py/object":
+            "hierarchical_config.Location", "locations": {"b1": {"py/object": "hierarchical_config.Location",
+            "locations": {}, "values": {"var2": {"x": [1, 2]}}}}, "values": {"var1": {"py/id": 8}}},
+            "a2": {"py/object": "hierarchical_config.Location", "locations": {}, "values": {"var3": {"py/id": 8}}}},
+            "values": {}}'''
+        self.assertEqual(config.data, LocationCodec.decode(legacy))
+
+    def testCodecTagLikeValues(self):
+        config = HierarchicalConfig()
+        config.set_var('var1', {'py/set': [1, 2]}, [])
+        config.set_var('var2', {'py/dict': {'py/set': []}}, ['py/set'])
+        self.assertEqual(config.data, LocationCodec.decode(LocationCodec.encode(config.data)))
+
+    def testMissingLocation(self):
+        config = HierarchicalConfig()
+        config.set_var('var', 1, ['a1'])
+
+        self.assertIsNone(config.get_location(['a1', 'b1']))
+        self.assertIsNone(config.get_location(['a2']))
+        config.delete_var(['a2'], 'var')
+        config.delete_var(['a1'], 'var')
+        self.assertIsNone(config.get_var('var', ['a1']))
+        self.assertDictEqual({}, config.get_location(['a1']).values)
+
+    def testLocationAccessors(self):
+        location = Location()
+        self.assertEqual([], list(location.child_items()))
+        location.values['x'] = 1
+        location.locations['a'] = Location(values={'y': 2})
+        self.assertEqual(1, location.get_value('x'))
+        self.assertEqual(2, location.get_child('a').get_value('y'))
+        self.assertEqual({'locations': {'a': {'values': {'y': 2}}}, 'values': {'x': 1}},
+                         LocationCodec.to_dict(location))
+
+    def testResolveAll(self):
+        config = HierarchicalConfig(defaults={'name': 'default', 'other': 0})
+        config.set_var('name', 'root', [])
+        config.set_var('list', [1], ['a'])
+        config.set_var('name', 'a', ['a'])
+        config.set_var('name', 'ab', ['a', 'b'])
+
+        self.assertEqual({'name': 'ab', 'other': 0, 'list': [1]}, config.resolve_all(['a', 'b', 'c']))
+        self.assertEqual({'name': 'root', 'other': 0}, config.resolve_all(['x']))
+        self.assertEqual({'name': 'a', 'missing': None}, config.resolve_all(['a'], ['name', 'missing']))
+        for path in [[], ['a'], ['a', 'b'], ['a', 'c', 'd'], ['x']]:
+            values = config.resolve_all(path, ['name', 'list', 'other'])
+            self.assertEqual({name: config.get_var(name, path) for name in values}, values)
+        config.resolve_all(['a'])['list'].append(2)
+        self.assertEqual([1], config.get_var('list', ['a']))
+
+    def testResolveMany(self):
+        config = HierarchicalConfig(defaults={'name': 'default'})
+        config.set_var('name', 'a', ['a'])
+        config.set_var('name', 'ab', ['a', 'b'])
+
+        paths = [[], ['a'], ['a', 'b'], ['a', 'b', 'c'], ['a', 'c'], ['x', 'b']]
+        self.assertEqual({tuple(path): config.get_var('name', path) for path in paths},
+                         config.resolve_many(paths, 'name'))
+
+    def testResolveUsesCache(self):
+        config = HierarchicalConfig(defaults={'name': 'default'})
+        config.set_var('name', 'a', ['a'])
+
+        config.resolve_many([['a', 'b'], ['x']], 'name')
+        hits = config.cache_info().hits
+        self.assertEqual('a', config.get_var('name', ['a', 'b']))
+        self.assertEqual('default', config.resolve_all(['x'], ['name'])['name'])
+        self.assertEqual(hits + 2, config.cache_info().hits)
+
+        config.set_var('name', 'ab', ['a', 'b'])
+        self.assertEqual({('a', 'b'): 'ab', ('a',): 'a'}, config.resolve_many([['a', 'b'], ['a']], 'name'))
+        self.assertEqual('ab', config.resolve_all(['a', 'b', 'c'])['name'])
+
+    def testResolveWalksPathOnce(self):
+        config = HierarchicalConfig(defaults={'name': 'default', 'other': 0})
+        config.set_var('name', 'a', ['a'])
+        config.set_var('list', [1], ['a', 'b'])
+        walked = []
+        get_levels = config._get_levels
+        config._get_levels = lambda path: walked.append(path) or get_levels(path)
+
+        self.assertEqual({'name': 'a', 'other': 0, 'list': [1]}, config.resolve_all(['a', 'b', 'c']))
+        self.assertEqual([('a', 'b', 'c')], walked)
+        self.assertEqual('a', config.get_var('name', ['a', 'b', 'c']))
+
+        del walked[:]
+        self.assertEqual({('a', 'b'): 'a', ('a', 'c'): 'a', ('x',): 'default'},
+                         config.resolve_many([['a', 'b'], ['a', 'c'], ['x']], 'name'))
+        self.assertEqual([('a', 'b'), ('a', 'c'), ('x',)], walked)
+        self.assertEqual(('a',), config._cache['name'][('a',)][0])
+        self.assertEqual((None, 'default'), config._cache['name'][()])
+
+    def testFrozen(self):
+        config = HierarchicalConfig(defaults={'default': {'a': 1}})
+        config.set_var('list', [1, 2], ['a'])
+
+        frozen = config.get_var('list', ['a', 'b'], frozen=True)
+        self.assertEqual((1, 2), frozen)
+        self.assertIs(frozen, config.get_var('list', ['a'], frozen=True))
+        self.assertIs(frozen, config.resolve_all(['a'], ['list'], frozen=True)['list'])
+        self.assertIs(frozen, config.resolve_many([['a', 'c']], 'list', frozen=True)[('a', 'c')])
+        self.assertEqual({'a': 1}, config.get_var('default', frozen=True))
+        with self.assertRaises(TypeError):
+            config.get_var('default', frozen=True)['a'] = 2
+
+        self.assertEqual([1, 2, 3], config.update_var('list', lambda value: value + [3], ['a']))
+        self.assertEqual((1, 2, 3), config.get_var('list', ['a'], frozen=True))
+        self.assertEqual((1, 2), frozen)
+        config.delete_var(['a'], 'list')
+        self.assertIsNone(config.get_var('list', ['a'], frozen=True))
+
+    def testFrozenNested(self):
+        config = HierarchicalConfig()
+        config.set_var('nested', {'list': [1, {'x': [2]}], 'set': {3}}, [])
+
+        frozen = config.get_var('nested', ['a'], frozen=True)
+        self.assertEqual((1, {'x': (2,)}), frozen['list'])
+        self.assertEqual(frozenset({3}), frozen['set'])
+        with self.assertRaises(TypeError):
+            frozen['list'][1]['x'] = 3
+        self.assertEqual({'list': [1, {'x': [2]}], 'set': {3}}, config.get_var('nested'))
+
+        config.set_var('nested', {'list': []}, ['a'])
+        self.assertEqual({'list': ()}, config.get_var('nested', ['a'], frozen=True))
+        self.assertIs(frozen, config.get_var('nested', ['b'], frozen=True))
 
     def test_int_variable(self):
         config = HierarchicalConfig()
@@ -126,7 +278,8 @@ class TestSettings(unittest.TestCase):
             var_type='int',
             default=1,
             description='minimum time since last activity before channel is allowed to be deleted',
-            store=config
+            store=config,
+            validator=lambda value: value >= 0
         )
         int_variable.set_global(5)
         self.assertEquals(int_variable.get(), 5)
@@ -134,6 +287,40 @@ class TestSettings(unittest.TestCase):
         self.assertEquals(int_variable.get(), 5)
 
         self.assertRaises(ValueError, int_variable.set_global, 'a')
+        self.assertRaises(ValueError, int_variable.set_global, '-1')
+        self.assertEquals(int_variable.get(), 5)
+
+    def test_validated_variable(self):
+        config = HierarchicalConfig()
+        bool_variable = Variable(
+            levels=['server'],
+            name='bool_variable',
+            var_type='bool',
+            default='yes',
+            description='some switch',
+            store=config
+        )
+        self.assertIs(True, bool_variable.get())
+        server = namedtuple('Server', 'id')('1')
+        bool_variable.set_server(server, 'off')
+        self.assertIs(False, bool_variable.get([server.id]))
+        self.assertRaises(ValueError, bool_variable.set_server, server, 'maybe')
+        with self.assertRaises(VariableNotInLevel) as context:
+            bool_variable.set_global(True)
+        self.assertEqual('global', context.exception.level)
+
+    def test_variable_types(self):
+        self.assertRaises(ValueError, Variable, 'name', 'list', None, 'some list')
+        variable = Variable('switch', bool, 'off', 'some switch', levels=('global', 'server'))
+        self.assertIs(False, variable.default)
+
+        config = HierarchicalConfig()
+        bound = variable.bind(config)
+        server = namedtuple('Server', 'id')('1')
+        bound.set_server(server, 'on')
+        self.assertIs(True, bound.get_server(server))
+        self.assertIs(False, bound.get())
+        self.assertIsNone(variable.store)
 
 
 if __name__ == '__main__':
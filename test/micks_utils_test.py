@@ -1,6 +1,30 @@
+import asyncio
 import unittest
+from collections import namedtuple
 
-from cogs.micks_utils import process_input
+from cogs.micks_utils import process_input, RoleIndex, MicksUtils, paginate, create_messages_from_list
+
+FakeRole = namedtuple('FakeRole', 'id name server')
+
+
+class FakeMember:
+    def __init__(self, id, name, server, roles):
+        self.id = id
+        self.name = name
+        self.server = server
+        self.roles = roles
+
+
+class FakeServer:
+    def __init__(self, id='s1'):
+        self.id = id
+        self.roles = []
+        self.members = []
+
+    def get_member(self, id):
+        for member in self.members:
+            if member.id == id:
+                return member
 
 
 class TestMicksUtils(unittest.TestCase):
@@ -11,3 +35,90 @@ class TestMicksUtils(unittest.TestCase):
         self.assertEquals(expected, process_input('Multi word command'))
 
         self.assertEquals(expected, process_input('Multi WOrd   coMMand'))
+
+    def testRoleIndex(self):
+        server = FakeServer()
+        admin = FakeRole('r1', 'Admin  Team', server)
+        other_admin = FakeRole('r2', 'admin team', server)
+        user = FakeRole('r3', 'User', server)
+        server.roles = [admin, other_admin, user]
+        server.members = [FakeMember('m1', 'a', server, [admin, user]), FakeMember('m2', 'b', server, [user])]
+
+        index = RoleIndex(server)
+        self.assertIs(admin, index.get_role('ADMIN team'))
+        self.assertIsNone(index.get_role('missing'))
+        self.assertEqual(['m1', 'm2'], sorted(member.id for member in index.get_members(user)))
+        self.assertEqual(['m1'], [member.id for member in index.get_members(admin)])
+
+        updated = FakeMember('m2', 'b', server, [admin])
+        index.update_member(server.members[1], updated)
+        server.members[1] = updated
+        self.assertEqual(['m1', 'm2'], sorted(member.id for member in index.get_members(admin)))
+        self.assertEqual(['m1'], [member.id for member in index.get_members(user)])
+
+        server.roles.remove(admin)
+        index.remove_role(admin)
+        self.assertIs(other_admin, index.get_role('admin team'))
+        renamed = FakeRole('r2', 'Mods', server)
+        server.roles[0] = renamed
+        index.update_role(other_admin, renamed)
+        self.assertIsNone(index.get_role('admin team'))
+        self.assertIs(renamed, index.get_role('mods'))
+
+        new = FakeRole('r4', 'New', server)
+        server.roles.append(new)
+        index.add_role(new)
+        self.assertIs(new, index.get_role('new'))
+
+    def testRoleIndexEvents(self):
+        loop = asyncio.new_event_loop()
+        server = FakeServer()
+        role = FakeRole('r1', 'Role', server)
+        server.roles = [role]
+        server.members = [FakeMember('m1', 'a', server, [role])]
+        utils = MicksUtils(bot=None)
+
+        index = utils.role_index(server)
+        member = FakeMember('m2', 'b', server, [role])
+        server.members.append(member)
+        loop.run_until_complete(utils.on_member_join(member))
+        self.assertIs(index, utils.role_index(server))
+        self.assertEqual(['m1', 'm2'], sorted(member.id for member in index.get_members(role)))
+
+        server.members.remove(member)
+        loop.run_until_complete(utils.on_member_remove(member))
+        self.assertEqual(['m1'], [member.id for member in index.get_members(role)])
+
+        # members added without events (chunking) cause a rebuild
+        server.members.append(member)
+        self.assertEqual(['m1', 'm2'], sorted(member.id for member in utils.role_index(server).get_members(role)))
+
+        loop.run_until_complete(utils.on_server_remove(server))
+        self.assertNotIn(server.id, utils.role_indexes)
+        loop.close()
+
+    def testPaginate(self):
+        lines = ['x' * 100] * 50 + ['y' * 3000, 'a```b']
+        messages = list(paginate(lines, limit=2000))
+        self.assertTrue(all(len(message) <= 2000 for message in messages))
+        self.assertTrue(all(message.startswith('```\n') and message.endswith('\n```') for message in messages))
+        self.assertEqual(5, len(messages))
+        self.assertEqual(sum(message.count('\n') - 1 for message in messages), len(lines))
+        self.assertNotIn('a```b', messages[-1])
+
+    def testPaginateLazily(self):
+        produced = []
+
+        def lines():
+            for i in range(100):
+                produced.append(i)
+                yield 'line {0}'.format(i)
+
+        pages = create_messages_from_list('Lines:', '- {0}', lines(), limit=100)
+        first = next(pages)
+        self.assertTrue(first.startswith('```\nLines:\n- line 0\n'))
+        self.assertLess(len(produced), 20)
+        rest = list(pages)
+        self.assertEqual(100, len(produced))
+        self.assertTrue(all(len(page) <= 100 for page in rest))
+        self.assertIn('- line 99', rest[-1])
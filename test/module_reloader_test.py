@@ -0,0 +1,237 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+from cogs.module_reloader import FileWatcher, PollingWatcher, create_watcher, module_of_file, scan_files, \
+    ChangeDetector, DependencyGraph, ReloadStats, ModuleReloader, timed_load_extension
+
+
+class TestModuleReloader(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.directory.name, 'cogs')
+        os.makedirs(os.path.join(self.root, 'pkg'))
+        self.write('a.py')
+        self.write(os.path.join('pkg', 'b.py'))
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        self.directory.cleanup()
+
+    def write(self, name, text='x = 1\n'):
+        path = os.path.join(self.root, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        # make mtime change visible to polling on file systems with coarse timestamps
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, time.time() + len(text)))
+        return path
+
+    def collect_changes(self, watcher_factory, change):
+        batches = []
+        watcher = watcher_factory(self.loop, self.root, batches.append, 0.05)
+        try:
+            self.loop.run_until_complete(asyncio.sleep(0.05))
+            change()
+            deadline = self.loop.time() + 5
+            while not batches and self.loop.time() < deadline:
+                self.loop.run_until_complete(asyncio.sleep(0.05))
+        finally:
+            watcher.stop()
+        return batches
+
+    def test_module_of_file(self):
+        self.assertEqual('cogs.a', module_of_file(os.path.join('cogs', 'a.py')))
+        self.assertEqual('cogs.pkg', module_of_file(os.path.join('cogs', 'pkg', 'sub', 'b.py')))
+        self.assertIsNone(module_of_file(os.path.join('cogs', 'utils', 'c.py')))
+        self.assertIsNone(module_of_file(os.path.join('other', 'd.py')))
+        self.assertEqual('cogs.a', module_of_file(os.path.join(self.root, 'a.py'), self.root))
+
+    def test_scan_files(self):
+        os.symlink(os.path.join(self.root, 'a.py'), os.path.join(self.root, 'link.py'))
+        self.assertEqual({os.path.join(self.root, name) for name in ['a.py', 'link.py', os.path.join('pkg', 'b.py')]},
+                         set(scan_files(self.root)))
+
+    def test_debounce(self):
+        batches = []
+        watcher = PollingWatcher(self.loop, self.root, batches.append, 0.05)
+        watcher.file_changed('a.py')
+        self.loop.run_until_complete(asyncio.sleep(0.02))
+        watcher.file_changed('b.py')
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual([{'a.py', 'b.py'}], batches)
+
+    def test_polling_watcher(self):
+        def factory(*args):
+            watcher = PollingWatcher(*args, period=0.05)
+            watcher.start()
+            return watcher
+
+        batches = self.collect_changes(factory, lambda: self.write(os.path.join('pkg', 'b.py'), 'x = 2\n'))
+        self.assertEqual([{os.path.join(self.root, 'pkg', 'b.py')}], batches)
+
+    def test_watcher(self):
+        new_dir = os.path.join(self.root, 'new')
+
+        def change():
+            os.mkdir(new_dir)
+            self.loop.run_until_complete(asyncio.sleep(0.1))
+            self.write(os.path.join('new', 'c.py'))
+
+        batches = self.collect_changes(create_watcher, change)
+        self.assertIn(os.path.join(new_dir, 'c.py'), set().union(*batches))
+
+    def test_watcher_fallback(self):
+        def add_reader(fd, callback):
+            raise NotImplementedError
+
+        self.loop.add_reader = add_reader
+        watcher = create_watcher(self.loop, self.root, lambda changed: None)
+        try:
+            self.assertIsInstance(watcher, PollingWatcher)
+        finally:
+            watcher.stop()
+        self.assertRaises(TypeError, FileWatcher, self.loop, self.root, lambda changed: None)
+
+    def test_watcher_symlink(self):
+        target_dir = os.path.join(self.directory.name, 'target')
+        os.mkdir(target_dir)
+        target = os.path.join(target_dir, 'd.py')
+        with open(target, 'w') as f:
+            f.write('x = 1\n')
+        link = os.path.join(self.root, 'd.py')
+        os.symlink(target, link)
+
+        def change():
+            with open(target, 'w') as f:
+                f.write('x = 22\n')
+            stat = os.stat(target)
+            os.utime(target, (stat.st_atime, time.time() + 10))
+
+        batches = self.collect_changes(create_watcher, change)
+        self.assertIn(link, set().union(*batches))
+
+    def test_change_detector(self):
+        contents = {}
+        deleted = []
+        detector = ChangeDetector(contents.__setitem__, deleted.append)
+        a = os.path.join(self.root, 'a.py')
+        self.assertEqual(set(scan_files(self.root)), detector.refresh(scan_files(self.root)))
+        self.assertEqual(b'x = 1\n', contents[a])
+
+        self.assertEqual(set(), detector.refresh([a]))
+        os.utime(a, (0, 1000))
+        self.assertEqual(set(), detector.refresh([a]))
+        self.write('a.py', 'x = 2\n')
+        self.assertEqual({a}, detector.refresh([a]))
+        self.assertEqual(b'x = 2\n', contents[a])
+        os.remove(a)
+        self.assertEqual({a}, detector.refresh([a]))
+        self.assertEqual([a], deleted)
+
+    def test_dependency_graph(self):
+        graph = DependencyGraph('cogs')
+        sources = {
+            'config.py': 'import json\nfrom cogs.utils import checks\n',
+            'manager.py': 'from cogs.config import Config\nfrom cogs.owner import CogLoadError\n',
+            os.path.join('pkg', 'pkg.py'): 'from . import helper, manager\nfrom .helper import x\n',
+            os.path.join('pkg', 'helper.py'): 'import cogs.config\n',
+            'other.py': 'from cogs import pkg\n',
+            'broken.py': 'from cogs import',
+        }
+        for name, source in sources.items():
+            graph.update_file(os.path.join('cogs', name), source.encode())
+
+        self.assertEqual({'cogs.config': set(), 'cogs.manager': {'cogs.config', 'cogs.owner'},
+                          'cogs.pkg': {'cogs.config'}, 'cogs.other': {'cogs.pkg'}},
+                         dict(graph.dependencies()))
+        self.assertEqual(['cogs.config', 'cogs.manager', 'cogs.pkg', 'cogs.other'],
+                         graph.reload_order(['cogs.pkg', 'cogs.config']))
+        self.assertEqual(['cogs.config', 'cogs.other'],
+                         graph.reload_order(['cogs.config'], loaded={'cogs.other'}))
+        self.assertEqual(['cogs.owner'], graph.reload_order(['cogs.owner'], loaded=set()))
+
+        graph.update_file(os.path.join('cogs', 'config.py'), b'import cogs.other\n')
+        with self.assertLogs('red.module_reloader', 'WARNING'):
+            order = graph.reload_order(['cogs.config'])
+        self.assertEqual(['cogs.config', 'cogs.manager', 'cogs.other', 'cogs.pkg'], order)
+        graph.remove_file(os.path.join('cogs', 'other.py'))
+        self.assertEqual(['cogs.config', 'cogs.manager', 'cogs.pkg'], graph.reload_order(['cogs.config']))
+
+    def test_reload_stats(self):
+        stats = ReloadStats()
+        stats.record('cogs.fast', {'unload': 0.001, 'import': 0.002, 'setup': 0.001})
+        stats.record('cogs.slow', {'unload': 0.001, 'import': 0.2, 'setup': 0.1})
+        stats.record('cogs.slow', {'unload': 0.001, 'import': 0.1}, 'ValueError: broken')
+        stats.record_batch({'commands': 0.004})
+
+        slow = stats.modules['cogs.slow']
+        self.assertEqual((1, 1, 'ValueError: broken'), (slow.successes, slow.failures, slow.last_error))
+        self.assertAlmostEqual(0.15, slow.mean('import'))
+        self.assertAlmostEqual(0.2, slow.slowest['import'])
+        self.assertAlmostEqual(0.1, slow.mean('setup'))
+        self.assertEqual(['cogs.slow', 'cogs.fast'], [module for module, _ in stats.slowest()])
+        self.assertEqual(['cogs.slow'], [module for module, _ in stats.slowest(1)])
+
+        message = stats.format()
+        self.assertIn('cogs.slow: ValueError: broken', message)
+        self.assertLess(message.index('cogs.slow'), message.index('cogs.fast'))
+        self.assertIn('batches: 1', message)
+
+    def test_reload_continues_after_error(self):
+        class Owner:
+            def _unload_cog(self, module, reloading=False):
+                pass
+
+            def _load_cog(self, module):
+                if module == 'cogs.a':
+                    raise RuntimeError('broken')
+                loaded.append(module)
+
+            async def disable_commands(self):
+                disabled.append(True)
+
+        class Bot:
+            def __init__(self, loop):
+                self.loop = loop
+
+            def get_cog(self, name):
+                return owner
+
+            def load_extension(self, name):
+                pass
+
+        loaded = []
+        disabled = []
+        owner = Owner()
+        reloader = ModuleReloader(Bot(self.loop))
+        with self.assertLogs('red.module_reloader', 'ERROR'):
+            self.loop.run_until_complete(reloader.reload_modules(['cogs.a', 'cogs.b']))
+        self.assertEqual(['cogs.b'], loaded)
+        self.assertEqual([True], disabled)
+        self.assertEqual('RuntimeError: broken', reloader.stats.modules['cogs.a'].last_error)
+
+    def test_timed_load_extension(self):
+        class Bot:
+            def load_extension(self, name):
+                time.sleep(0.01)
+                loaded.append(name)
+
+        loaded = []
+        timings = {}
+        bot = Bot()
+        with timed_load_extension(bot, timings):
+            bot.load_extension('cogs.a')
+        self.assertEqual(['cogs.a'], loaded)
+        self.assertGreaterEqual(timings['setup'], 0.01)
+        self.assertNotIn('load_extension', vars(bot))
+
+
+if __name__ == '__main__':
+    unittest.main()